@@ -1,14 +1,38 @@
+import argparse
 import asyncio
+import bisect
+import contextlib
+import gzip
+import hashlib
+import hmac
 import json
+import mmap
+import multiprocessing
+import os
 import random
+import re
+import signal
+import struct
+import sys
+import threading
+import time
 import uuid
+import zlib
+from array import array
+from collections import deque
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Dict, List, Set, Tuple, Optional
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Set, Tuple, Optional
 import websockets
 from aiohttp import web
 import aiohttp
 
+try:
+    import brotli
+except ImportError:  # brotli 为可选依赖，缺失时只提供 gzip 压缩版本
+    brotli = None
+
 # 游戏配置
 GAME_WIDTH = 600
 GAME_HEIGHT = 400
@@ -19,6 +43,45 @@ MAX_PLAYERS = 10
 INITIAL_SPEED = 10  # 格子/秒
 FOOD_COUNT = 5
 SPEED_INCREMENT = 0.5  # 每吃一个食物增加的速度
+KEYFRAME_INTERVAL = 200  # 每隔多少帧广播一次完整关键帧
+SEND_RATE = 20  # 每秒最多广播次数，与模拟频率无关
+MAX_CATCHUP_TICKS = 5  # 落后时单次循环最多补跑的tick数
+STATS_INTERVAL = 60  # 调度统计输出间隔（秒）
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+STATIC_MAX_AGE = 365 * 24 * 3600  # 带版本号的静态资源缓存时长（秒）
+ROOM_IDLE_TIMEOUT = 60  # 房间无人后保留多久再回收（秒）
+MAX_ROOMS = 100  # 每个进程的房间数上限，每个房间有自己的游戏循环（和录像文件）
+ROOM_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,32}")  # /ws?room= 允许的房间号
+OUTBOX_SIZE = 64  # 每个连接最多排队的非状态消息数（欢迎、聊天等），满时丢弃最旧的可丢弃消息
+OUTBOX_DROPPABLE = ("chat", "pong")  # 发送队列满时可以丢弃的消息类型
+SLOW_CLIENT_TIMEOUT = 5.0  # 发送积压超过该时长的客户端将被断开（秒）
+WORKER_POLL_INTERVAL = 1.0  # 多进程模式下主进程汇总工作进程状态的间隔（秒）
+SHUTDOWN_TIMEOUT = 5.0  # 关闭服务器时等待连接处理结束的时长（秒），之后保存录像
+ENCODE_WORKERS = 0  # 帧编码池大小，0 表示在事件循环中编码
+INPUT_QUEUE_SIZE = 4  # 每个玩家最多排队的方向指令数，每个tick消费一条
+INPUT_RATE = 20  # 每个连接每秒允许的消息数，超出的消息在解析前丢弃
+INPUT_BURST = 40  # 限流的突发容量
+MAX_MESSAGE_SIZE = 4096  # 客户端单条消息的最大字节数
+WS_CLOSE_REPLACED = 4001  # 同一玩家在新连接中加入时旧连接的关闭码，客户端收到后不再重连
+WS_COMPRESS = True  # 客户端支持时启用 permessage-deflate，连接内共享压缩上下文
+METRICS_TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)  # 耗时直方图分桶（秒）
+LOOP_LAG_INTERVAL = 0.25  # 事件循环延迟的采样间隔（秒）
+ADMIN_TOKEN_ENV = "SNAKE_ADMIN_TOKEN"  # 设置该环境变量后 /admin 接口需要令牌，否则只允许本机访问
+PROFILE_INTERVAL = 0.005  # 采样分析器的采样间隔（秒）
+PROFILE_MAX_SECONDS = 60  # 单次分析或追踪的最长时间（秒）
+TRACE_BUFFER_SIZE = 100000  # tick追踪环形缓冲区保留的事件数
+REPLAY_HASH_INTERVAL = 100  # 录像中每隔多少tick记录一次状态摘要
+REPLAY_MAX_SPEED = 64  # 观战回放的最大倍速
+REPLAY_MAX_STREAMS = 4  # 每个进程同时进行的观战回放数，回放在本进程内重新模拟，与在线房间争用CPU
+VIEW_WIDTH = GRID_WIDTH  # 客户端视野（格子数），与画布大小一致；场地超过视野时按视野裁剪广播
+VIEW_HEIGHT = GRID_HEIGHT
+VIEW_MARGIN = 4  # 视野外的缓冲格数，实体离开缓冲区才通知移除，避免在边缘反复进出
+BUCKET_SIZE = 8  # 空间分桶的边长（格子数）
+SPAWN_ATTEMPTS = 64  # 随机挑选出生位置的次数，都失败时按顺序扫描空闲格子
+
+# 占用网格中的特殊标记，非负值为玩家槽位
+EMPTY = -1
+FOOD = -2
 
 # 方向向量
 DIRECTIONS = {
@@ -28,1105 +91,2439 @@ DIRECTIONS = {
     "right": (1, 0)
 }
 
+class SnakeBody:
+    """蛇身：双端队列保存有序身体，集合镜像用于O(1)成员判断"""
+    __slots__ = ("cells", "members")
+    
+    def __init__(self, cells: Iterable[Tuple[int, int]] = ()):
+        self.cells = deque(cells)
+        self.members = set(self.cells)
+    
+    def push_head(self, pos: Tuple[int, int]):
+        """在头部插入新格子"""
+        self.cells.appendleft(pos)
+        self.members.add(pos)
+    
+    def pop_tail(self) -> Tuple[int, int]:
+        """移除并返回尾部格子"""
+        pos = self.cells.pop()
+        self.members.discard(pos)
+        return pos
+    
+    @property
+    def head(self) -> Tuple[int, int]:
+        return self.cells[0]
+    
+    def to_list(self) -> List[Tuple[int, int]]:
+        """按从头到尾的顺序导出"""
+        return list(self.cells)
+    
+    def __contains__(self, pos) -> bool:
+        return pos in self.members
+    
+    def __len__(self) -> int:
+        return len(self.cells)
+    
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        return iter(self.cells)
+    
+    def __getitem__(self, index: int) -> Tuple[int, int]:
+        return self.cells[index]
+
+class FreeCells:
+    """空闲格子集合：紧凑数组加位置索引，O(1)增删与均匀随机采样"""
+    __slots__ = ("cells", "positions")
+    
+    def __init__(self, size: int):
+        self.cells = array('i', range(size))
+        self.positions = array('i', range(size))  # 格子在 cells 中的位置，不空闲为 -1
+    
+    def add(self, cell: int):
+        if self.positions[cell] < 0:
+            self.positions[cell] = len(self.cells)
+            self.cells.append(cell)
+    
+    def remove(self, cell: int):
+        """用末尾元素填补被移除的位置"""
+        position = self.positions[cell]
+        if position < 0:
+            return
+        last = self.cells.pop()
+        if last != cell:
+            self.cells[position] = last
+            self.positions[last] = position
+        self.positions[cell] = -1
+    
+    def sample(self, rng) -> int:
+        """均匀随机取一个空闲格子"""
+        return self.cells[rng.randrange(len(self.cells))]
+    
+    def __contains__(self, cell: int) -> bool:
+        return self.positions[cell] >= 0
+    
+    def __len__(self) -> int:
+        return len(self.cells)
+
+class SpatialIndex:
+    """均匀网格分桶：记录每个桶内各玩家的身体格子数和食物格子，用于查询视野内的实体"""
+    def __init__(self, width: int, height: int, bucket_size: int = BUCKET_SIZE):
+        self.width = width
+        self.height = height
+        self.bucket_size = bucket_size
+        self.cols = (width + bucket_size - 1) // bucket_size
+        self.rows = (height + bucket_size - 1) // bucket_size
+        self.players: List[Dict[int, int]] = [{} for _ in range(self.cols * self.rows)]
+        self.foods: List[Set[int]] = [set() for _ in range(self.cols * self.rows)]
+    
+    def bucket(self, cell: int) -> int:
+        y, x = divmod(cell, self.width)
+        return (y // self.bucket_size) * self.cols + x // self.bucket_size
+    
+    def add_cell(self, slot: int, cell: int):
+        counts = self.players[self.bucket(cell)]
+        counts[slot] = counts.get(slot, 0) + 1
+    
+    def remove_cell(self, slot: int, cell: int):
+        counts = self.players[self.bucket(cell)]
+        if counts[slot] == 1:
+            del counts[slot]
+        else:
+            counts[slot] -= 1
+    
+    def add_food(self, cell: int):
+        self.foods[self.bucket(cell)].add(cell)
+    
+    def remove_food(self, cell: int):
+        self.foods[self.bucket(cell)].discard(cell)
+    
+    def _spans(self, center: int, radius: int, size: int, count: int) -> Set[int]:
+        """场地边界环绕时，区间覆盖的桶下标"""
+        if 2 * radius + 1 >= size:
+            return set(range(count))
+        return {(pos % size) // self.bucket_size
+                for pos in range(center - radius, center + radius + 1)}
+    
+    def query(self, x: int, y: int, radius_x: int, radius_y: int) -> Tuple[Set[int], Set[int]]:
+        """返回以 (x, y) 为中心的矩形所覆盖的桶内的玩家槽位和食物格子"""
+        cols = self._spans(x, radius_x, self.width, self.cols)
+        slots: Set[int] = set()
+        foods: Set[int] = set()
+        for row in self._spans(y, radius_y, self.height, self.rows):
+            for col in cols:
+                bucket = row * self.cols + col
+                slots.update(self.players[bucket])
+                foods.update(self.foods[bucket])
+        return slots, foods
+
 @dataclass
 class Player:
     """玩家类"""
     id: str
     name: str
     color: str
+    body: SnakeBody  # 初始蛇身由 Game.spawn_body 在空闲格子中选择
     direction: Tuple[int, int] = (1, 0)
-    next_direction: Optional[Tuple[int, int]] = None
-    body: List[Tuple[int, int]] = field(default_factory=list)
+    inputs: deque = field(default_factory=deque)  # 待消费的方向，每tick按顺序消费一条
     score: int = 0
     alive: bool = True
+    slot: int = -1
+    needs_keyframe: bool = True
+    proto: str = "json"  # 广播帧格式：json 或 bin
     ws: Optional[websockets.WebSocketServerProtocol] = None
+    outbox: Optional["Outbox"] = None
     last_move_time: float = 0.0
+    # 按视野裁剪广播时，客户端当前持有的玩家（id -> 槽位）和食物（id -> 食物）
+    known_players: Dict[str, int] = field(default_factory=dict)
+    known_foods: Dict[str, "Food"] = field(default_factory=dict)
     
     def __post_init__(self):
-        # 随机初始位置
-        x = random.randint(5, GRID_WIDTH - 6)
-        y = random.randint(5, GRID_HEIGHT - 6)
-        self.body = [(x, y), (x-1, y), (x-2, y)]
-        self.last_move_time = asyncio.get_event_loop().time()
+        self.last_move_time = time.monotonic()
 
-@dataclass
+@dataclass(frozen=True)
 class Food:
-    """食物类"""
+    """食物类（生成后不再修改，可在快照之间共享）"""
     x: int
     y: int
     id: str = field(default_factory=lambda: str(uuid.uuid4()))
 
+class StateDelta:
+    """两次广播之间累积的增量变化"""
+    def __init__(self):
+        self.heads: Dict[str, List[Tuple[int, int]]] = {}
+        self.tails: Dict[str, int] = {}
+        self.changed: Set[str] = set()
+        self.joined: Dict[str, None] = {}
+        self.left: List[Player] = []
+        self.foods_added: Dict[str, Food] = {}
+        self.foods_removed: List[Food] = []
+        self.speed_changed = False
+
+class PlayerView(NamedTuple):
+    """玩家在某一版本的只读视图"""
+    id: str
+    name: str
+    color: str
+    slot: int
+    body: Tuple[Tuple[int, int], ...]
+    score: int
+    alive: bool
+
+class Snapshot(NamedTuple):
+    """某一版本的只读游戏状态，发布后不再修改，读者无需加锁或复制；可序列化后交给进程池"""
+    version: int
+    tick: int
+    width: int
+    height: int
+    speed: float
+    players: Tuple[PlayerView, ...]
+    foods: Tuple[Food, ...]
+
+class FrameDelta(NamedTuple):
+    """一次广播的只读增量，玩家信息取自同一版本的快照"""
+    seq: int
+    left: Tuple[Tuple[str, int], ...]  # (玩家id, 槽位)
+    joined: Tuple[PlayerView, ...]
+    moves: Tuple[Tuple[PlayerView, Tuple[Tuple[int, int], ...], int], ...]  # (玩家, 新蛇头, 移除尾巴数)
+    changed: Tuple[PlayerView, ...]
+    foods_added: Tuple[Food, ...]
+    foods_removed: Tuple[Food, ...]
+    speed_changed: bool
+
 class Game:
     """游戏类"""
-    def __init__(self):
+    def __init__(self, width: int = GRID_WIDTH, height: int = GRID_HEIGHT,
+                 seed: Optional[int] = None):
+        self.width = width
+        self.height = height
+        # 所有随机性都来自该种子，相同种子和输入得到相同结果
+        self.seed = seed if seed is not None else random.randrange(2 ** 63)
+        self.rng = random.Random(self.seed)
+        self._food_seq = 0
         self.players: Dict[str, Player] = {}
-        self.foods: List[Food] = []
+        self.foods: Dict[int, Food] = {}
         self.game_loop_task: Optional[asyncio.Task] = None
-        self.last_update_time = 0
+        self.tick = 0
         self.speed = INITIAL_SPEED
+        # 占用网格：每个格子记录占用者的槽位，或 EMPTY / FOOD
+        self.grid = array('i', [EMPTY]) * (width * height)
+        # 与网格中 EMPTY 格子保持一致的空闲集合
+        self.free = FreeCells(width * height)
+        self.slots: List[Optional[Player]] = []
+        # 场地超过客户端视野时维护空间分桶，广播按视野裁剪
+        self.spatial = (SpatialIndex(width, height)
+                        if width > VIEW_WIDTH or height > VIEW_HEIGHT else None)
+        # 增量广播：序号与尚未发出的变化
+        self.seq = 0
+        self.delta = StateDelta()
+        # 状态版本号：每次状态变化加一，编码结果按版本缓存
+        self.version = 0
+        self._frames: Dict[str, bytes] = {}
+        self._frames_version = -1
+        self._flushed: Optional[FrameDelta] = None
+        # 只读快照：每个版本在事件循环中首次被读取时发布，HTTP、编码与统计只读取快照
+        self._views: Dict[str, PlayerView] = {}
+        self._snapshot: Optional[Snapshot] = None
+        # 录像：记录加入、离开与每tick的输入，None 表示不录像
+        self.recorder: Optional["ReplayRecorder"] = None
+    
+    def state_hash(self) -> bytes:
+        """模拟状态的摘要，用于校验回放；只包含影响后续模拟的状态"""
+        digest = hashlib.blake2b(digest_size=8)
+        digest.update(repr((self.tick, self.speed, self._food_seq)).encode())
+        for player in self.players.values():
+            digest.update(repr((player.id, player.slot, player.alive, player.score,
+                                player.direction, tuple(player.body))).encode())
+        digest.update(repr(sorted(self.foods.items())).encode())
+        digest.update(repr(self.rng.getstate()).encode())
+        return digest.digest()
+    
+    def cell_index(self, pos: Tuple[int, int]) -> int:
+        """坐标转换为网格下标"""
+        return pos[1] * self.width + pos[0]
         
-    def add_player(self, player_id: str, name: str, ws) -> Player:
-        """添加玩家到游戏"""
+    def add_player(self, player_id: str, name: str, ws,
+                   body: Optional[SnakeBody] = None) -> Player:
+        """添加玩家到游戏；同一 id 已在游戏中时先移除旧玩家，释放其槽位和格子"""
+        if player_id in self.players:
+            self.remove_player(player_id)
         colors = [
             "#FF5252", "#FF4081", "#E040FB", "#7C4DFF", "#536DFE",
             "#448AFF", "#40C4FF", "#18FFFF", "#64FFDA", "#69F0AE"
         ]
         
+        if body is None:
+            # 出生失败时不写 join 记录，恢复随机数状态，否则回放时随机数序列会错位
+            state = self.rng.getstate()
+            try:
+                body = self.spawn_body()
+            except ValueError:
+                self.rng.setstate(state)
+                raise
+        elif any(self.grid[self.cell_index(pos)] != EMPTY for pos in body):
+            raise ValueError("初始蛇身与已有的蛇或食物重叠")
+        
         color = colors[len(self.players) % len(colors)]
-        player = Player(id=player_id, name=name, color=color, ws=ws)
+        player = Player(id=player_id, name=name, color=color, ws=ws, body=body)
+        
+        # 分配槽位（复用空闲槽位）
+        if None in self.slots:
+            player.slot = self.slots.index(None)
+            self.slots[player.slot] = player
+        else:
+            player.slot = len(self.slots)
+            self.slots.append(player)
+        
+        for pos in player.body:
+            index = self.cell_index(pos)
+            self.grid[index] = player.slot
+            self.free.remove(index)
+            if self.spatial is not None:
+                self.spatial.add_cell(player.slot, index)
+        
         self.players[player_id] = player
+        self.delta.joined[player_id] = None
+        self.version += 1
+        if self.recorder is not None:
+            self.recorder.join(self.tick, player)
         return player
     
+    def spawn_body(self) -> SnakeBody:
+        """在空闲格子中随机选择出生位置，长度为3的初始蛇身只占用 EMPTY 格子
+        
+        与原来一样不贴近场地边缘；没有可用位置时抛出 ValueError。
+        """
+        def body_at(index: int) -> Optional[SnakeBody]:
+            x, y = index % self.width, index // self.width
+            if not (5 <= x <= self.width - 6 and 5 <= y <= self.height - 6):
+                return None
+            cells = [(x, y), (x - 1, y), (x - 2, y)]
+            if all(self.grid[self.cell_index(pos)] == EMPTY for pos in cells):
+                return SnakeBody(cells)
+            return None
+        
+        for _ in range(SPAWN_ATTEMPTS):
+            if not self.free:
+                break
+            body = body_at(self.free.sample(self.rng))
+            if body is not None:
+                return body
+        for index in sorted(self.free.cells):
+            body = body_at(index)
+            if body is not None:
+                return body
+        raise ValueError("场地上没有可用的出生位置")
+    
     def remove_player(self, player_id: str):
         """从游戏中移除玩家"""
-        if player_id in self.players:
-            del self.players[player_id]
+        player = self.players.pop(player_id, None)
+        if player is None:
+            return
+        
+        # 只清除仍归该玩家所有的格子
+        for pos in player.body:
+            index = self.cell_index(pos)
+            if self.grid[index] == player.slot:
+                self.grid[index] = EMPTY
+                self.free.add(index)
+            if self.spatial is not None:
+                self.spatial.remove_cell(player.slot, index)
+        self.slots[player.slot] = None
+        
+        if player_id in self.delta.joined:
+            del self.delta.joined[player_id]
+        else:
+            self.delta.left.append(player)
+        self.version += 1
+        if self.recorder is not None:
+            self.recorder.leave(self.tick, player)
     
     def generate_food(self):
-        """生成食物"""
-        while len(self.foods) < FOOD_COUNT:
-            # 查找所有被占用的位置
-            occupied = set()
-            for player in self.players.values():
-                occupied.update(player.body)
-            for food in self.foods:
-                occupied.add((food.x, food.y))
-            
-            # 生成不在占用位置的食物
-            attempts = 0
-            while attempts < 100:  # 防止无限循环
-                x = random.randint(0, GRID_WIDTH - 1)
-                y = random.randint(0, GRID_HEIGHT - 1)
-                if (x, y) not in occupied:
-                    self.foods.append(Food(x, y))
-                    break
-                attempts += 1
+        """在空闲格子中均匀随机生成食物，只要还有空闲格子就一定成功"""
+        while len(self.foods) < FOOD_COUNT and self.free:
+            index = self.free.sample(self.rng)
+            self._food_seq += 1
+            food = Food(index % self.width, index // self.width, id=f"f{self._food_seq}")
+            self.grid[index] = FOOD
+            self.free.remove(index)
+            self.foods[index] = food
+            if self.spatial is not None:
+                self.spatial.add_food(index)
+            self.delta.foods_added[food.id] = food
+            self.version += 1
     
     def update(self):
-        """更新游戏状态"""
-        current_time = asyncio.get_event_loop().time()
-        time_since_last_update = current_time - self.last_update_time
-        
-        # 控制更新频率
-        if time_since_last_update < 1.0 / self.speed:
-            return
-        
-        self.last_update_time = current_time
+        """推进一个tick，调用频率由 TickScheduler 控制"""
+        self.tick += 1
+        self.version += 1
+        self._apply_directions()
+        self._move_players()
+        if self.recorder is not None:
+            self.recorder.tick(self)
+    
+    def queue_input(self, player: Player, direction: Tuple[int, int]) -> bool:
+        """把方向指令排入玩家的输入队列，返回是否接受
         
-        # 更新每个玩家的方向
+        与队尾（或当前）方向相同、相反的指令以及队列已满时丢弃，
+        这样一个tick内先上后左的两次按键会在接下来两个tick里依次生效。
+        """
+        last = player.inputs[-1] if player.inputs else player.direction
+        if (not player.alive or len(player.inputs) >= INPUT_QUEUE_SIZE
+                or direction == last or direction == (-last[0], -last[1])):
+            return False
+        player.inputs.append(direction)
+        if self.recorder is not None:
+            self.recorder.input(player, direction)
+        return True
+    
+    def _apply_directions(self):
+        """每个玩家每tick消费一条方向指令"""
         for player in self.players.values():
-            if player.next_direction and player.alive:
-                # 防止直接反向移动
-                current_dx, current_dy = player.direction
-                next_dx, next_dy = player.next_direction
-                if (current_dx, current_dy) != (-next_dx, -next_dy):
-                    player.direction = player.next_direction
-                player.next_direction = None
+            if player.inputs and player.alive:
+                self._apply_directions_for(player)
+    
+    @staticmethod
+    def _apply_directions_for(player: Player):
+        # 防止直接反向移动
+        next_dx, next_dy = player.inputs.popleft()
+        if player.direction != (-next_dx, -next_dy):
+            player.direction = (next_dx, next_dy)
+    
+    def _move_players(self):
+        """同时移动所有玩家：先计算所有新蛇头，再基于tick开始时的快照统一判定碰撞
         
-        # 移动每个玩家
-        for player in self.players.values():
-            if not player.alive:
-                continue
-                
+        - 多个蛇头进入同一格（包括争抢同一个食物）时全部死亡
+        - 撞到tick开始时存活玩家的身体（包括自己）死亡，即使对方本tick也死亡
+        - 本tick前进且没吃到食物的蛇会移走尾巴，其尾巴格不算障碍；
+          本tick死亡的蛇不移走尾巴，进入其尾巴的蛇同样死亡，并沿“进入尾巴”的链条传递
+        - 结果与玩家的处理顺序无关
+        """
+        movers = [player for player in self.players.values() if player.alive]
+        
+        # 第一阶段：计算意图
+        targets = []
+        counts: Dict[int, int] = {}
+        for player in movers:
             dx, dy = player.direction
-            head_x, head_y = player.body[0]
-            new_x = (head_x + dx) % GRID_WIDTH
-            new_y = (head_y + dy) % GRID_HEIGHT
-            new_head = (new_x, new_y)
-            
-            # 检查是否撞到自己
-            if new_head in player.body[1:]:
-                player.alive = False
-                continue
-            
-            # 检查是否撞到其他玩家
-            collision = False
-            for other_player in self.players.values():
-                if other_player.id != player.id and other_player.alive:
-                    if new_head in other_player.body:
-                        collision = True
-                        break
-            if collision:
-                player.alive = False
-                continue
-            
-            # 移动蛇
-            player.body.insert(0, new_head)
-            
-            # 检查是否吃到食物
-            food_eaten = None
-            for i, food in enumerate(self.foods):
-                if (new_head[0], new_head[1]) == (food.x, food.y):
-                    food_eaten = i
-                    player.score += 10
-                    self.speed += SPEED_INCREMENT
-                    break
-            
-            if food_eaten is not None:
-                # 吃到食物，不移除尾部
-                self.foods.pop(food_eaten)
+            head_x, head_y = player.body.head
+            new_head = ((head_x + dx) % self.width, (head_y + dy) % self.height)
+            index = self.cell_index(new_head)
+            targets.append((new_head, index))
+            counts[index] = counts.get(index, 0) + 1
+        
+        # 没吃到食物的玩家本tick会移走尾巴
+        vacated = {}
+        for player, (_, index) in zip(movers, targets):
+            if self.grid[index] != FOOD:
+                vacated[player.slot] = self.cell_index(player.body[-1])
+        
+        # 第二阶段：基于快照判定，全部判定完再应用
+        outcomes = []
+        followers: Dict[int, List[int]] = {}  # 槽位 -> 进入该蛇尾巴、要它前进才能存活的玩家序号
+        for position, (player, (new_head, index)) in enumerate(zip(movers, targets)):
+            owner = self.grid[index]
+            if counts[index] > 1:
+                died = True
+            elif owner >= 0 and self.slots[owner].alive:
+                died = vacated.get(owner) != index
+                if not died and owner != player.slot:
+                    followers.setdefault(owner, []).append(position)
+            else:
+                died = False
+            outcomes.append(died)
+        
+        # 死亡的蛇留在原地，尾巴不会移走
+        dying = [player.slot for player, died in zip(movers, outcomes) if died]
+        while dying:
+            for position in followers.pop(dying.pop(), ()):
+                if not outcomes[position]:
+                    outcomes[position] = True
+                    dying.append(movers[position].slot)
+        
+        for player, (new_head, index), died in zip(movers, targets, outcomes):
+            if died:
+                self._kill(player)
+            else:
+                self._advance(player, new_head, index, self.grid[index] == FOOD)
+    
+    def _kill(self, player: Player):
+        player.alive = False
+        self.delta.changed.add(player.id)
+    
+    def _advance(self, player: Player, new_head: Tuple[int, int], index: int, ate: bool):
+        """蛇头前进一格；没吃到食物时先移走尾部，蛇头可以进入自己刚离开的尾巴格"""
+        spatial = self.spatial
+        if not ate:
+            tail = self.cell_index(player.body.pop_tail())
+            if self.grid[tail] == player.slot:
+                self.grid[tail] = EMPTY
+                self.free.add(tail)
+            if spatial is not None:
+                spatial.remove_cell(player.slot, tail)
+            self.delta.tails[player.id] = self.delta.tails.get(player.id, 0) + 1
+        
+        player.body.push_head(new_head)
+        self.grid[index] = player.slot
+        self.free.remove(index)
+        self.delta.heads.setdefault(player.id, []).append(new_head)
+        if spatial is not None:
+            spatial.add_cell(player.slot, index)
+        
+        if ate:
+            # 吃到食物，不移除尾部
+            food = self.foods.pop(index)
+            if spatial is not None:
+                spatial.remove_food(index)
+            if food.id in self.delta.foods_added:
+                del self.delta.foods_added[food.id]
             else:
-                # 没吃到食物，移除尾部
-                player.body.pop()
+                self.delta.foods_removed.append(food)
+            player.score += 10
+            self.speed += SPEED_INCREMENT
+            self.delta.changed.add(player.id)
+            self.delta.speed_changed = True
+    
+    def publish(self) -> Snapshot:
+        """发布当前版本的只读快照；死亡玩家不再变化，沿用上一次的视图"""
+        views = {}
+        for player_id, player in self.players.items():
+            view = self._views.get(player_id)
+            if view is None or player.alive or view.alive:
+                view = PlayerView(player.id, player.name, player.color, player.slot,
+                                  tuple(player.body), player.score, player.alive)
+            views[player_id] = view
+        self._views = views
+        self._snapshot = Snapshot(self.version, self.tick, self.width, self.height, self.speed,
+                                  tuple(views.values()), tuple(self.foods.values()))
+        return self._snapshot
+    
+    def snapshot(self) -> Snapshot:
+        """当前版本的快照，版本变化后的首次读取时发布
+        
+        复制蛇身的开销与蛇长成正比，没有读者的tick（如补跑的tick）不发布。
+        """
+        if self._snapshot is None or self._snapshot.version != self.version:
+            return self.publish()
+        return self._snapshot
+    
+    @staticmethod
+    def player_state(player: PlayerView) -> dict:
+        """单个玩家的完整状态"""
+        return {
+            "id": player.id,
+            "name": player.name,
+            "color": player.color,
+            "body": player.body,
+            "score": player.score,
+            "alive": player.alive
+        }
+    
+    @staticmethod
+    def food_state(food: Food) -> dict:
+        return {"x": food.x, "y": food.y, "id": food.id}
+    
+    @staticmethod
+    def snapshot_state(snapshot: Snapshot) -> dict:
+        """快照的完整状态"""
+        return {
+            "players": [Game.player_state(player) for player in snapshot.players],
+            "foods": [Game.food_state(food) for food in snapshot.foods],
+            "grid_width": snapshot.width,
+            "grid_height": snapshot.height,
+            "speed": snapshot.speed
+        }
     
     def get_state(self):
         """获取游戏状态"""
-        players_data = []
-        for player in self.players.values():
-            players_data.append({
-                "id": player.id,
-                "name": player.name,
-                "color": player.color,
-                "body": player.body,
-                "score": player.score,
-                "alive": player.alive
-            })
+        return self.snapshot_state(self.snapshot())
+    
+    def flush_delta(self) -> StateDelta:
+        """取出自上次广播以来的增量变化，并推进广播序号"""
+        delta, self.delta = self.delta, StateDelta()
+        self.seq += 1
+        return delta
+    
+    @staticmethod
+    def freeze_delta(delta: StateDelta, snapshot: Snapshot, seq: int) -> FrameDelta:
+        """把取出的增量转换为只读形式，玩家状态取自快照"""
+        players = {player.id: player for player in snapshot.players}
+        # 新加入的玩家已包含完整状态，无需再发送其移动和变化
+        return FrameDelta(
+            seq=seq,
+            left=tuple((player.id, player.slot) for player in delta.left),
+            joined=tuple(players[player_id] for player_id in delta.joined),
+            moves=tuple((players[player_id], tuple(heads), delta.tails.get(player_id, 0))
+                        for player_id, heads in delta.heads.items()
+                        if player_id in players and player_id not in delta.joined),
+            changed=tuple(players[player_id] for player_id in delta.changed
+                          if player_id in players and player_id not in delta.joined),
+            foods_added=tuple(delta.foods_added.values()),
+            foods_removed=tuple(delta.foods_removed),
+            speed_changed=delta.speed_changed
+        )
+    
+    @staticmethod
+    def delta_state(delta: FrameDelta, snapshot: Snapshot) -> dict:
+        """增量变化的JSON表示"""
+        data = {}
+        
+        if delta.left:
+            data["left"] = [player_id for player_id, _ in delta.left]
+        if delta.joined:
+            data["joined"] = [Game.player_state(player) for player in delta.joined]
+        if delta.moves:
+            data["moves"] = {player.id: {"heads": heads, "tails": tails}
+                             for player, heads, tails in delta.moves}
+        if delta.changed:
+            data["changed"] = {player.id: {"score": player.score, "alive": player.alive}
+                               for player in delta.changed}
+        if delta.foods_added:
+            data["foods_added"] = [Game.food_state(food) for food in delta.foods_added]
+        if delta.foods_removed:
+            data["foods_removed"] = [food.id for food in delta.foods_removed]
+        if delta.speed_changed:
+            data["speed"] = snapshot.speed
+        return data
+    
+    def _sync_frames(self):
+        """状态版本变化后清空编码缓存"""
+        if self._frames_version != self.version:
+            self._frames = {}
+            self._frames_version = self.version
+            self._flushed = None
+    
+    def flush_frames(self) -> FrameDelta:
+        """为当前版本取出增量并推进序号；同一版本的增量帧和关键帧共用这一次取出的结果"""
+        self._sync_frames()
+        if self._flushed is None:
+            self._flushed = self.freeze_delta(self.flush_delta(), self.snapshot(), self.seq)
+        return self._flushed
+    
+    def interest_frame(self, player: Player, snapshot: Snapshot, delta: FrameDelta,
+                       keyframe: bool, views: Dict[int, PlayerView]) -> Tuple[Snapshot, FrameDelta]:
+        """按玩家视野裁剪快照和增量，views 为快照中槽位到玩家视图的映射
+        
+        进入视野的实体完整发送（增量中作为 joined / foods_added），离开视野外缓冲区的实体
+        通知移除（left / foods_removed），已持有的实体只发送增量变化。
+        """
+        x, y = player.body.head
+        radius_x, radius_y = VIEW_WIDTH // 2, VIEW_HEIGHT // 2
+        inner_slots, inner_foods = self.spatial.query(x, y, radius_x, radius_y)
+        outer_slots, outer_foods = self.spatial.query(x, y, radius_x + VIEW_MARGIN,
+                                                      radius_y + VIEW_MARGIN)
+        
+        known_players = {} if keyframe else player.known_players
+        known_foods = {} if keyframe else player.known_foods
+        
+        # 视野内的实体可见；已持有的实体在离开缓冲区前保持可见
+        visible = {views[slot].id for slot in inner_slots}
+        visible.update(player_id for player_id, slot in known_players.items()
+                       if slot in outer_slots and views[slot].id == player_id)
+        foods = {self.foods[cell].id: self.foods[cell] for cell in inner_foods}
+        for food_id, food in known_foods.items():
+            cell = self.cell_index((food.x, food.y))
+            if cell in outer_foods and self.foods.get(cell) is food:
+                foods[food_id] = food
+        
+        # 离开后以相同 id 重新加入的玩家按新玩家处理
+        rejoined = {view.id for view in delta.joined}
+        staying = {player_id for player_id in known_players
+                   if player_id in visible and player_id not in rejoined}
+        players = tuple(view for view in snapshot.players if view.id in visible)
+        
+        player.known_players = {view.id: view.slot for view in players}
+        player.known_foods = foods
+        view_snapshot = snapshot._replace(players=players, foods=tuple(foods.values()))
+        if keyframe:
+            return view_snapshot, delta
+        return view_snapshot, delta._replace(
+            left=tuple(item for item in known_players.items() if item[0] not in staying),
+            joined=tuple(view for view in players if view.id not in staying),
+            moves=tuple(move for move in delta.moves if move[0].id in staying),
+            changed=tuple(view for view in delta.changed if view.id in staying),
+            foods_added=tuple(food for food_id, food in foods.items() if food_id not in known_foods),
+            foods_removed=tuple(food for food_id, food in known_foods.items() if food_id not in foods)
+        )
+    
+    def encoded(self, kind: str) -> bytes:
+        """返回当前版本的编码帧；同一版本只编码一次，所有接收者共享"""
+        self._sync_frames()
+        frame = self._frames.get(kind)
+        if frame is not None:
+            return frame
+        
+        delta = None if kind == "players" else self.flush_frames()
+        frame = encode_frame(kind, self.snapshot(), delta)
+        self._frames[kind] = frame
+        return frame
+
+# 录像文件格式（小端，只追加）：
+#   文件头  4s 魔数  H 版本  I 宽  I 高  Q 随机种子  d 开始时间(Unix秒)
+#   记录    I 负载长度  B 类型  负载
+#     加入  I tick  H+utf8 玩家id  H+utf8 名字
+#     离开  I tick  H+utf8 玩家id
+#     tick  I tick(更新后)  H 输入数  每条输入 H 槽位 B 方向序号
+#     摘要  I tick  8s Game.state_hash()
+# 每条记录带长度前缀，可以用 mmap 顺序扫描；进程崩溃时最后一条不完整的记录被忽略。
+# 食物位置与出生位置都由种子决定，不需要记录。
+REPLAY_MAGIC = b"SNKR"
+REPLAY_VERSION = 2
+REPLAY_HEADER = struct.Struct("<4sHIIQd")
+REPLAY_RECORD = struct.Struct("<IB")
+REPLAY_JOIN = 1
+REPLAY_LEAVE = 2
+REPLAY_TICK = 3
+REPLAY_HASH = 4
+REPLAY_DIRECTIONS = list(DIRECTIONS.values())
+
+class ReplayHeader(NamedTuple):
+    width: int
+    height: int
+    seed: int
+    started: float
+
+class ReplayRecord(NamedTuple):
+    """一条录像记录；data 按类型为 (玩家id, 名字)、(玩家id,)、((槽位, 方向), ...) 或 (摘要,)"""
+    kind: int
+    tick: int
+    data: tuple
+
+def _pack_replay_str(value: str) -> bytes:
+    data = value.encode("utf-8")[:0xFFFF]
+    return struct.pack("<H", len(data)) + data
+
+def _unpack_replay_str(buffer, offset: int) -> Tuple[str, int]:
+    (length,) = struct.unpack_from("<H", buffer, offset)
+    offset += 2
+    return bytes(buffer[offset:offset + length]).decode("utf-8", "replace"), offset + length
+
+class ReplayRecorder:
+    """把一局游戏的加入、离开与每tick输入追加写入录像文件
+    
+    同一tick间隔内被接受的方向指令合并进该tick的记录；回放时先按顺序处理加入和离开，
+    再排入这些指令，然后 generate_food + update，与 TickScheduler 的顺序一致。
+    """
+    def __init__(self, path: str, game: Game):
+        self.path = path
+        self.file = open(path, "ab")
+        self.pending: List[Tuple[int, int]] = []  # 本tick间隔内接受的 (槽位, 方向序号)
+        if self.file.tell() == 0:
+            self.file.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, game.width, game.height,
+                                               game.seed, time.time()))
+            self.file.flush()  # 至少留下文件头，进程被杀时录像也能被识别
+    
+    @classmethod
+    def create(cls, directory: str, room_id: str, game: Game) -> "ReplayRecorder":
+        """在目录中为房间新建录像文件，房间号中的特殊字符替换为下划线"""
+        safe_id = re.sub(r"[^A-Za-z0-9_-]", "_", room_id)[:64]
+        name = f"{safe_id}-{time.strftime('%Y%m%d-%H%M%S')}-{game.seed % 10 ** 6:06d}.snkr"
+        return cls(os.path.join(directory, name), game)
+    
+    def _write(self, kind: int, payload: bytes):
+        self.file.write(REPLAY_RECORD.pack(len(payload), kind) + payload)
+    
+    def join(self, tick: int, player: Player):
+        self._write(REPLAY_JOIN, struct.pack("<I", tick) + _pack_replay_str(player.id) +
+                    _pack_replay_str(player.name))
+    
+    def leave(self, tick: int, player: Player):
+        # 离开前排入的指令随玩家一起作废，避免槽位被新玩家复用后误用
+        self.pending = [entry for entry in self.pending if entry[0] != player.slot]
+        self._write(REPLAY_LEAVE, struct.pack("<I", tick) + _pack_replay_str(player.id))
+    
+    def input(self, player: Player, direction: Tuple[int, int]):
+        self.pending.append((player.slot, REPLAY_DIRECTIONS.index(direction)))
+    
+    def tick(self, game: Game):
+        inputs = b"".join(struct.pack("<HB", slot, direction) for slot, direction in self.pending)
+        self._write(REPLAY_TICK, struct.pack("<IH", game.tick, len(self.pending)) + inputs)
+        self.pending = []
+        if game.tick % REPLAY_HASH_INTERVAL == 0:
+            self._write(REPLAY_HASH, struct.pack("<I", game.tick) + game.state_hash())
+            self.file.flush()
+    
+    def close(self):
+        self.file.close()
+
+def read_replay(path: str) -> Tuple[ReplayHeader, Iterator[ReplayRecord]]:
+    """读取录像文件头，并返回按顺序解析记录的迭代器"""
+    with open(path, "rb") as f:
+        # 空文件无法 mmap，过短的文件先在这里拒绝
+        if os.fstat(f.fileno()).st_size < REPLAY_HEADER.size:
+            raise ValueError(f"{path} 不是录像文件")
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, width, height, seed, started = REPLAY_HEADER.unpack_from(buffer, 0)
+    if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+        raise ValueError(f"{path} 不是录像文件或版本不支持")
+    
+    def records() -> Iterator[ReplayRecord]:
+        offset = REPLAY_HEADER.size
+        while offset + REPLAY_RECORD.size <= len(buffer):
+            length, kind = REPLAY_RECORD.unpack_from(buffer, offset)
+            start = offset + REPLAY_RECORD.size
+            if start + length > len(buffer):
+                break  # 最后一条记录不完整
+            offset = start + length
+            (tick,) = struct.unpack_from("<I", buffer, start)
+            if kind == REPLAY_JOIN:
+                player_id, cursor = _unpack_replay_str(buffer, start + 4)
+                name, _ = _unpack_replay_str(buffer, cursor)
+                yield ReplayRecord(kind, tick, (player_id, name))
+            elif kind == REPLAY_LEAVE:
+                yield ReplayRecord(kind, tick, (_unpack_replay_str(buffer, start + 4)[0],))
+            elif kind == REPLAY_TICK:
+                (count,) = struct.unpack_from("<H", buffer, start + 4)
+                yield ReplayRecord(kind, tick, tuple(
+                    struct.unpack_from("<HB", buffer, start + 6 + i * 3) for i in range(count)))
+            elif kind == REPLAY_HASH:
+                yield ReplayRecord(kind, tick, (bytes(buffer[start + 4:start + 12]),))
+            # 未知类型的记录按长度跳过
+    
+    return ReplayHeader(width, height, seed, started), records()
+
+class Replay:
+    """无界面回放：按录像重新模拟一局，并在摘要记录处校验状态"""
+    def __init__(self, path: str):
+        self.header, self.records = read_replay(path)
+        self.game = Game(self.header.width, self.header.height, seed=self.header.seed)
+        self.verified = 0  # 通过校验的摘要数
+        self.finished = False
+    
+    def step(self) -> Optional[ReplayRecord]:
+        """应用下一条记录，录像结束时返回 None；状态与录像不一致时抛出 ValueError"""
+        record = next(self.records, None)
+        if record is None:
+            self.finished = True
+            return None
+        game = self.game
+        if record.kind == REPLAY_JOIN:
+            game.add_player(record.data[0], record.data[1], None)
+        elif record.kind == REPLAY_LEAVE:
+            game.remove_player(record.data[0])
+        elif record.kind == REPLAY_TICK:
+            for slot, direction in record.data:
+                player = game.slots[slot] if slot < len(game.slots) else None
+                if player is not None:
+                    game.queue_input(player, REPLAY_DIRECTIONS[direction])
+            game.generate_food()
+            game.update()
+            if game.tick != record.tick:
+                raise ValueError(f"回放tick不一致: 录像 {record.tick}，回放 {game.tick}")
+        elif record.kind == REPLAY_HASH:
+            if game.state_hash() != record.data[0]:
+                raise ValueError(f"第 {record.tick} tick 的状态摘要与录像不一致")
+            self.verified += 1
+        return record
+    
+    def advance_tick(self) -> bool:
+        """应用记录直到完成下一个tick，录像结束时返回 False"""
+        while True:
+            record = self.step()
+            if record is None:
+                return False
+            if record.kind == REPLAY_TICK:
+                return True
+    
+    def fast_forward(self, until_tick: Optional[int] = None):
+        """全速回放到指定tick（默认到结尾）
+        
+        快进时不广播，每tick丢弃增量记录，内存不随对局长度增长；之后需要发送的是关键帧。
+        """
+        while until_tick is None or self.game.tick < until_tick:
+            more = self.advance_tick()
+            self.game.flush_delta()
+            if not more:
+                break
+
+# 二进制帧格式（小端）：
+#   帧头    B 类型(1=关键帧, 2=增量帧)  B 格子下标字节数(2或4)  I 序号  I tick（tick频率即速度）
+#   玩家    H 槽位  B+字节 id  B+字节 名字  3B 颜色RGB  i 分数  B 存活  I 身长  格子下标[身长]
+#   关键帧  H 宽  H 高  f 速度  H 玩家数  玩家[...]  H 食物数  格子下标[...]
+#   增量帧  H 离开数  H 槽位[...]  H 加入数  玩家[...]
+#           H 移动数  (H 槽位  H 新头数  格子下标[...]  H 移除尾数)[...]
+#           H 变化数  (H 槽位  i 分数  B 存活)[...]
+#           H 移除食物数  格子下标[...]  H 新增食物数  格子下标[...]  f 速度
+BIN_KEYFRAME = 1
+BIN_DELTA = 2
+
+def _pack_cells(snapshot: Snapshot, cells: Iterable[Tuple[int, int]]) -> bytes:
+    """把坐标序列打包为格子下标数组"""
+    width = snapshot.width
+    typecode = "H" if snapshot.width * snapshot.height <= 0x10000 else "I"
+    packed = array(typecode, [y * width + x for x, y in cells])
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+def _pack_str(value: str) -> bytes:
+    data = value.encode("utf-8")[:255]
+    return struct.pack("<B", len(data)) + data
+
+def _pack_player(snapshot: Snapshot, player: PlayerView) -> bytes:
+    return b"".join((
+        struct.pack("<H", player.slot),
+        _pack_str(player.id),
+        _pack_str(player.name),
+        bytes.fromhex(player.color[1:7]),
+        struct.pack("<iBI", player.score, player.alive, len(player.body)),
+        _pack_cells(snapshot, player.body)
+    ))
+
+def _binary_header(snapshot: Snapshot, frame_type: int, seq: int) -> bytes:
+    cell_bytes = 2 if snapshot.width * snapshot.height <= 0x10000 else 4
+    return struct.pack("<BBII", frame_type, cell_bytes, seq, snapshot.tick)
+
+def encode_keyframe_binary(snapshot: Snapshot, seq: int) -> bytes:
+    """关键帧的二进制编码"""
+    parts = [
+        _binary_header(snapshot, BIN_KEYFRAME, seq),
+        struct.pack("<HHfH", snapshot.width, snapshot.height, snapshot.speed, len(snapshot.players))
+    ]
+    parts.extend(_pack_player(snapshot, player) for player in snapshot.players)
+    parts.append(struct.pack("<H", len(snapshot.foods)))
+    parts.append(_pack_cells(snapshot, ((food.x, food.y) for food in snapshot.foods)))
+    return b"".join(parts)
+
+def encode_delta_binary(snapshot: Snapshot, delta: FrameDelta) -> bytes:
+    """增量帧的二进制编码"""
+    parts = [_binary_header(snapshot, BIN_DELTA, delta.seq)]
+    
+    parts.append(struct.pack("<H", len(delta.left)))
+    parts.extend(struct.pack("<H", slot) for _, slot in delta.left)
+    
+    parts.append(struct.pack("<H", len(delta.joined)))
+    parts.extend(_pack_player(snapshot, player) for player in delta.joined)
+    
+    parts.append(struct.pack("<H", len(delta.moves)))
+    for player, heads, tails in delta.moves:
+        parts.append(struct.pack("<HH", player.slot, len(heads)))
+        parts.append(_pack_cells(snapshot, heads))
+        parts.append(struct.pack("<H", tails))
+    
+    parts.append(struct.pack("<H", len(delta.changed)))
+    parts.extend(struct.pack("<HiB", player.slot, player.score, player.alive)
+                 for player in delta.changed)
+    
+    parts.append(struct.pack("<H", len(delta.foods_removed)))
+    parts.append(_pack_cells(snapshot, ((food.x, food.y) for food in delta.foods_removed)))
+    parts.append(struct.pack("<H", len(delta.foods_added)))
+    parts.append(_pack_cells(snapshot, ((food.x, food.y) for food in delta.foods_added)))
+    parts.append(struct.pack("<f", snapshot.speed))
+    return b"".join(parts)
+
+def encode_frame(kind: str, snapshot: Snapshot, delta: Optional[FrameDelta] = None) -> bytes:
+    """按帧类型编码；只读取快照与只读增量，可在任意线程或进程中调用"""
+    if kind == "players":
+        return json.dumps([
+            {"id": p.id, "name": p.name, "score": p.score, "alive": p.alive}
+            for p in snapshot.players
+        ]).encode("utf-8")
+    if kind == "game_delta":
+        return json.dumps({
+            "type": "game_delta",
+            "seq": delta.seq,
+            "tick": snapshot.tick,
+            "tick_rate": snapshot.speed,
+            "data": Game.delta_state(delta, snapshot)
+        }).encode("utf-8")
+    if kind == "game_state":
+        return json.dumps({
+            "type": "game_state",
+            "seq": delta.seq,
+            "tick": snapshot.tick,
+            "tick_rate": snapshot.speed,
+            "data": Game.snapshot_state(snapshot)
+        }).encode("utf-8")
+    if kind == "game_delta_bin":
+        return encode_delta_binary(snapshot, delta)
+    if kind == "game_state_bin":
+        return encode_keyframe_binary(snapshot, delta.seq)
+    raise ValueError(f"未知的帧类型: {kind}")
+
+class FrameJob(NamedTuple):
+    """一个待编码的帧"""
+    kind: str
+    snapshot: Snapshot
+    delta: FrameDelta
+
+def encode_jobs(jobs: Dict[str, FrameJob]) -> Dict[str, bytes]:
+    """一次编码一批帧，提交到编码池时共用的快照只需传递一次"""
+    return {key: encode_frame(*job) for key, job in jobs.items()}
+
+def format_metric_value(value: float) -> str:
+    return repr(float(value))
+
+class Counter:
+    """只增计数器，可按一个标签区分"""
+    def __init__(self, name: str, help: str, label: Optional[str] = None):
+        self.name = name
+        self.help = help
+        self.label = label
+        # 无标签的计数器从0开始导出
+        self.values: Dict[str, float] = {} if label else {"": 0.0}
+    
+    def inc(self, key: str = "", amount: float = 1.0):
+        self.values[key] = self.values.get(key, 0.0) + amount
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.values.items()):
+            labels = f'{{{self.label}="{key}"}}' if self.label else ""
+            lines.append(f"{self.name}{labels} {format_metric_value(value)}")
+        return lines
+
+class Gauge:
+    """瞬时值，抓取时调用 func 计算"""
+    def __init__(self, name: str, help: str, func):
+        self.name = name
+        self.help = help
+        self.func = func
+    
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge",
+                f"{self.name} {format_metric_value(self.func())}"]
+
+class Histogram:
+    """固定分桶的直方图，observe 只做一次二分查找和两次加法"""
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = METRICS_TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个为 +Inf
+        self.sum = 0.0
+    
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            le = "+Inf" if bound == float("inf") else format_metric_value(bound)
+            lines.append(f'{self.name}_bucket{{le="{le}"}} {total}')
+        lines.append(f"{self.name}_sum {format_metric_value(self.sum)}")
+        lines.append(f"{self.name}_count {total}")
+        return lines
+
+class Metrics:
+    """进程内的监控指标，/metrics 以 Prometheus 文本格式导出；记录开销为常数时间，可常开"""
+    
+    # 客户端消息类型，其他取值归为 other，避免标签无限增长
+    MESSAGE_TYPES = ("join", "change_direction", "resync", "chat", "ping")
+    
+    def __init__(self):
+        self.tick_seconds = Histogram("snake_tick_duration_seconds", "单个tick的模拟耗时")
+        self.encode_seconds = Histogram("snake_encode_duration_seconds", "一次广播从开始到编码完成的耗时")
+        self.fanout_seconds = Histogram("snake_broadcast_fanout_seconds", "把编码好的帧排入所有连接发送队列的耗时")
+        self.loop_lag_seconds = Histogram("snake_event_loop_lag_seconds", "事件循环延迟：定时唤醒比预期晚的时间")
+        self.frame_bytes = Counter("snake_frame_bytes_total", "排入发送队列的状态帧字节数", "type")
+        self.messages_in = Counter("snake_messages_in_total", "收到的客户端消息数", "type")
+        self.messages_out = Counter("snake_messages_out_total", "排入发送队列的消息数", "type")
+        self.messages_dropped = Counter("snake_messages_dropped_total", "被丢弃的消息数", "reason")
+        self.tick_overruns = Counter("snake_tick_overruns_total", "需要补跑tick的调度次数")
+        self.loop_errors = Counter("snake_game_loop_errors_total", "游戏循环中捕获的异常数")
+        self.gauges: List[Gauge] = []
+    
+    def message_in(self, kind):
+        self.messages_in.inc(kind if kind in self.MESSAGE_TYPES else "other")
+    
+    def render(self) -> str:
+        families = [self.tick_seconds, self.encode_seconds, self.fanout_seconds, self.loop_lag_seconds,
+                    self.frame_bytes, self.messages_in, self.messages_out, self.messages_dropped,
+                    self.tick_overruns, self.loop_errors, *self.gauges]
+        return "\n".join(line for family in families for line in family.render()) + "\n"
+
+def merge_metrics(sources: List[Tuple[str, str]]) -> str:
+    """合并多个进程的指标文本，每个样本加上 worker 标签，同名指标的样本放在一起"""
+    headers: Dict[str, List[str]] = {}
+    samples: Dict[str, List[str]] = {}
+    for worker, text in sources:
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# HELP "):
+                family = line.split(" ", 3)[2]
+                headers.setdefault(family, [])
+                samples.setdefault(family, [])
+            if line.startswith("#"):
+                if len(headers[family]) < 2:
+                    headers[family].append(line)
+                continue
+            if not line or family is None:
+                continue
+            name, _, rest = line.partition(" ")
+            if "{" in name:
+                name = name.replace("{", f'{{worker="{worker}",', 1)
+            else:
+                name = f'{name}{{worker="{worker}"}}'
+            samples[family].append(f"{name} {rest}")
+    return "\n".join(line for family in headers
+                     for line in headers[family] + samples[family]) + "\n"
+
+async def monitor_loop_lag():
+    """定期休眠固定时长，实际唤醒时间与预期之差即事件循环延迟"""
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        metrics.loop_lag_seconds.observe(max(0.0, time.monotonic() - start - LOOP_LAG_INTERVAL))
+
+# 全局监控指标
+metrics = Metrics()
+METRICS_HEADERS = {"Content-Type": "text/plain; version=0.0.4; charset=utf-8", "Cache-Control": "no-cache"}
+
+class SamplingProfiler:
+    """采样分析器：后台线程定期读取各线程的调用栈，输出 flamegraph 可用的折叠栈"""
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.running = False
+    
+    def _sample(self, seconds: float) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        sampler = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == sampler:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                # 线程名作为根帧，事件循环线程与编码线程分开显示
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                counts[key] = counts.get(key, 0) + 1
+            time.sleep(self.interval)
+        return counts
+    
+    async def profile(self, seconds: float) -> str:
+        """采样 seconds 秒，返回折叠栈文本，每行为“根;...;叶 次数”"""
+        self.running = True
+        try:
+            counts = await asyncio.get_running_loop().run_in_executor(None, self._sample, seconds)
+        finally:
+            self.running = False
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items()))
+
+class Span:
+    """一段追踪区间，退出时写入追踪器"""
+    __slots__ = ("tracer", "name", "track", "start")
+    
+    def __init__(self, tracer: "Tracer", name: str, track: str):
+        self.tracer = tracer
+        self.name = name
+        self.track = track
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.track, self.start, time.perf_counter())
+
+class Tracer:
+    """tick分段追踪：开启期间把各阶段耗时写入环形缓冲区，可导出为 Chrome trace JSON
+    
+    关闭时 span() 返回共享的空上下文，开销只有一次时间比较。
+    """
+    NULL_SPAN = contextlib.nullcontext()
+    
+    def __init__(self, size: int = TRACE_BUFFER_SIZE):
+        self.events: deque = deque(maxlen=size)  # (阶段, 轨道, 开始, 结束)，时间为 perf_counter 秒
+        self.enabled_until = 0.0
+    
+    @property
+    def enabled(self) -> bool:
+        return time.monotonic() < self.enabled_until
+    
+    def enable(self, seconds: float):
+        self.enabled_until = max(self.enabled_until, time.monotonic() + seconds)
+    
+    def span(self, name: str, track: str):
+        if not self.enabled:
+            return self.NULL_SPAN
+        return Span(self, name, track)
+    
+    def record(self, name: str, track: str, start: float, end: float):
+        self.events.append((name, track, start, end))
+    
+    def chrome_trace(self) -> dict:
+        """Chrome trace 格式（chrome://tracing、Perfetto 可直接打开），每个房间一条轨道"""
+        pid = os.getpid()
+        tids: Dict[str, int] = {}
+        events = []
+        for name, track, start, end in list(self.events):
+            if track not in tids:
+                tids[track] = len(tids) + 1
+                events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tids[track],
+                               "args": {"name": track}})
+            events.append({"name": name, "ph": "X", "pid": pid, "tid": tids[track],
+                           "ts": round(start * 1e6, 1), "dur": round((end - start) * 1e6, 1)})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+# 全局分析器与追踪器
+profiler = SamplingProfiler()
+tracer = Tracer()
+
+class TickScheduler:
+    """固定步长调度器：累加器驱动模拟，落后时补跑tick，并统计抖动与超时"""
+    def __init__(self, game: Game, max_catchup: int = MAX_CATCHUP_TICKS, track: str = ""):
+        self.game = game
+        self.track = track  # tick追踪中的轨道名
+        self.max_catchup = max_catchup
+        self.accumulator = 0.0
+        self.last_time: Optional[float] = None
+        self.ticks = 0
+        self.overruns = 0  # 需要补跑tick的次数
+        self.dropped_ticks = 0  # 超过补跑上限被丢弃的tick数
+        self.jitter: deque = deque(maxlen=1000)  # 每个tick相对截止时间的延迟（秒）
+        self.tick_time: deque = deque(maxlen=1000)  # 每个tick的模拟耗时（秒）
+    
+    @property
+    def interval(self) -> float:
+        return 1.0 / self.game.speed
+    
+    def advance(self, now: float) -> int:
+        """运行所有到期的tick，返回本次运行的tick数"""
+        if self.last_time is None:
+            self.last_time = now
+        self.accumulator += now - self.last_time
+        self.last_time = now
+        
+        steps = 0
+        while self.accumulator >= self.interval:
+            if steps == self.max_catchup:
+                # 落后太多，丢弃积压，避免越追越慢
+                self.dropped_ticks += int(self.accumulator / self.interval)
+                self.accumulator = 0.0
+                break
+            self.jitter.append(self.accumulator - self.interval)
+            self.accumulator -= self.interval
+            start = time.perf_counter()
+            with tracer.span("tick", self.track):
+                with tracer.span("generate_food", self.track):
+                    self.game.generate_food()
+                with tracer.span("update", self.track):
+                    self.game.update()
+            elapsed = time.perf_counter() - start
+            self.tick_time.append(elapsed)
+            metrics.tick_seconds.observe(elapsed)
+            steps += 1
+        
+        self.ticks += steps
+        if steps > 1:
+            self.overruns += 1
+            metrics.tick_overruns.inc()
+        return steps
+    
+    def next_deadline(self) -> float:
+        """下一个tick的截止时间"""
+        return self.last_time + max(0.0, self.interval - self.accumulator)
+    
+    def stats(self) -> dict:
+        """调度统计"""
+        jitter = list(self.jitter)
+        tick_time = list(self.tick_time)
+        return {
+            "ticks": self.ticks,
+            "tick_rate": self.game.speed,
+            "overruns": self.overruns,
+            "dropped_ticks": self.dropped_ticks,
+            "jitter_avg_ms": sum(jitter) / len(jitter) * 1000 if jitter else 0.0,
+            "jitter_max_ms": max(jitter) * 1000 if jitter else 0.0,
+            "tick_avg_ms": sum(tick_time) / len(tick_time) * 1000 if tick_time else 0.0,
+            "tick_max_ms": max(tick_time) * 1000 if tick_time else 0.0
+        }
+
+async def send_frame(ws, frame: bytes, binary: bool = False):
+    """发送已编码的帧，避免每个接收者重复编码"""
+    opcode = web.WSMsgType.BINARY if binary else web.WSMsgType.TEXT
+    await ws.send_frame(frame, opcode)
+
+class TokenBucket:
+    """令牌桶限流：每秒补充 rate 个令牌，最多积累 burst 个"""
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.dropped = 0
+    
+    def allow(self) -> bool:
+        """取一个令牌，没有令牌时记为丢弃"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.dropped += 1
+        return False
+
+class Outbox:
+    """连接的发送队列：由独立的写任务发送，状态帧只保留最新一帧，积压过久的慢客户端会被断开
+    
+    队列长度只限制内存：其他玩家的聊天刷屏会让队列暂时变满，这时丢弃最旧的聊天或 pong，
+    是否断开只看积压时长（SLOW_CLIENT_TIMEOUT）。
+    """
+    def __init__(self, ws):
+        self.ws = ws
+        self.messages: deque = deque()  # 待发送的非状态消息 (帧, 是否二进制, 类型)
+        self.state: Optional[Tuple[bytes, bool]] = None  # 待发送的状态帧
+        self.pending_since: Optional[float] = None  # 队列从空变为非空的时间
+        self.dropped = 0  # 被丢弃的过期状态帧数
+        self.batch = False  # 客户端支持时把同一批待发送的文本消息合并成一帧
+        self.batched = 0  # 被合并进其他帧的消息数
+        self.closed = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+    
+    @property
+    def depth(self) -> int:
+        return len(self.messages) + (self.state is not None)
+    
+    @property
+    def state_pending(self) -> bool:
+        return self.state is not None
+    
+    @property
+    def lagging(self) -> bool:
+        """发送积压是否已超过阈值"""
+        return (self.pending_since is not None
+                and time.monotonic() - self.pending_since > SLOW_CLIENT_TIMEOUT)
+    
+    def _queued(self):
+        if self.pending_since is None:
+            self.pending_since = time.monotonic()
+        self._wakeup.set()
+    
+    def send(self, frame: bytes, binary: bool = False, kind: str = "other"):
+        """排队一条非状态消息；kind 为监控指标中的消息类型，OUTBOX_DROPPABLE 中的类型在队列满时可以丢弃"""
+        if self.closed:
+            return
+        if len(self.messages) >= OUTBOX_SIZE and not self._drop_oldest():
+            if kind in OUTBOX_DROPPABLE:
+                metrics.messages_dropped.inc("outbox_full")
+                return
+            # 队列里都是欢迎之类不能丢的消息时照常排队，这类消息每个连接只有几条
+        self.messages.append((frame, binary, kind))
+        metrics.messages_out.inc(kind)
+        self._queued()
+    
+    def _drop_oldest(self) -> bool:
+        """丢弃队列中最旧的一条可丢弃消息，没有可丢弃的消息时返回 False"""
+        for index, (_, _, kind) in enumerate(self.messages):
+            if kind in OUTBOX_DROPPABLE:
+                del self.messages[index]
+                metrics.messages_dropped.inc("outbox_full")
+                return True
+        return False
+    
+    def send_state(self, frame: bytes, binary: bool = False):
+        """排队状态帧，覆盖尚未发出的旧状态帧"""
+        if self.closed:
+            return
+        if self.state is not None:
+            self.dropped += 1
+            metrics.messages_dropped.inc("superseded")
+        self.state = (frame, binary)
+        self._queued()
+    
+    async def _run(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self.messages or self.state:
+                    frame, binary = self._next_frame()
+                    await send_frame(self.ws, frame, binary)
+                self.pending_since = None
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            self.evict("发送失败")
+    
+    def _next_frame(self) -> Tuple[bytes, bool]:
+        """取出下一帧；开启合并时，连续的文本消息（含状态帧）合并为一个JSON数组"""
+        if self.messages:
+            frame, binary, _ = self.messages.popleft()
+        else:
+            (frame, binary), self.state = self.state, None
+            return frame, binary
+        if not self.batch or binary:
+            return frame, binary
+        
+        batch = [frame]
+        while self.messages and not self.messages[0][1]:
+            batch.append(self.messages.popleft()[0])
+        if not self.messages and self.state is not None and not self.state[1]:
+            batch.append(self.state[0])
+            self.state = None
+        if len(batch) == 1:
+            return frame, False
+        self.batched += len(batch) - 1
+        return b"[" + b",".join(batch) + b"]", False
+    
+    def evict(self, reason: str):
+        """断开慢客户端"""
+        if self.closed:
+            return
+        print(f"断开客户端: {reason}")
+        metrics.messages_dropped.inc("evicted", self.depth)
+        self.close()
+        asyncio.ensure_future(self.ws.close())
+    
+    def close(self):
+        """停止写任务"""
+        self.closed = True
+        self.messages.clear()
+        self.state = None
+        self._task.cancel()
+
+def plan_broadcast(game: Game, sent_version: int
+                   ) -> Tuple[int, List[Tuple[Outbox, str, bool]], Dict[str, FrameJob]]:
+    """决定本次广播每个连接发送的帧
+    
+    返回已广播的版本号、(发送队列, 帧键, 是否二进制) 列表和帧键到待编码帧的映射。
+    场地不超过视野时同类帧所有连接共享，否则每个连接按视野裁剪各自编码。
+    """
+    # 新加入、请求重新同步的玩家以及周期性关键帧发送完整状态
+    advanced = game.version != sent_version
+    if advanced:
+        sent_version = game.version
+    snapshot = game.snapshot()
+    delta = game.flush_frames()
+    periodic_keyframe = advanced and game.seq % KEYFRAME_INTERVAL == 0
+    views = None
+    
+    sends = []
+    jobs: Dict[str, FrameJob] = {}
+    for player in list(game.players.values()):
+        outbox = player.outbox
+        if outbox is None or outbox.closed:
+            continue
+        if outbox.lagging:
+            outbox.evict(f"玩家 {player.name} 发送积压超过 {SLOW_CLIENT_TIMEOUT} 秒")
+            continue
+        
+        if advanced and outbox.state_pending:
+            # 上一帧还没发出：丢弃它，直接用关键帧追上最新状态
+            player.needs_keyframe = True
+        
+        keyframe = player.needs_keyframe or periodic_keyframe
+        if keyframe:
+            player.needs_keyframe = False
+            kind = "game_state"
+        elif advanced:
+            kind = "game_delta"
+        else:
+            continue
+        if player.proto == "bin":
+            kind += "_bin"
+        
+        if game.spatial is None:
+            # 同一帧的编码结果按协议共享
+            key = kind
+            if key not in jobs:
+                jobs[key] = FrameJob(kind, snapshot, delta)
+        else:
+            if views is None:
+                views = {view.slot: view for view in snapshot.players}
+            key = f"{kind}:{player.id}"
+            jobs[key] = FrameJob(kind, *game.interest_frame(player, snapshot, delta, keyframe, views))
+        sends.append((outbox, key, kind.endswith("_bin")))
+    return sent_version, sends, jobs
+
+def deliver_frames(sends: List[Tuple[Outbox, str, bool]], frames: Dict[str, bytes]):
+    """把编码好的帧排入各连接的发送队列"""
+    start = time.perf_counter()
+    for outbox, key, binary in sends:
+        if not outbox.closed:
+            frame = frames[key]
+            outbox.send_state(frame, binary=binary)
+            # 按视野裁剪的帧键带有玩家id，统计时只取帧类型
+            kind = key.partition(":")[0]
+            metrics.messages_out.inc(kind)
+            metrics.frame_bytes.inc(kind, len(frame))
+    metrics.fanout_seconds.observe(time.perf_counter() - start)
+
+def create_encode_executor(workers: int, pool: str = "thread") -> Optional[Executor]:
+    """创建帧编码池；workers 为 0 时在事件循环中编码"""
+    if workers <= 0:
+        return None
+    if pool == "process":
+        executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+        # 预先启动子进程，避免第一批编码等待进程启动
+        for _ in range(workers):
+            executor.submit(int)
+        return executor
+    return ThreadPoolExecutor(workers, thread_name_prefix="encode")
+
+class FrameEncoder:
+    """房间的帧编码阶段：把快照编码为帧
+    
+    配置了编码池时异步编码，与下一tick的模拟流水线并行；同一房间同时只有一批在编码，
+    上一批未完成时跳过本次广播，变化继续累积到下一批增量中。
+    """
+    def __init__(self, executor: Optional[Executor] = None, track: str = ""):
+        self.executor = executor
+        self.track = track  # tick追踪中的轨道名
+        self.sent_version = -1
+        self.task: Optional[asyncio.Task] = None
+        self.latency: deque = deque(maxlen=1000)  # 从提交到编码完成的耗时（秒）
+        self.skipped = 0  # 因上一批未编码完成而跳过的广播次数
+    
+    def broadcast(self, game: Game):
+        """广播当前状态"""
+        if self.task is not None and not self.task.done():
+            self.skipped += 1
+            return
         
-        foods_data = [{"x": food.x, "y": food.y, "id": food.id} for food in self.foods]
+        start = time.perf_counter()
+        with tracer.span("get_state", self.track):
+            self.sent_version, sends, jobs = plan_broadcast(game, self.sent_version)
+        if not sends:
+            return
+        if self.executor is None:
+            # 在事件循环中编码，共享帧复用游戏按版本缓存的编码结果
+            with tracer.span("dumps", self.track):
+                frames = {key: game.encoded(key) if key == job.kind else encode_frame(*job)
+                          for key, job in jobs.items()}
+            self.latency.append(time.perf_counter() - start)
+            metrics.encode_seconds.observe(self.latency[-1])
+            with tracer.span("send", self.track):
+                deliver_frames(sends, frames)
+            return
         
+        self.task = asyncio.create_task(self._encode(sends, jobs, start))
+    
+    async def _encode(self, sends, jobs: Dict[str, FrameJob], start: float):
+        submitted = time.perf_counter()
+        try:
+            frames = await asyncio.get_running_loop().run_in_executor(
+                self.executor, encode_jobs, jobs)
+        except Exception as e:
+            print(f"Encode error: {e}")
+            return
+        self.latency.append(time.perf_counter() - start)
+        metrics.encode_seconds.observe(self.latency[-1])
+        if tracer.enabled:
+            # 编码在池中进行，记录的是从提交到结果返回事件循环的区间
+            tracer.record("dumps", self.track, submitted, time.perf_counter())
+        with tracer.span("send", self.track):
+            deliver_frames(sends, frames)
+    
+    def stats(self) -> dict:
+        """编码统计"""
+        latency = list(self.latency)
         return {
-            "players": players_data,
-            "foods": foods_data,
-            "grid_width": GRID_WIDTH,
-            "grid_height": GRID_HEIGHT,
-            "speed": self.speed
+            "pool": type(self.executor).__name__ if self.executor else "inline",
+            "encode_avg_ms": sum(latency) / len(latency) * 1000 if latency else 0.0,
+            "encode_max_ms": max(latency) * 1000 if latency else 0.0,
+            "skipped": self.skipped
         }
 
-# 全局游戏实例
-game = Game()
+class Room:
+    """房间：独立的游戏实例和游戏循环"""
+    def __init__(self, room_id: str, executor: Optional[Executor] = None,
+                 arena: Tuple[int, int] = (GRID_WIDTH, GRID_HEIGHT), max_players: int = MAX_PLAYERS):
+        self.id = room_id
+        self.game = Game(*arena)
+        self.max_players = max_players
+        self.scheduler = TickScheduler(self.game, track=f"房间 {room_id}")
+        self.encoder = FrameEncoder(executor, track=f"房间 {room_id}")
+        self.task: Optional[asyncio.Task] = None
+        self.empty_since: Optional[float] = time.monotonic()
+    
+    @property
+    def full(self) -> bool:
+        return len(self.game.players) >= self.max_players
+    
+    def stats(self) -> dict:
+        """房间统计（不含玩家列表），读取最近发布的快照"""
+        snapshot = self.game.snapshot()
+        return {
+            "id": self.id,
+            "player_count": len(snapshot.players),
+            "speed": snapshot.speed,
+            "scheduler": self.scheduler.stats(),
+            "encoder": self.encoder.stats()
+        }
+
+class RoomManager:
+    """房间管理：按需创建房间、匹配有空位的房间、回收空闲房间"""
+    def __init__(self, id_prefix: str = ""):
+        self.rooms: Dict[str, Room] = {}
+        self.id_prefix = id_prefix  # 多进程模式下用于把房间号映射回所属工作进程
+        self.executor: Optional[Executor] = None  # 各房间共用的帧编码池，见 create_encode_executor
+        self.arena = (GRID_WIDTH, GRID_HEIGHT)  # 新房间的场地大小（格子数）
+        self.max_players = MAX_PLAYERS  # 每个房间的人数上限，大场地可以调高
+        self.ws_compress = WS_COMPRESS  # 是否与客户端协商 permessage-deflate
+        self.record_dir: Optional[str] = None  # 录像目录，None 表示不录像
+        self.replay_streams = 0  # 正在进行的观战回放数
+        self._next_id = 1
+    
+    def _create(self, room_id: str) -> Room:
+        """构造新房间，此时尚未登记也没有游戏循环，玩家加入成功后由 open() 启动"""
+        if len(self.rooms) >= MAX_ROOMS:
+            raise ValueError(f"服务器房间数已达上限（{MAX_ROOMS}），请稍后再试")
+        return Room(room_id, self.executor, self.arena, self.max_players)
+    
+    def open(self, room: Room):
+        """登记新房间、开始录像并启动游戏循环，已登记的房间不做任何事
+        
+        开始录像前已加入的玩家补记为加入，回放时按相同顺序从种子重新生成出生位置。
+        """
+        if self.rooms.get(room.id) is room:
+            return
+        if self.record_dir is not None:
+            room.game.recorder = ReplayRecorder.create(self.record_dir, room.id, room.game)
+            for player in room.game.players.values():
+                room.game.recorder.join(room.game.tick, player)
+        self.rooms[room.id] = room
+        room.task = asyncio.create_task(game_loop(self, room))
+        print(f"房间 {room.id} 已创建")
+    
+    def get_or_create(self, room_id: str) -> Room:
+        """按房间号获取房间，不存在则构造新房间（见 _create）；房间号不合法时抛出 ValueError"""
+        if not ROOM_ID_PATTERN.fullmatch(room_id):
+            raise ValueError("房间号只能包含字母、数字、下划线和连字符，最长32个字符")
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = self._create(room_id)
+        return room
+    
+    def find_room(self) -> Room:
+        """匹配一个有空位的房间，优先人多的房间；都已满时构造新房间（见 _create）"""
+        candidates = [room for room in self.rooms.values() if not room.full]
+        if candidates:
+            return max(candidates, key=lambda room: len(room.game.players))
+        
+        while f"{self.id_prefix}{self._next_id}" in self.rooms:
+            self._next_id += 1
+        room_id = f"{self.id_prefix}{self._next_id}"
+        self._next_id += 1
+        return self._create(room_id)
+    
+    def close(self, room: Room):
+        """移除房间"""
+        if self.rooms.get(room.id) is room:
+            del self.rooms[room.id]
+            if room.game.recorder is not None:
+                room.game.recorder.close()
+                print(f"房间 {room.id} 录像已保存: {room.game.recorder.path}")
+            print(f"房间 {room.id} 空闲已回收")
+    
+    async def close_connections(self, app):
+        """服务器关闭时断开各房间的客户端，使连接处理及时结束，注册在 app.on_shutdown 中"""
+        await asyncio.gather(*(player.ws.close(code=aiohttp.WSCloseCode.GOING_AWAY,
+                                               message="服务器关闭".encode("utf-8"))
+                               for room in self.rooms.values()
+                               for player in room.game.players.values() if player.ws is not None))
+    
+    async def close_recorders(self, app):
+        """服务器关闭时保存各房间的录像，注册在 app.on_cleanup 中"""
+        for room in self.rooms.values():
+            recorder = room.game.recorder
+            if recorder is not None:
+                room.game.recorder = None
+                recorder.close()
+                print(f"房间 {room.id} 录像已保存: {recorder.path}")
+    
+    def queue_depths(self) -> List[int]:
+        """各连接发送队列的当前长度"""
+        return [player.outbox.depth for room in self.rooms.values()
+                for player in room.game.players.values() if player.outbox is not None]
+    
+    def health(self) -> dict:
+        """健康检查数据；open_slots 为未满房间的空位总数，多进程模式下主进程据此分配玩家"""
+        return {
+            "status": "ok",
+            "pid": os.getpid(),
+            "room_count": len(self.rooms),
+            "player_count": sum(len(room.game.players) for room in self.rooms.values()),
+            "open_slots": sum(room.max_players - len(room.game.players)
+                              for room in self.rooms.values() if not room.full)
+        }
+    
+    def players_json(self) -> bytes:
+        """各房间统计与玩家列表，玩家列表复用每个房间按版本缓存的编码"""
+        parts = []
+        for room in list(self.rooms.values()):
+            meta = json.dumps(room.stats()).encode("utf-8")
+            parts.append(meta[:-1] + b', "players": ' + room.game.encoded("players") + b'}')
+        
+        player_count = sum(len(room.game.players) for room in self.rooms.values())
+        header = json.dumps({"room_count": len(self.rooms), "player_count": player_count})
+        return header[:-1].encode("utf-8") + b', "rooms": [' + b', '.join(parts) + b']}'
 
-async def game_loop():
-    """游戏主循环"""
+async def game_loop(rooms: RoomManager, room: Room):
+    """房间游戏循环：按截止时间休眠，模拟与广播各自按自己的频率运行"""
+    game = room.game
+    scheduler = room.scheduler
+    send_interval = 1.0 / SEND_RATE
+    next_send = next_stats = time.monotonic()
     while True:
         try:
-            # 生成食物
-            game.generate_food()
+            now = time.monotonic()
             
-            # 更新游戏状态
-            game.update()
+            # 房间空闲超时后回收
+            if game.players:
+                room.empty_since = None
+            elif room.empty_since is None:
+                room.empty_since = now
+            elif now - room.empty_since > ROOM_IDLE_TIMEOUT:
+                rooms.close(room)
+                return
             
-            # 广播游戏状态给所有连接的客户端
-            state = game.get_state()
-            state_json = json.dumps({
-                "type": "game_state",
-                "data": state
-            })
-            
-            # 发送给所有连接的玩家
-            tasks = []
-            for player in list(game.players.values()):
-                if player.ws and not player.ws.closed:
-                    try:
-                        tasks.append(player.ws.send(state_json))
-                    except:
-                        pass
-            
-            if tasks:
-                await asyncio.gather(*tasks, return_exceptions=True)
+            scheduler.advance(now)
             
-            # 清理死亡玩家
-            dead_players = []
-            for player_id, player in list(game.players.items()):
-                if not player.alive and player.ws and player.ws.closed:
-                    dead_players.append(player_id)
+            if now >= next_send:
+                room.encoder.broadcast(game)
+                
+                # 清理死亡玩家
+                dead_players = []
+                for player_id, player in list(game.players.items()):
+                    if not player.alive and player.ws and player.ws.closed:
+                        dead_players.append(player_id)
+                
+                for player_id in dead_players:
+                    game.remove_player(player_id)
+                
+                next_send += send_interval
+                if next_send < now:
+                    next_send = now + send_interval
             
-            for player_id in dead_players:
-                game.remove_player(player_id)
+            if now >= next_stats:
+                next_stats = now + STATS_INTERVAL
+                if scheduler.ticks:
+                    print(f"房间 {room.id} 调度统计: {scheduler.stats()} 编码统计: {room.encoder.stats()}")
             
-            await asyncio.sleep(0.05)  # 控制游戏循环频率
+            # 休眠到下一个tick或下一次广播的截止时间
+            deadline = min(scheduler.next_deadline(), next_send)
+            await asyncio.sleep(max(0.0, deadline - time.monotonic()))
             
         except Exception as e:
             print(f"Game loop error: {e}")
+            metrics.loop_errors.inc()
             await asyncio.sleep(1)
 
+# 全局房间管理器
+rooms = RoomManager()
+metrics.gauges += [
+    Gauge("snake_rooms", "房间数", lambda: len(rooms.rooms)),
+    Gauge("snake_players", "在线玩家数", lambda: sum(len(room.game.players) for room in rooms.rooms.values())),
+    Gauge("snake_send_queue_depth_max", "单个连接发送队列的最大长度", lambda: max(rooms.queue_depths(), default=0)),
+    Gauge("snake_send_queue_depth_total", "所有连接发送队列的总长度", lambda: sum(rooms.queue_depths())),
+]
+
 async def handle_websocket(request):
-    """处理WebSocket连接"""
-    ws = web.WebSocketResponse()
+    """处理WebSocket连接，/ws?room=房间号 加入指定房间，否则自动匹配"""
+    ws = web.WebSocketResponse(max_msg_size=MAX_MESSAGE_SIZE, compress=rooms.ws_compress)
     await ws.prepare(request)
+    outbox = Outbox(ws)
+    limiter = TokenBucket(INPUT_RATE, INPUT_BURST)
     
+    room: Optional[Room] = None
+    player: Optional[Player] = None
     player_id = None
     player_name = f"Player{random.randint(1000, 9999)}"
     
     try:
         async for msg in ws:
             if msg.type == web.WSMsgType.TEXT:
+                # 先限流再解析，刷屏的消息不会进入 json.loads
+                if not limiter.allow():
+                    metrics.messages_dropped.inc("rate_limit")
+                    if limiter.dropped == 1:
+                        print(f"玩家 {player_name} 发送过快，开始丢弃消息")
+                    continue
                 data = json.loads(msg.data)
+                metrics.message_in(data.get("type"))
                 
                 if data["type"] == "join":
+                    if room is not None:
+                        continue
+                    
                     # 玩家加入游戏
                     player_id = data.get("player_id", str(uuid.uuid4()))
                     player_name = data.get("name", player_name)
                     
-                    # 检查玩家数量
-                    if len(game.players) >= MAX_PLAYERS:
-                        await ws.send(json.dumps({
-                            "type": "error",
-                            "message": "游戏已满，最多10人"
-                        }))
+                    # 指定房间时检查玩家数量，否则匹配有空位的房间；新房间在加入成功后才启动
+                    try:
+                        room_id = request.query.get("room")
+                        if room_id:
+                            target = rooms.get_or_create(room_id)
+                            if target.full and player_id not in target.game.players:
+                                raise ValueError(f"房间已满，每个房间最多{target.max_players}人")
+                        else:
+                            target = rooms.find_room()
+                    except ValueError as e:
+                        await ws.send_str(json.dumps({"type": "error", "message": str(e)}))
                         await ws.close()
-                        return
+                        return ws
+                    
+                    # 同一玩家（例如共用 localStorage 的另一个标签页）重复加入时，新连接取代旧连接
+                    existing = target.game.players.get(player_id)
+                    if existing is not None and existing.ws is not None:
+                        if existing.outbox is not None:
+                            existing.outbox.close()
+                        asyncio.ensure_future(existing.ws.close(
+                            code=WS_CLOSE_REPLACED, message="已在其他连接中加入".encode("utf-8")))
                     
                     # 添加玩家
-                    player = game.add_player(player_id, player_name, ws)
+                    try:
+                        player = target.game.add_player(player_id, player_name, ws)
+                    except ValueError as e:
+                        await ws.send_str(json.dumps({"type": "error", "message": str(e)}))
+                        await ws.close()
+                        return ws
+                    room = target
+                    rooms.open(room)
+                    player.outbox = outbox
+                    # 广播帧格式：/ws?proto=bin 或加入消息中的 proto 字段
+                    if data.get("proto", request.query.get("proto")) == "bin":
+                        player.proto = "bin"
+                    # 客户端声明 batch 后，同一批消息合并成JSON数组发送
+                    outbox.batch = bool(data.get("batch"))
                     
                     # 发送欢迎消息
-                    await ws.send(json.dumps({
+                    outbox.send(json.dumps({
                         "type": "welcome",
                         "player_id": player_id,
                         "name": player_name,
                         "color": player.color,
+                        "room": room.id,
+                        "proto": player.proto,
                         "grid_size": GRID_SIZE,
                         "game_width": GAME_WIDTH,
                         "game_height": GAME_HEIGHT
-                    }))
+                    }).encode("utf-8"), kind="welcome")
                     
-                    print(f"玩家 {player_name} 加入了游戏")
+                    print(f"玩家 {player_name} 加入了房间 {room.id}")
+                
+                elif data["type"] == "ping":
+                    # 延迟测量：原样带回客户端的时间戳，回复与状态帧走同一发送队列
+                    outbox.send(json.dumps({"type": "pong", "t": data.get("t")}).encode("utf-8"), kind="pong")
+                
+                elif player is None or room.game.players.get(player_id) is not player:
+                    # 尚未加入，或已被同一玩家的新连接取代
+                    continue
                 
                 elif data["type"] == "change_direction":
-                    # 改变方向
-                    if player_id and player_id in game.players:
-                        direction = data["direction"]
-                        if direction in DIRECTIONS:
-                            game.players[player_id].next_direction = DIRECTIONS[direction]
+                    # 方向指令排入输入队列，每个tick消费一条
+                    direction = data["direction"]
+                    if direction in DIRECTIONS:
+                        room.game.queue_input(player, DIRECTIONS[direction])
+                
+                elif data["type"] == "resync":
+                    # 客户端发现序号不连续，下一帧发送完整状态
+                    player.needs_keyframe = True
                 
                 elif data["type"] == "chat":
                     # 聊天消息
-                    if player_id and player_id in game.players:
-                        message = data.get("message", "")
-                        # 广播聊天消息
-                        chat_data = json.dumps({
-                            "type": "chat",
-                            "player": player_name,
-                            "message": message,
-                            "time": datetime.now().strftime("%H:%M:%S")
-                        })
-                        
-                        tasks = []
-                        for p in list(game.players.values()):
-                            if p.ws and not p.ws.closed:
-                                try:
-                                    tasks.append(p.ws.send(chat_data))
-                                except:
-                                    pass
-                        
-                        if tasks:
-                            await asyncio.gather(*tasks, return_exceptions=True)
+                    message = data.get("message", "")
+                    # 在房间内广播聊天消息，排入各连接的发送队列
+                    chat_data = json.dumps({
+                        "type": "chat",
+                        "player": player_name,
+                        "message": message,
+                        "time": datetime.now().strftime("%H:%M:%S")
+                    }).encode("utf-8")
+                    
+                    for p in list(room.game.players.values()):
+                        if p.outbox is not None:
+                            p.outbox.send(chat_data, kind="chat")
     
     except Exception as e:
         print(f"WebSocket error: {e}")
     finally:
-        # 清理玩家
-        if player_id:
-            game.remove_player(player_id)
-            print(f"玩家 {player_name} 离开了游戏")
+        outbox.close()
+        if limiter.dropped:
+            print(f"玩家 {player_name} 共有 {limiter.dropped} 条消息因发送过快被丢弃")
+        # 清理玩家；已被新连接取代时玩家属于新连接，不能移除
+        if room is not None and room.game.players.get(player_id) is player:
+            room.game.remove_player(player_id)
+            print(f"玩家 {player_name} 离开了房间 {room.id}")
     
     return ws
 
+class StaticAsset(NamedTuple):
+    """内存中的静态资源，压缩版本在启动时预先生成"""
+    body: bytes
+    gzip: bytes
+    brotli: Optional[bytes]
+    etag: str
+    content_type: str
+    cache_control: str
+
+class StaticAssets:
+    """由 main() 在启动时一次性读入 static 目录，之后的请求不再访问磁盘
+    
+    只有提供页面的主进程构建，导入本模块的脚本和工作进程不会读取或压缩静态资源。
+    """
+    
+    CONTENT_TYPES = {
+        ".html": "text/html; charset=utf-8",
+        ".css": "text/css; charset=utf-8",
+        ".js": "application/javascript; charset=utf-8",
+    }
+    
+    def __init__(self, directory: str = STATIC_DIR):
+        self.assets: Dict[str, StaticAsset] = {}
+        files = {}
+        if not os.path.isdir(directory):
+            print(f"静态资源目录 {directory} 不存在，页面不可用")
+            return
+        for name in sorted(os.listdir(directory)):
+            if os.path.splitext(name)[1] in self.CONTENT_TYPES:
+                with open(os.path.join(directory, name), "rb") as f:
+                    files[name] = f.read()
+        
+        # 页面引用的 css/js 加上内容哈希，资源可以长期缓存，内容变化后自动换新地址
+        versions = {name: self.digest(body) for name, body in files.items()}
+        index = files.pop("index.html", None)
+        for name, body in files.items():
+            if index is not None:
+                index = index.replace(f'"/static/{name}"'.encode(),
+                                      f'"/static/{name}?v={versions[name]}"'.encode())
+            self.assets[name] = self.build(name, body, f"public, max-age={STATIC_MAX_AGE}, immutable")
+        # 页面本身每次都需要协商，保证能拿到新的资源地址
+        if index is not None:
+            self.assets["index.html"] = self.build("index.html", index, "no-cache")
+    
+    @staticmethod
+    def digest(body: bytes) -> str:
+        return hashlib.sha256(body).hexdigest()[:16]
+    
+    def build(self, name: str, body: bytes, cache_control: str) -> StaticAsset:
+        return StaticAsset(
+            body=body,
+            gzip=gzip.compress(body, compresslevel=9, mtime=0),
+            brotli=brotli.compress(body, quality=11) if brotli is not None else None,
+            etag=f'"{self.digest(body)}"',
+            content_type=self.CONTENT_TYPES[os.path.splitext(name)[1]],
+            cache_control=cache_control
+        )
+    
+    def response(self, request, name: str) -> web.Response:
+        """按 If-None-Match 和 Accept-Encoding 选择 304 或合适的压缩版本"""
+        asset = self.assets.get(name)
+        if asset is None:
+            raise web.HTTPNotFound()
+        headers = {
+            "ETag": asset.etag,
+            "Cache-Control": asset.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if asset.etag in request.headers.get("If-None-Match", ""):
+            return web.Response(status=304, headers=headers)
+        
+        accepted = {encoding.split(";")[0].strip()
+                    for encoding in request.headers.get("Accept-Encoding", "").split(",")}
+        body = asset.body
+        if asset.brotli is not None and "br" in accepted:
+            body = asset.brotli
+            headers["Content-Encoding"] = "br"
+        elif "gzip" in accepted:
+            body = asset.gzip
+            headers["Content-Encoding"] = "gzip"
+        headers["Content-Type"] = asset.content_type
+        return web.Response(body=body, headers=headers)
+
 async def index_handler(request):
     """处理主页请求"""
-    with open("index.html", "r", encoding="utf-8") as f:
-        html_content = f.read()
-    
-    return web.Response(text=html_content, content_type="text/html")
+    return request.app["static_assets"].response(request, "index.html")
+
+async def static_handler(request):
+    """处理静态资源请求"""
+    return request.app["static_assets"].response(request, request.match_info["name"])
 
 async def get_players_handler(request):
-    """获取当前玩家列表"""
-    players = []
-    for player in game.players.values():
-        players.append({
-            "id": player.id,
-            "name": player.name,
-            "score": player.score,
-            "alive": player.alive
-        })
+    """获取各房间统计和玩家列表"""
+    return web.Response(body=rooms.players_json(), content_type="application/json")
+
+async def health_handler(request):
+    """健康检查"""
+    return web.json_response(rooms.health())
+
+def check_admin(request):
+    """/admin 接口的访问控制：配置了令牌时校验令牌，否则只允许本机访问"""
+    token = os.environ.get(ADMIN_TOKEN_ENV)
+    if token:
+        supplied = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+        supplied = supplied or request.query.get("token", "")
+        if not hmac.compare_digest(supplied.encode("utf-8"), token.encode("utf-8")):
+            raise web.HTTPForbidden(text="需要管理令牌")
+    elif request.remote not in ("127.0.0.1", "::1"):
+        raise web.HTTPForbidden(text=f"未设置 {ADMIN_TOKEN_ENV} 时只允许本机访问")
+
+def admin_seconds(request, default: float) -> float:
+    try:
+        seconds = float(request.query.get("seconds", default))
+    except ValueError:
+        raise web.HTTPBadRequest(text="seconds 必须是数字")
+    if not 0 <= seconds <= PROFILE_MAX_SECONDS:
+        raise web.HTTPBadRequest(text=f"seconds 取值范围为 0 到 {PROFILE_MAX_SECONDS}")
+    return seconds
+
+async def profile_handler(request):
+    """/admin/profile?seconds=N：采样分析 N 秒，返回折叠栈（flamegraph.pl、speedscope 可用）"""
+    check_admin(request)
+    seconds = admin_seconds(request, 10)
+    if profiler.running:
+        raise web.HTTPConflict(text="已有采样分析在进行")
+    print(f"开始采样分析 {seconds} 秒")
+    return web.Response(text=await profiler.profile(seconds), content_type="text/plain")
+
+async def trace_handler(request):
+    """/admin/trace?seconds=N：开启tick追踪 N 秒后返回缓冲区中的 Chrome trace JSON；seconds=0 直接下载"""
+    check_admin(request)
+    seconds = admin_seconds(request, 5)
+    if seconds > 0:
+        print(f"开启tick追踪 {seconds} 秒")
+        tracer.enable(seconds)
+        await asyncio.sleep(seconds)
+    return web.json_response(tracer.chrome_trace(),
+                             headers={"Content-Disposition": 'attachment; filename="trace.json"'})
+
+def replay_path(name: str) -> str:
+    """录像目录中的录像文件路径，只接受文件名，防止读取目录外的文件"""
+    if rooms.record_dir is None:
+        raise web.HTTPNotFound(text="服务器未开启录像")
+    name = os.path.basename(name)
+    path = os.path.join(rooms.record_dir, name)
+    if not name.endswith(".snkr") or not os.path.isfile(path):
+        raise web.HTTPNotFound(text="录像不存在")
+    return path
+
+async def replays_handler(request):
+    """列出录像文件"""
+    if rooms.record_dir is None:
+        raise web.HTTPNotFound(text="服务器未开启录像")
+    files = []
+    for name in sorted(os.listdir(rooms.record_dir)):
+        if name.endswith(".snkr"):
+            stat = os.stat(os.path.join(rooms.record_dir, name))
+            files.append({"file": name, "size": stat.st_size, "modified": int(stat.st_mtime)})
+    return web.json_response(files)
+
+async def replay_handler(request):
+    """观战回放：/replay?file=录像&speed=倍速&from=tick，帧格式与 /ws 相同（proto=bin 为二进制帧）
+    
+    回放在独立的 Game 中重新模拟，不占用任何在线房间；from 之前的部分在线程中全速快进。
+    同时进行的回放数受 REPLAY_MAX_STREAMS 限制，超出时返回 503。
+    """
+    path = replay_path(request.query.get("file", ""))
+    try:
+        speed = float(request.query.get("speed", 1))
+        start = int(request.query.get("from", 0))
+    except ValueError:
+        raise web.HTTPBadRequest(text="speed 和 from 必须是数字")
+    if not 0 < speed <= REPLAY_MAX_SPEED:
+        raise web.HTTPBadRequest(text=f"speed 取值范围为 0 到 {REPLAY_MAX_SPEED}")
+    binary = request.query.get("proto") == "bin"
+    if rooms.replay_streams >= REPLAY_MAX_STREAMS:
+        raise web.HTTPServiceUnavailable(text="观战回放数已达上限，请稍后再试")
+    try:
+        replay = Replay(path)
+    except ValueError:
+        raise web.HTTPBadRequest(text="录像文件损坏或版本不支持")
     
-    return web.Response(text=json.dumps({"players": players}), content_type="application/json")
+    rooms.replay_streams += 1
+    try:
+        ws = web.WebSocketResponse(max_msg_size=MAX_MESSAGE_SIZE, compress=rooms.ws_compress)
+        await ws.prepare(request)
+        await stream_replay(ws, replay, path, speed, start, binary)
+    finally:
+        rooms.replay_streams -= 1
+    return ws
 
-async def main():
-    """主函数"""
-    # 启动游戏循环
-    asyncio.create_task(game_loop())
+async def stream_replay(ws, replay: Replay, path: str, speed: float, start: int, binary: bool):
+    """快进到 start 后按倍速逐tick发送回放帧，直到录像结束或观战端断开"""
+    async def ignore_messages():
+        # 观战端发来的消息（如浏览器客户端的 join）一律忽略，只为及时处理关闭
+        async for _ in ws:
+            pass
     
-    # 创建HTTP服务器
+    reader = asyncio.create_task(ignore_messages())
+    suffix = "_bin" if binary else ""
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, replay.fast_forward, start)
+        game = replay.game
+        kind = "game_state"
+        while not ws.closed:
+            delta = game.flush_frames()
+            await send_frame(ws, encode_frame(kind + suffix, game.snapshot(), delta), binary)
+            kind = "game_delta"
+            if not replay.advance_tick():
+                break
+            await asyncio.sleep(1.0 / (game.speed * speed))
+    except ValueError as e:
+        print(f"回放 {os.path.basename(path)} 失败: {e}")
+    except ConnectionResetError:
+        pass
+    finally:
+        reader.cancel()
+        await ws.close()
+
+async def metrics_handler(request):
+    """Prometheus 文本格式的监控指标"""
+    return web.Response(body=metrics.render().encode("utf-8"), headers=METRICS_HEADERS)
+
+def worker_port(port: int, index: int) -> int:
+    """工作进程监听的端口，客户端经 /route 查询后直接连接"""
+    return port + 1 + index
+
+def room_worker(room_id: str, worker_count: int) -> int:
+    """房间号到工作进程的固定映射：工作进程生成的房间号带有 w<序号>- 前缀，其余按哈希分配"""
+    prefix, sep, _ = room_id.partition("-")
+    if sep and prefix[:1] == "w" and prefix[1:].isdigit() and int(prefix[1:]) < worker_count:
+        return int(prefix[1:])
+    return zlib.crc32(room_id.encode("utf-8")) % worker_count
+
+async def serve_worker(index: int, port: int, parent_pid: int):
+    """工作进程：在自己的端口上直接服务客户端WebSocket，统计接口由主进程汇总"""
     app = web.Application()
-    app.router.add_get('/', index_handler)
+    app.on_shutdown.append(rooms.close_connections)
+    app.on_cleanup.append(rooms.close_recorders)
     app.router.add_get('/ws', handle_websocket)
     app.router.add_get('/players', get_players_handler)
+    app.router.add_get('/health', health_handler)
+    app.router.add_get('/metrics', metrics_handler)
+    app.router.add_get('/admin/profile', profile_handler)
+    app.router.add_get('/admin/trace', trace_handler)
     
-    # 添加静态文件路由
-    app.router.add_static('/static/', path='./static', name='static')
-    
-    # 创建HTML文件
-    html_content = """
-    <!DOCTYPE html>
-    <html lang="zh-CN">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>多人贪吃蛇游戏</title>
-        <style>
-            * {
-                margin: 0;
-                padding: 0;
-                box-sizing: border-box;
-            }
-            
-            body {
-                font-family: 'Arial', sans-serif;
-                background: linear-gradient(135deg, #1a1a2e 0%, #16213e 100%);
-                color: #fff;
-                min-height: 100vh;
-                padding: 20px;
-            }
-            
-            .container {
-                max-width: 1000px;
-                margin: 0 auto;
-                padding: 20px;
-            }
-            
-            header {
-                text-align: center;
-                margin-bottom: 20px;
-            }
-            
-            h1 {
-                font-size: 2.5rem;
-                color: #4dff91;
-                text-shadow: 0 0 10px rgba(77, 255, 145, 0.5);
-                margin-bottom: 10px;
-            }
-            
-            .subtitle {
-                color: #a0a0c0;
-                font-size: 1.1rem;
-                margin-bottom: 20px;
-            }
-            
-            .game-container {
-                display: flex;
-                flex-wrap: wrap;
-                gap: 20px;
-                margin-bottom: 20px;
-            }
-            
-            .game-area {
-                flex: 1;
-                min-width: 300px;
-            }
-            
-            .game-ui {
-                flex: 0 0 300px;
-                background: rgba(0, 0, 0, 0.3);
-                border-radius: 10px;
-                padding: 20px;
-                border: 1px solid #333;
-            }
-            
-            #gameCanvas {
-                background-color: #0d1b2a;
-                border-radius: 10px;
-                border: 2px solid #333;
-                display: block;
-                margin: 0 auto;
-            }
-            
-            .panel {
-                margin-bottom: 20px;
-            }
-            
-            .panel h2 {
-                color: #4dff91;
-                border-bottom: 2px solid #4dff91;
-                padding-bottom: 5px;
-                margin-bottom: 15px;
-                font-size: 1.3rem;
-            }
-            
-            .player-list {
-                list-style: none;
-                max-height: 200px;
-                overflow-y: auto;
-            }
-            
-            .player-item {
-                display: flex;
-                justify-content: space-between;
-                padding: 8px 10px;
-                background: rgba(255, 255, 255, 0.05);
-                border-radius: 5px;
-                margin-bottom: 5px;
-                border-left: 4px solid #4dff91;
-            }
-            
-            .player-name {
-                font-weight: bold;
-            }
-            
-            .player-score {
-                color: #ffd700;
-            }
-            
-            .controls {
-                margin-top: 20px;
-            }
-            
-            .control-info {
-                background: rgba(0, 0, 0, 0.2);
-                padding: 15px;
-                border-radius: 5px;
-                margin-bottom: 15px;
-            }
-            
-            .control-info p {
-                margin-bottom: 5px;
-                color: #a0a0c0;
-            }
-            
-            .chat-container {
-                margin-top: 20px;
-            }
-            
-            #chatLog {
-                height: 150px;
-                overflow-y: auto;
-                background: rgba(0, 0, 0, 0.2);
-                border-radius: 5px;
-                padding: 10px;
-                margin-bottom: 10px;
-                border: 1px solid #333;
-            }
-            
-            .chat-message {
-                margin-bottom: 5px;
-                padding: 5px;
-                border-radius: 3px;
-                background: rgba(255, 255, 255, 0.05);
-            }
-            
-            .chat-input {
-                display: flex;
-                gap: 10px;
-            }
-            
-            #chatInput {
-                flex: 1;
-                padding: 10px;
-                border-radius: 5px;
-                border: 1px solid #333;
-                background: rgba(0, 0, 0, 0.3);
-                color: white;
-            }
-            
-            button {
-                padding: 10px 20px;
-                background: linear-gradient(135deg, #4dff91 0%, #1a8cff 100%);
-                border: none;
-                border-radius: 5px;
-                color: white;
-                font-weight: bold;
-                cursor: pointer;
-                transition: all 0.3s;
-            }
-            
-            button:hover {
-                transform: translateY(-2px);
-                box-shadow: 0 5px 15px rgba(77, 255, 145, 0.4);
-            }
-            
-            button:active {
-                transform: translateY(0);
-            }
-            
-            .instructions {
-                background: rgba(0, 0, 0, 0.2);
-                padding: 20px;
-                border-radius: 10px;
-                margin-top: 20px;
-                border: 1px solid #333;
-            }
-            
-            .instructions h3 {
-                color: #4dff91;
-                margin-bottom: 10px;
-            }
-            
-            .instructions ul {
-                padding-left: 20px;
-                color: #a0a0c0;
-            }
-            
-            .instructions li {
-                margin-bottom: 5px;
-            }
-            
-            .status {
-                text-align: center;
-                margin-bottom: 15px;
-                padding: 10px;
-                border-radius: 5px;
-                background: rgba(0, 0, 0, 0.2);
-            }
-            
-            .status.connected {
-                color: #4dff91;
-                border: 1px solid #4dff91;
-            }
-            
-            .status.disconnected {
-                color: #ff5252;
-                border: 1px solid #ff5252;
-            }
-            
-            .game-stats {
-                display: flex;
-                justify-content: space-between;
-                margin-bottom: 15px;
-                padding: 10px;
-                background: rgba(0, 0, 0, 0.2);
-                border-radius: 5px;
-            }
-            
-            .stat-item {
-                text-align: center;
-            }
-            
-            .stat-value {
-                font-size: 1.5rem;
-                font-weight: bold;
-                color: #4dff91;
-            }
-            
-            .stat-label {
-                font-size: 0.9rem;
-                color: #a0a0c0;
-            }
-            
-            @media (max-width: 768px) {
-                .game-container {
-                    flex-direction: column;
-                }
-                
-                .game-ui {
-                    width: 100%;
-                }
-            }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <header>
-                <h1>🐍 多人贪吃蛇</h1>
-                <p class="subtitle">最多10人同时游戏 | 使用方向键或WASD控制</p>
-            </header>
-            
-            <div class="game-container">
-                <div class="game-area">
-                    <div class="status disconnected" id="status">正在连接服务器...</div>
-                    <canvas id="gameCanvas" width="600" height="400"></canvas>
-                    
-                    <div class="game-stats">
-                        <div class="stat-item">
-                            <div class="stat-value" id="playerCount">0</div>
-                            <div class="stat-label">在线玩家</div>
-                        </div>
-                        <div class="stat-item">
-                            <div class="stat-value" id="playerScore">0</div>
-                            <div class="stat-label">你的分数</div>
-                        </div>
-                        <div class="stat-item">
-                            <div class="stat-value" id="gameSpeed">10</div>
-                            <div class="stat-label">游戏速度</div>
-                        </div>
-                    </div>
-                </div>
-                
-                <div class="game-ui">
-                    <div class="panel">
-                        <h2>玩家列表 (最多10人)</h2>
-                        <ul class="player-list" id="playerList">
-                            <li class="player-item">等待玩家加入...</li>
-                        </ul>
-                    </div>
-                    
-                    <div class="controls">
-                        <div class="control-info">
-                            <p><strong>控制方式:</strong></p>
-                            <p>↑↓←→ 或 WASD 键控制方向</p>
-                            <p>空格键暂停/继续聊天</p>
-                        </div>
-                        
-                        <div class="chat-container">
-                            <h2>游戏聊天</h2>
-                            <div id="chatLog"></div>
-                            <div class="chat-input">
-                                <input type="text" id="chatInput" placeholder="输入消息..." maxlength="100">
-                                <button id="sendBtn">发送</button>
-                            </div>
-                        </div>
-                    </div>
-                </div>
-            </div>
-            
-            <div class="instructions">
-                <h3>游戏说明</h3>
-                <ul>
-                    <li>使用方向键或WASD键控制你的蛇移动</li>
-                    <li>吃掉红色食物可以增加长度和分数</li>
-                    <li>撞到自己或其他玩家会导致死亡</li>
-                    <li>游戏支持最多10人同时游玩</li>
-                    <li>游戏速度会随着玩家吃掉食物而增加</li>
-                    <li>蛇可以穿过边界到达另一侧</li>
-                </ul>
-            </div>
-        </div>
-        
-        <script>
-            // 游戏变量
-            let playerId = null;
-            let playerColor = "#FF5252";
-            let playerName = "Player" + Math.floor(1000 + Math.random() * 9000);
-            let ws = null;
-            let gamePaused = false;
-            
-            // 获取DOM元素
-            const canvas = document.getElementById('gameCanvas');
-            const ctx = canvas.getContext('2d');
-            const statusEl = document.getElementById('status');
-            const playerListEl = document.getElementById('playerList');
-            const playerCountEl = document.getElementById('playerCount');
-            const playerScoreEl = document.getElementById('playerScore');
-            const gameSpeedEl = document.getElementById('gameSpeed');
-            const chatLogEl = document.getElementById('chatLog');
-            const chatInputEl = document.getElementById('chatInput');
-            const sendBtn = document.getElementById('sendBtn');
-            
-            // 初始化WebSocket连接
-            function connectWebSocket() {
-                const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-                const wsUrl = `${protocol}//${window.location.host}/ws`;
-                
-                ws = new WebSocket(wsUrl);
-                
-                ws.onopen = function() {
-                    console.log('已连接到服务器');
-                    statusEl.textContent = '已连接到服务器';
-                    statusEl.className = 'status connected';
-                    
-                    // 发送加入游戏消息
-                    ws.send(JSON.stringify({
-                        type: 'join',
-                        player_id: localStorage.getItem('snakePlayerId') || generatePlayerId(),
-                        name: localStorage.getItem('snakePlayerName') || playerName
-                    }));
-                };
-                
-                ws.onmessage = function(event) {
-                    const data = JSON.parse(event.data);
-                    
-                    switch(data.type) {
-                        case 'welcome':
-                            playerId = data.player_id;
-                            playerColor = data.color;
-                            playerName = data.name;
-                            
-                            // 保存到本地存储
-                            localStorage.setItem('snakePlayerId', playerId);
-                            localStorage.setItem('snakePlayerName', playerName);
-                            
-                            console.log(`欢迎，${playerName} (${playerId})`);
-                            break;
-                            
-                        case 'game_state':
-                            updateGame(data.data);
-                            break;
-                            
-                        case 'chat':
-                            addChatMessage(data.player, data.message, data.time);
-                            break;
-                            
-                        case 'error':
-                            alert(data.message);
-                            break;
-                    }
-                };
-                
-                ws.onclose = function() {
-                    console.log('与服务器的连接已断开');
-                    statusEl.textContent = '与服务器连接已断开，5秒后重连...';
-                    statusEl.className = 'status disconnected';
-                    
-                    // 5秒后重连
-                    setTimeout(connectWebSocket, 5000);
-                };
-                
-                ws.onerror = function(error) {
-                    console.error('WebSocket错误:', error);
-                    statusEl.textContent = '连接错误，请检查网络';
-                    statusEl.className = 'status disconnected';
-                };
-            }
-            
-            // 生成玩家ID
-            function generatePlayerId() {
-                return 'player_' + Date.now() + '_' + Math.random().toString(36).substr(2, 9);
-            }
-            
-            // 更新游戏状态
-            function updateGame(state) {
-                // 清除画布
-                ctx.fillStyle = '#0d1b2a';
-                ctx.fillRect(0, 0, canvas.width, canvas.height);
-                
-                // 绘制网格
-                ctx.strokeStyle = 'rgba(255, 255, 255, 0.05)';
-                ctx.lineWidth = 1;
-                
-                for (let x = 0; x <= 600; x += 20) {
-                    ctx.beginPath();
-                    ctx.moveTo(x, 0);
-                    ctx.lineTo(x, 400);
-                    ctx.stroke();
-                }
-                
-                for (let y = 0; y <= 400; y += 20) {
-                    ctx.beginPath();
-                    ctx.moveTo(0, y);
-                    ctx.lineTo(600, y);
-                    ctx.stroke();
-                }
-                
-                // 绘制食物
-                ctx.fillStyle = '#FF5252';
-                for (const food of state.foods) {
-                    ctx.beginPath();
-                    ctx.arc(
-                        food.x * 20 + 10,
-                        food.y * 20 + 10,
-                        8, 0, Math.PI * 2
-                    );
-                    ctx.fill();
-                    
-                    // 食物光泽效果
-                    ctx.fillStyle = 'rgba(255, 255, 255, 0.3)';
-                    ctx.beginPath();
-                    ctx.arc(
-                        food.x * 20 + 6,
-                        food.y * 20 + 6,
-                        3, 0, Math.PI * 2
-                    );
-                    ctx.fill();
-                    ctx.fillStyle = '#FF5252';
-                }
-                
-                // 绘制玩家
-                let myPlayer = null;
-                let alivePlayers = 0;
-                
-                for (const player of state.players) {
-                    if (player.id === playerId) {
-                        myPlayer = player;
-                    }
-                    
-                    if (player.alive) {
-                        alivePlayers++;
-                    }
-                    
-                    // 绘制蛇身
-                    ctx.fillStyle = player.color;
-                    for (let i = 0; i < player.body.length; i++) {
-                        const [x, y] = player.body[i];
-                        
-                        // 蛇头
-                        if (i === 0) {
-                            ctx.fillRect(x * 20, y * 20, 20, 20);
-                            
-                            // 蛇头眼睛
-                            ctx.fillStyle = 'white';
-                            ctx.beginPath();
-                            
-                            // 根据方向确定眼睛位置
-                            let eye1X, eye1Y, eye2X, eye2Y;
-                            if (player.body.length > 1) {
-                                const [headX, headY] = player.body[0];
-                                const [nextX, nextY] = player.body[1];
-                                
-                                if (nextX < headX) { // 向右移动
-                                    eye1X = x * 20 + 15; eye1Y = y * 20 + 5;
-                                    eye2X = x * 20 + 15; eye2Y = y * 20 + 15;
-                                } else if (nextX > headX) { // 向左移动
-                                    eye1X = x * 20 + 5; eye1Y = y * 20 + 5;
-                                    eye2X = x * 20 + 5; eye2Y = y * 20 + 15;
-                                } else if (nextY < headY) { // 向下移动
-                                    eye1X = x * 20 + 5; eye1Y = y * 20 + 15;
-                                    eye2X = x * 20 + 15; eye2Y = y * 20 + 15;
-                                } else { // 向上移动
-                                    eye1X = x * 20 + 5; eye1Y = y * 20 + 5;
-                                    eye2X = x * 20 + 15; eye2Y = y * 20 + 5;
-                                }
-                            } else {
-                                eye1X = x * 20 + 5; eye1Y = y * 20 + 5;
-                                eye2X = x * 20 + 15; eye2Y = y * 20 + 5;
-                            }
-                            
-                            ctx.arc(eye1X, eye1Y, 2, 0, Math.PI * 2);
-                            ctx.arc(eye2X, eye2Y, 2, 0, Math.PI * 2);
-                            ctx.fill();
-                            
-                            // 蛇瞳孔
-                            ctx.fillStyle = 'black';
-                            ctx.beginPath();
-                            ctx.arc(eye1X, eye1Y, 1, 0, Math.PI * 2);
-                            ctx.arc(eye2X, eye2Y, 1, 0, Math.PI * 2);
-                            ctx.fill();
-                            
-                            ctx.fillStyle = player.color;
-                        } else {
-                            // 蛇身
-                            ctx.fillRect(x * 20, y * 20, 20, 20);
-                            
-                            // 蛇身内部阴影
-                            ctx.fillStyle = 'rgba(255, 255, 255, 0.2)';
-                            ctx.fillRect(x * 20 + 2, y * 20 + 2, 16, 16);
-                            ctx.fillStyle = player.color;
-                        }
-                    }
-                    
-                    // 绘制玩家名称
-                    if (player.body.length > 0) {
-                        const [headX, headY] = player.body[0];
-                        ctx.fillStyle = 'white';
-                        ctx.font = '12px Arial';
-                        ctx.textAlign = 'center';
-                        ctx.fillText(
-                            player.name,
-                            headX * 20 + 10,
-                            headY * 20 - 5
-                        );
-                    }
-                }
-                
-                // 更新玩家列表
-                updatePlayerList(state.players);
-                
-                // 更新统计信息
-                playerCountEl.textContent = `${alivePlayers}/${state.players.length}`;
-                gameSpeedEl.textContent = state.speed.toFixed(1);
-                
-                if (myPlayer) {
-                    playerScoreEl.textContent = myPlayer.score;
-                    
-                    // 如果玩家死亡，显示死亡信息
-                    if (!myPlayer.alive) {
-                        ctx.fillStyle = 'rgba(0, 0, 0, 0.7)';
-                        ctx.fillRect(0, 0, canvas.width, canvas.height);
-                        
-                        ctx.fillStyle = 'white';
-                        ctx.font = 'bold 30px Arial';
-                        ctx.textAlign = 'center';
-                        ctx.fillText('游戏结束!', canvas.width / 2, canvas.height / 2 - 30);
-                        
-                        ctx.font = '20px Arial';
-                        ctx.fillText(`最终得分: ${myPlayer.score}`, canvas.width / 2, canvas.height / 2 + 20);
-                        
-                        ctx.font = '16px Arial';
-                        ctx.fillText('刷新页面重新开始', canvas.width / 2, canvas.height / 2 + 60);
-                    }
-                }
-            }
-            
-            // 更新玩家列表
-            function updatePlayerList(players) {
-                playerListEl.innerHTML = '';
-                
-                // 按分数排序
-                const sortedPlayers = [...players].sort((a, b) => b.score - a.score);
-                
-                sortedPlayers.forEach(player => {
-                    const li = document.createElement('li');
-                    li.className = 'player-item';
-                    li.style.borderLeftColor = player.color;
-                    
-                    if (!player.alive) {
-                        li.style.opacity = '0.6';
-                    }
-                    
-                    const nameSpan = document.createElement('span');
-                    nameSpan.className = 'player-name';
-                    nameSpan.textContent = player.name + (player.id === playerId ? ' (你)' : '');
-                    
-                    const scoreSpan = document.createElement('span');
-                    scoreSpan.className = 'player-score';
-                    scoreSpan.textContent = player.score;
-                    
-                    li.appendChild(nameSpan);
-                    li.appendChild(scoreSpan);
-                    playerListEl.appendChild(li);
-                });
-            }
-            
-            // 添加聊天消息
-            function addChatMessage(player, message, time) {
-                const messageEl = document.createElement('div');
-                messageEl.className = 'chat-message';
-                messageEl.innerHTML = `<strong style="color: ${player === playerName ? playerColor : '#4dff91'}">${player}:</strong> ${message} <span style="color: #888; font-size: 0.8em;">${time}</span>`;
-                
-                chatLogEl.appendChild(messageEl);
-                chatLogEl.scrollTop = chatLogEl.scrollHeight;
-            }
-            
-            // 发送聊天消息
-            function sendChatMessage() {
-                const message = chatInputEl.value.trim();
-                if (message && ws && ws.readyState === WebSocket.OPEN) {
-                    ws.send(JSON.stringify({
-                        type: 'chat',
-                        message: message
-                    }));
-                    
-                    chatInputEl.value = '';
-                }
-            }
-            
-            // 键盘控制
-            const keyMap = {
-                'ArrowUp': 'up',
-                'ArrowDown': 'down',
-                'ArrowLeft': 'left',
-                'ArrowRight': 'right',
-                'w': 'up',
-                's': 'down',
-                'a': 'left',
-                'd': 'right',
-                'W': 'up',
-                'S': 'down',
-                'A': 'left',
-                'D': 'right'
-            };
-            
-            document.addEventListener('keydown', (e) => {
-                // 如果聊天框有焦点，不处理方向键
-                if (document.activeElement === chatInputEl) {
-                    if (e.key === 'Enter') {
-                        sendChatMessage();
-                        e.preventDefault();
-                    }
-                    return;
-                }
-                
-                // 空格键切换聊天框焦点
-                if (e.key === ' ') {
-                    e.preventDefault();
-                    if (chatInputEl === document.activeElement) {
-                        chatInputEl.blur();
-                    } else {
-                        chatInputEl.focus();
-                    }
-                    return;
-                }
-                
-                // 方向控制
-                if (keyMap[e.key] && ws && ws.readyState === WebSocket.OPEN) {
-                    ws.send(JSON.stringify({
-                        type: 'change_direction',
-                        direction: keyMap[e.key]
-                    }));
-                    e.preventDefault();
-                }
-            });
-            
-            // 发送按钮事件
-            sendBtn.addEventListener('click', sendChatMessage);
-            chatInputEl.addEventListener('keypress', (e) => {
-                if (e.key === 'Enter') {
-                    sendChatMessage();
-                }
-            });
-            
-            // 触摸控制（移动设备）
-            let touchStartX = 0;
-            let touchStartY = 0;
-            
-            canvas.addEventListener('touchstart', (e) => {
-                e.preventDefault();
-                touchStartX = e.touches[0].clientX;
-                touchStartY = e.touches[0].clientY;
-            }, {passive: false});
-            
-            canvas.addEventListener('touchend', (e) => {
-                e.preventDefault();
-                const touchEndX = e.changedTouches[0].clientX;
-                const touchEndY = e.changedTouches[0].clientY;
-                
-                const dx = touchEndX - touchStartX;
-                const dy = touchEndY - touchStartY;
-                
-                // 确定滑动方向
-                if (Math.abs(dx) > Math.abs(dy)) {
-                    // 水平滑动
-                    if (dx > 0 && ws) {
-                        ws.send(JSON.stringify({type: 'change_direction', direction: 'right'}));
-                    } else if (dx < 0 && ws) {
-                        ws.send(JSON.stringify({type: 'change_direction', direction: 'left'}));
-                    }
-                } else {
-                    // 垂直滑动
-                    if (dy > 0 && ws) {
-                        ws.send(JSON.stringify({type: 'change_direction', direction: 'down'}));
-                    } else if (dy < 0 && ws) {
-                        ws.send(JSON.stringify({type: 'change_direction', direction: 'up'}));
-                    }
-                }
-            }, {passive: false});
-            
-            // 防止触摸滚动
-            document.addEventListener('touchmove', (e) => {
-                if (e.target === canvas) {
-                    e.preventDefault();
-                }
-            }, {passive: false});
-            
-            // 初始连接
-            connectWebSocket();
-            
-            // 页面可见性变化处理
-            document.addEventListener('visibilitychange', () => {
-                if (document.hidden) {
-                    console.log('页面切换到后台');
-                } else {
-                    console.log('页面回到前台');
-                }
-            });
-        </script>
-    </body>
-    </html>
+    runner = web.AppRunner(app, shutdown_timeout=SHUTDOWN_TIMEOUT)
+    await runner.setup()
+    site = web.TCPSite(runner, '0.0.0.0', worker_port(port, index))
+    await site.start()
+    print(f"工作进程 {index} 已启动 (pid {os.getpid()})")
+    lag_monitor = asyncio.create_task(monitor_loop_lag())  # 保留引用，避免任务被回收
+    
+    # 主进程退出后随之退出，避免遗留占用端口的工作进程；主进程关闭时发送 SIGTERM
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    try:
+        while not stop.is_set():
+            if os.getppid() != parent_pid:
+                print(f"主进程已退出，工作进程 {index} 关闭")
+                break
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stop.wait(), WORKER_POLL_INTERVAL)
+    finally:
+        await runner.cleanup()
+
+def run_worker(index: int, port: int, parent_pid: int, encode_workers: int, arena: Tuple[int, int],
+               max_players: int = MAX_PLAYERS, ws_compress: bool = WS_COMPRESS,
+               record_dir: Optional[str] = None):
+    """工作进程入口；工作进程是守护进程，不能再创建子进程，编码池只能使用线程"""
+    rooms.id_prefix = f"w{index}-"
+    rooms.arena = arena
+    rooms.max_players = max_players
+    rooms.ws_compress = ws_compress
+    rooms.record_dir = record_dir
+    rooms.executor = create_encode_executor(encode_workers)
+    try:
+        asyncio.run(serve_worker(index, port, parent_pid))
+    except KeyboardInterrupt:
+        pass
+
+class WorkerCluster:
+    """多进程模式的主进程：告诉客户端房间所在的工作进程，并汇总各进程状态
+    
+    客户端先请求 /route 取得工作进程端口再直接连接，帧的压缩与发送都在工作进程中完成；
+    /ws 仍按房间转发，供只能访问主端口的客户端使用。
     """
+    def __init__(self, worker_count: int, port: int, encode_workers: int = 0,
+                 arena: Tuple[int, int] = (GRID_WIDTH, GRID_HEIGHT), max_players: int = MAX_PLAYERS,
+                 ws_compress: bool = WS_COMPRESS, record_dir: Optional[str] = None):
+        self.worker_count = worker_count
+        self.port = port
+        self.encode_workers = encode_workers
+        self.arena = arena
+        self.max_players = max_players
+        self.ws_compress = ws_compress  # 工作进程与转发连接是否与客户端协商压缩；到工作进程的本机转发不压缩
+        self.record_dir = record_dir  # 各工作进程把录像写到同一目录，回放由主进程提供
+        self.processes: List[multiprocessing.Process] = []
+        self.health: List[Optional[dict]] = [None] * worker_count
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._round_robin = 0
     
-    # 保存HTML文件
-    with open("index.html", "w", encoding="utf-8") as f:
-        f.write(html_content)
+    def url(self, index: int, path: str) -> str:
+        return f"http://127.0.0.1:{worker_port(self.port, index)}{path}"
     
-    # 创建静态目录
-    import os
-    if not os.path.exists("static"):
-        os.makedirs("static")
+    async def start(self, app):
+        """启动工作进程和状态汇总任务"""
+        ctx = multiprocessing.get_context("spawn")
+        for index in range(self.worker_count):
+            process = ctx.Process(target=run_worker, args=(index, self.port, os.getpid(),
+                                                            self.encode_workers, self.arena,
+                                                            self.max_players, self.ws_compress,
+                                                            self.record_dir),
+                                  daemon=True)
+            process.start()
+            self.processes.append(process)
+        self.session = aiohttp.ClientSession()
+        app["cluster_poll"] = asyncio.create_task(self.poll())
+    
+    async def stop(self, app):
+        app["cluster_poll"].cancel()
+        await self.session.close()
+        for process in self.processes:
+            process.terminate()
+    
+    async def fetch(self, index: int, path: str):
+        """从工作进程获取JSON，失败返回 None"""
+        try:
+            async with self.session.get(self.url(index, path),
+                                        timeout=aiohttp.ClientTimeout(total=2)) as resp:
+                return await resp.json()
+        except Exception:
+            return None
+    
+    async def fetch_text(self, index: int, path: str) -> Optional[str]:
+        """从工作进程获取文本，失败返回 None"""
+        try:
+            async with self.session.get(self.url(index, path),
+                                        timeout=aiohttp.ClientTimeout(total=2)) as resp:
+                return await resp.text()
+        except Exception:
+            return None
+    
+    async def poll(self):
+        """定期汇总工作进程健康状态"""
+        while True:
+            results = await asyncio.gather(*(self.fetch(i, "/health")
+                                             for i in range(self.worker_count)))
+            for index, result in enumerate(results):
+                self.health[index] = result
+            await asyncio.sleep(WORKER_POLL_INTERVAL)
+    
+    def pick_worker(self) -> int:
+        """未指定房间时选择健康的工作进程
+        
+        与 RoomManager.find_room 一样先填满已有房间：优先有空位且空位最少的进程，
+        所有进程都没有空位时才选择玩家最少的进程（它会新建房间）。
+        """
+        healthy = [index for index, health in enumerate(self.health) if health is not None]
+        if not healthy:
+            # 尚未取得任何状态时轮流分配
+            best = self._round_robin % self.worker_count
+            self._round_robin += 1
+            return best
+        with_slots = [index for index in healthy if self.health[index]["open_slots"] > 0]
+        if with_slots:
+            best = min(with_slots, key=lambda index: (self.health[index]["open_slots"],
+                                                      self.health[index]["player_count"]))
+            self.health[best]["open_slots"] -= 1
+        else:
+            best = min(healthy, key=lambda index: self.health[index]["player_count"])
+            self.health[best]["open_slots"] += self.max_players - 1
+        # 在下次汇总前先计入本次分配，避免瞬间涌入的连接都落到同一进程或各自新建房间
+        self.health[best]["player_count"] += 1
+        return best
+    
+    def choose_worker(self, request) -> int:
+        room_id = request.query.get("room")
+        return room_worker(room_id, self.worker_count) if room_id else self.pick_worker()
+    
+    async def route_handler(self, request):
+        """/route?room=房间号：返回负责该房间的工作进程端口，未指定房间时按 pick_worker 匹配"""
+        index = self.choose_worker(request)
+        return web.json_response({"worker": index, "port": worker_port(self.port, index)})
+    
+    async def proxy_websocket(self, request):
+        """把客户端WebSocket双向转发到负责该房间的工作进程，关闭码原样传回客户端"""
+        ws = web.WebSocketResponse(compress=self.ws_compress)
+        await ws.prepare(request)
+        
+        index = self.choose_worker(request)
+        path = "/ws" + (f"?{request.query_string}" if request.query_string else "")
+        
+        async def pump(source, target):
+            async for msg in source:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    await send_frame(target, msg.data.encode("utf-8"))
+                elif msg.type == aiohttp.WSMsgType.BINARY:
+                    await send_frame(target, msg.data, binary=True)
+        
+        code = aiohttp.WSCloseCode.OK
+        try:
+            async with self.session.ws_connect(self.url(index, path)) as upstream:
+                tasks = [asyncio.create_task(pump(ws, upstream)),
+                         asyncio.create_task(pump(upstream, ws))]
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in tasks:
+                    task.cancel()
+                if upstream.closed and upstream.close_code:
+                    code = upstream.close_code
+        except Exception as e:
+            print(f"转发到工作进程 {index} 失败: {e}")
+        finally:
+            await ws.close(code=code)
+        return ws
+    
+    async def players_handler(self, request):
+        """汇总所有工作进程的房间统计和玩家列表"""
+        results = await asyncio.gather(*(self.fetch(i, "/players")
+                                         for i in range(self.worker_count)))
+        all_rooms = []
+        for index, result in enumerate(results):
+            for room in (result or {}).get("rooms", []):
+                room["worker"] = index
+                all_rooms.append(room)
+        return web.json_response({
+            "workers": self.worker_count,
+            "room_count": len(all_rooms),
+            "player_count": sum(room["player_count"] for room in all_rooms),
+            "rooms": all_rooms
+        })
+    
+    async def metrics_handler(self, request):
+        """合并主进程与各工作进程的监控指标，样本带 worker 标签"""
+        results = await asyncio.gather(*(self.fetch_text(i, "/metrics")
+                                         for i in range(self.worker_count)))
+        sources = [("main", metrics.render())]
+        sources += [(str(index), text) for index, text in enumerate(results) if text]
+        return web.Response(body=merge_metrics(sources).encode("utf-8"), headers=METRICS_HEADERS)
+    
+    def admin_handler(self, local_handler):
+        """/admin 接口：带 worker=序号 时转发给该工作进程，否则分析主进程自身"""
+        async def handler(request):
+            check_admin(request)
+            if "worker" not in request.query:
+                return await local_handler(request)
+            try:
+                index = int(request.query["worker"])
+            except ValueError:
+                raise web.HTTPBadRequest(text="worker 必须是工作进程序号")
+            if not 0 <= index < self.worker_count:
+                raise web.HTTPNotFound(text=f"没有工作进程 {index}")
+            headers = {key: value for key, value in request.headers.items() if key == "Authorization"}
+            timeout = aiohttp.ClientTimeout(total=admin_seconds(request, 10) + 10)
+            async with self.session.get(self.url(index, request.path_qs), headers=headers,
+                                        timeout=timeout) as resp:
+                return web.Response(body=await resp.read(), status=resp.status,
+                                    content_type=resp.content_type)
+        return handler
+    
+    async def health_handler(self, request):
+        """汇总健康状态，任一工作进程不可用时返回503"""
+        workers = []
+        for index, process in enumerate(self.processes):
+            health = self.health[index]
+            workers.append({
+                "index": index,
+                "alive": process.is_alive() and health is not None,
+                **(health or {})
+            })
+        healthy = all(worker["alive"] for worker in workers)
+        return web.json_response({
+            "status": "ok" if healthy else "degraded",
+            "workers": workers
+        }, status=200 if healthy else 503)
+
+async def main(port: int = 8001, workers: int = 0, encode_workers: int = 0,
+               encode_pool: str = "thread", arena: Tuple[int, int] = (GRID_WIDTH, GRID_HEIGHT),
+               max_players: int = MAX_PLAYERS, ws_compress: bool = WS_COMPRESS,
+               record_dir: Optional[str] = None):
+    """主函数；workers > 0 时以多进程模式运行，房间分布在各工作进程上"""
+    rooms.arena = arena
+    rooms.max_players = max_players
+    rooms.ws_compress = ws_compress
+    if record_dir is not None:
+        os.makedirs(record_dir, exist_ok=True)
+    rooms.record_dir = record_dir
+    # 创建HTTP服务器（房间及其游戏循环按需创建）
+    app = web.Application()
+    app["static_assets"] = StaticAssets()
+    app.on_shutdown.append(rooms.close_connections)
+    app.on_cleanup.append(rooms.close_recorders)
+    app.router.add_get('/', index_handler)
+    if workers > 0:
+        cluster = WorkerCluster(workers, port, encode_workers, arena, max_players, ws_compress, record_dir)
+        app.on_startup.append(cluster.start)
+        app.on_cleanup.append(cluster.stop)
+        app.router.add_get('/route', cluster.route_handler)
+        app.router.add_get('/ws', cluster.proxy_websocket)
+        app.router.add_get('/players', cluster.players_handler)
+        app.router.add_get('/health', cluster.health_handler)
+        app.router.add_get('/metrics', cluster.metrics_handler)
+        app.router.add_get('/admin/profile', cluster.admin_handler(profile_handler))
+        app.router.add_get('/admin/trace', cluster.admin_handler(trace_handler))
+    else:
+        rooms.executor = create_encode_executor(encode_workers, encode_pool)
+        app.router.add_get('/ws', handle_websocket)
+        app.router.add_get('/players', get_players_handler)
+        app.router.add_get('/health', health_handler)
+        app.router.add_get('/metrics', metrics_handler)
+        app.router.add_get('/admin/profile', profile_handler)
+        app.router.add_get('/admin/trace', trace_handler)
+    
+    app.router.add_get('/static/{name}', static_handler)
+    app.router.add_get('/replay', replay_handler)
+    app.router.add_get('/replays', replays_handler)
     
     # 启动服务器
-    runner = web.AppRunner(app)
+    runner = web.AppRunner(app, shutdown_timeout=SHUTDOWN_TIMEOUT)
     await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', 8001)
+    site = web.TCPSite(runner, '0.0.0.0', port)
     await site.start()
+    lag_monitor = asyncio.create_task(monitor_loop_lag())  # 保留引用，避免任务被回收
     
     print("多人贪吃蛇游戏服务器已启动！")
-    print(f"请访问: http://localhost:8001")
-    print(f"最多支持 {MAX_PLAYERS} 人同时游戏")
+    print(f"请访问: http://localhost:{port}")
+    print(f"每个房间最多 {max_players} 人，房间按需创建，场地 {arena[0]}x{arena[1]}")
+    if workers > 0:
+        print(f"多进程模式: {workers} 个工作进程，客户端直接连接端口 "
+              f"{worker_port(port, 0)}-{worker_port(port, workers - 1)}")
+    if encode_workers > 0:
+        print(f"帧编码池: {encode_workers} 个{'进程' if encode_pool == 'process' else '线程'}")
+    if not ws_compress:
+        print("已关闭 WebSocket 压缩")
+    if record_dir is not None:
+        print(f"对局录像保存在 {record_dir}，观战回放: http://localhost:{port}/?replay=<录像文件>")
     
-    # 保持服务器运行
-    await asyncio.Event().wait()
+    # 保持服务器运行；收到 SIGTERM 或 Ctrl-C 时执行 on_cleanup（保存录像、停止工作进程）
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="多人贪吃蛇游戏服务器")
+    parser.add_argument("--port", type=int, default=8001, help="监听端口")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="工作进程数，0 表示单进程运行")
+    parser.add_argument("--encode-workers", type=int, default=ENCODE_WORKERS,
+                        help="帧编码池大小，0 表示在事件循环中编码")
+    parser.add_argument("--encode-pool", choices=["thread", "process"], default="thread",
+                        help="帧编码池类型")
+    parser.add_argument("--arena-width", type=int, default=GRID_WIDTH,
+                        help="场地宽度（格子数），超过视野时只向每个玩家发送其视野附近的实体")
+    parser.add_argument("--arena-height", type=int, default=GRID_HEIGHT, help="场地高度（格子数）")
+    parser.add_argument("--max-players", type=int, default=MAX_PLAYERS,
+                        help="每个房间的人数上限，大场地可以容纳数百条蛇")
+    parser.add_argument("--no-ws-compress", dest="ws_compress", action="store_false",
+                        help="不协商 permessage-deflate，带宽充足而CPU紧张时使用")
+    parser.add_argument("--record-dir", default=None,
+                        help="对局录像目录，不指定则不录像")
+    args = parser.parse_args()
+    if args.workers > 0 and args.encode_pool == "process":
+        parser.error("多进程模式下帧编码池只能使用线程")
+    if args.arena_width < 11 or args.arena_height < 11:
+        parser.error("场地至少为 11x11")
+    if args.max_players < 1:
+        parser.error("每个房间至少容纳 1 人")
     try:
-        asyncio.run(main())
+        asyncio.run(main(args.port, args.workers, args.encode_workers, args.encode_pool,
+                         (args.arena_width, args.arena_height), args.max_players, args.ws_compress,
+                         args.record_dir))
     except KeyboardInterrupt:
         print("服务器已关闭")
 
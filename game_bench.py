@@ -0,0 +1,481 @@
+"""多人贪吃蛇性能基准
+
+直接驱动 game.Game，不经过网络。
+
+用法:
+    python game_bench.py body            # 不同蛇长下的单次tick耗时
+    python game_bench.py arena           # 大场地上不同玩家数的tick耗时
+    python game_bench.py compress        # 不同客户端数下 permessage-deflate 的CPU开销与节省的字节
+    python game_bench.py suite           # 各场景下 update / generate_food / get_state 的耗时与每玩家内存
+    python game_bench.py suite --save baseline.json      # 保存基线
+    python game_bench.py suite --compare baseline.json   # 与基线对比，回退超过阈值时返回非零
+    python game_bench.py check           # 碰撞规则用例与随机对局的一致性检查，失败时返回非零
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import zlib
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple
+
+import game
+
+def build_long_snake(length: int) -> game.Game:
+    """构造一条指定长度的蛇，蛇头沿空行向右移动"""
+    width = 400
+    height = max(8, (length + width - 1) // width + 2)
+    g = game.Game(width=width, height=height)
+
+    # 蛇头位于最后一行，身体按行填充场地下方区域
+    cells = [(0, height - 1)]
+    for index in range(length - 1):
+        cells.append((index % width, index // width))
+
+    player = g.add_player("bench", "bench", None, body=game.SnakeBody(cells))
+    player.direction = game.DIRECTIONS["right"]
+    return g
+
+def bench_tick(length: int, ticks: int) -> float:
+    """返回平均每tick耗时（微秒）"""
+    g = build_long_snake(length)
+    start = time.perf_counter()
+    for _ in range(ticks):
+        g.update()
+    elapsed = time.perf_counter() - start
+    assert g.players["bench"].alive
+    return elapsed / ticks * 1e6
+
+def seeded_game(seed: int, width: int, height: int, players: int) -> game.Game:
+    """用固定种子构造游戏，相同参数得到相同的初始状态"""
+    g = game.Game(width=width, height=height, seed=seed)
+    for index in range(players):
+        g.add_player(f"bot{index}", f"bot{index}", None)
+    return g
+
+def steer(g: game.Game, rng: random.Random, turn_rate: float = 0.2):
+    """随机转向"""
+    directions = list(game.DIRECTIONS.values())
+    for player in g.players.values():
+        if rng.random() < turn_rate:
+            g.queue_input(player, rng.choice(directions))
+
+def broadcast_frames(g: game.Game, tick: int, proto: str) -> bytes:
+    """一tick广播的帧：首帧和周期性关键帧为完整状态，其余为增量"""
+    kind = "game_state" if tick % game.KEYFRAME_INTERVAL == 0 else "game_delta"
+    return g.encoded(kind + ("_bin" if proto == "bin" else ""))
+
+def deflate_frame(context, frame: bytes) -> int:
+    """按 permessage-deflate 压缩一帧（共享上下文，去掉同步标记），返回压缩后字节数"""
+    return len(context.compress(frame) + context.flush(zlib.Z_SYNC_FLUSH)) - 4
+
+class Scenario(NamedTuple):
+    """基准场景：玩家数、蛇长、场地大小和食物数"""
+    players: int
+    length: int
+    width: int
+    height: int
+    food: int
+
+SCENARIOS = {
+    "default": Scenario(players=10, length=3, width=game.GRID_WIDTH, height=game.GRID_HEIGHT, food=5),
+    "crowded": Scenario(players=40, length=50, width=100, height=100, food=20),
+    "long": Scenario(players=10, length=1000, width=400, height=60, food=5),
+    "many": Scenario(players=300, length=10, width=1000, height=1000, food=100),
+}
+
+def scenario_bodies(scenario: Scenario) -> Iterator[game.SnakeBody]:
+    """每名玩家占据若干行，蛇头在首行向右移动，身体按行折叠在下方
+    
+    蛇头所在行只有蛇头，移动不超过场地宽度的tick数内不会发生碰撞。
+    """
+    rows = (scenario.length - 2) // scenario.width + 2
+    if scenario.players * rows > scenario.height:
+        raise SystemExit(f"场地高度 {scenario.height} 放不下 {scenario.players} 条长度为 {scenario.length} 的蛇")
+    for index in range(scenario.players):
+        top = index * rows
+        yield game.SnakeBody([(0, top)] + [(i % scenario.width, top + 1 + i // scenario.width)
+                                           for i in range(scenario.length - 1)])
+
+def add_bodies(g: game.Game, bodies: Iterable[game.SnakeBody]):
+    for index, body in enumerate(bodies):
+        g.add_player(f"bot{index}", f"bot{index}", None, body=body)
+
+def build_scenario(scenario: Scenario, seed: int = 1) -> game.Game:
+    """按场景构造游戏"""
+    g = game.Game(width=scenario.width, height=scenario.height, seed=seed)
+    add_bodies(g, scenario_bodies(scenario))
+    return g
+
+def best_of(measure: Callable[[], List[float]], repeat: int) -> Dict[str, float]:
+    """重复测量，返回单次耗时（微秒）的最小值和中位数；最小值受干扰最少，用于对比
+    
+    与 timeit 一样在测量期间关闭垃圾回收，并先空跑一轮预热。
+    """
+    measure()
+    samples = []
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            samples.extend(measure())
+    finally:
+        if enabled:
+            gc.enable()
+    return {"min_us": min(samples) * 1e6, "median_us": statistics.median(samples) * 1e6}
+
+def suite_scenario(scenario: Scenario, args) -> Dict[str, float]:
+    """一个场景的全部指标"""
+    # 食物数是模块级配置，只在本场景内替换
+    food_count, game.FOOD_COUNT = game.FOOD_COUNT, scenario.food
+    try:
+        ticks = min(args.ticks, scenario.width - 1)
+        
+        def update():
+            g = build_scenario(scenario, args.seed)
+            g.generate_food()
+            start = time.perf_counter()
+            for _ in range(ticks):
+                g.update()
+            return [(time.perf_counter() - start) / ticks]
+        
+        def generate_food():
+            # 新建的场地没有食物，一次调用补满全部食物
+            g = build_scenario(scenario, args.seed)
+            start = time.perf_counter()
+            g.generate_food()
+            return [time.perf_counter() - start]
+        
+        def get_state():
+            # 每次先推进一个tick，快照需要重新发布，与广播时的开销一致
+            g = build_scenario(scenario, args.seed)
+            g.generate_food()
+            samples = []
+            for _ in range(ticks):
+                g.update()
+                start = time.perf_counter()
+                json.dumps(g.get_state())
+                samples.append(time.perf_counter() - start)
+            return samples
+        
+        results = {}
+        for name, measure in (("update", update), ("generate_food", generate_food),
+                              ("get_state_json", get_state)):
+            for stat, value in best_of(measure, args.repeat).items():
+                results[f"{name}.{stat}"] = value
+        
+        # 每玩家内存：在空场地上加入全部玩家（含蛇身），tracemalloc 记录的分配差
+        g = build_scenario(scenario._replace(players=0), args.seed)
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        add_bodies(g, scenario_bodies(scenario))
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        results["memory.per_player_bytes"] = (after - before) / scenario.players
+    finally:
+        game.FOOD_COUNT = food_count
+    return results
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+def cmd_suite(args):
+    """运行基准场景；--save 保存为基线，--compare 与基线对比"""
+    scenarios = {name: SCENARIOS[name] for name in args.scenarios}
+    if args.players is not None:
+        # 命令行指定的自定义场景，未给出的参数取 default 场景
+        base = SCENARIOS["default"]
+        scenarios = {"custom": Scenario(
+            players=args.players,
+            length=args.length if args.length is not None else base.length,
+            width=args.width if args.width is not None else base.width,
+            height=args.height if args.height is not None else base.height,
+            food=args.food if args.food is not None else base.food,
+        )}
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    
+    results = {}
+    regressions = []
+    print(f"每项重复 {args.repeat} 次，回退阈值 {args.threshold:.0%}")
+    print(f"{'场景/指标':<40} {'本次':>12}" + (f" {'基线':>12} {'变化':>9}" if baseline else ""))
+    for name, scenario in scenarios.items():
+        results[name] = suite_scenario(scenario, args)
+        for metric, value in results[name].items():
+            line = f"{name + '/' + metric:<40} {value:>12.2f}"
+            old = (baseline or {}).get(name, {}).get(metric)
+            if old:
+                change = (value - old) / old
+                line += f" {old:>12.2f} {change:>+9.1%}"
+                # 中位数只作参考，回退判断使用最小值和内存
+                if change > args.threshold and not metric.endswith("median_us"):
+                    line += "  回退"
+                    regressions.append(f"{name}/{metric}")
+            print(line)
+    
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({
+                "revision": git_revision(),
+                "scenarios": {name: scenario._asdict() for name, scenario in scenarios.items()},
+                "results": results,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"基线已保存到 {args.save}")
+    if regressions:
+        print(f"{len(regressions)} 项超过阈值: {', '.join(regressions)}")
+        raise SystemExit(1)
+
+def cmd_body(args):
+    print(f"{'蛇长':>10} {'每tick(us)':>12}")
+    for length in args.lengths:
+        print(f"{length:>10} {bench_tick(length, args.ticks):>12.2f}")
+
+def cmd_arena(args):
+    print(f"场地 {args.width}x{args.height}，{args.ticks} ticks")
+    print(f"{'玩家':>8} {'每tick(ms)':>12} {'ticks/s':>10} {'存活':>6}")
+    for players in args.players:
+        g = seeded_game(args.seed, args.width, args.height, players)
+        rng = random.Random(args.seed)
+        elapsed = 0.0
+        for _ in range(args.ticks):
+            steer(g, rng)
+            start = time.perf_counter()
+            g.generate_food()
+            g.update()
+            elapsed += time.perf_counter() - start
+        alive = sum(player.alive for player in g.players.values())
+        per_tick = elapsed / args.ticks
+        print(f"{players:>8} {per_tick * 1000:>12.3f} {1 / per_tick:>10.0f} {alive:>6}")
+
+def cmd_compress(args):
+    """每个连接各有一个压缩上下文，CPU开销随客户端数线性增长；模拟本身不计时"""
+    print(f"{args.proto} 帧，{args.ticks} ticks，压缩级别 {args.level}")
+    print(f"{'客户端':>8} {'模式':>10} {'每tick(ms)':>12} {'每客户端字节/tick':>18} {'节省':>8} {'每KB耗时(us)':>13}")
+    for clients in args.clients:
+        # 客户端按房间上限分到若干房间，同一房间的客户端收到相同的帧
+        rooms = (clients + game.MAX_PLAYERS - 1) // game.MAX_PLAYERS
+        frames = []
+        for index in range(rooms):
+            members = min(game.MAX_PLAYERS, clients - index * game.MAX_PLAYERS)
+            g = seeded_game(args.seed + index, game.GRID_WIDTH, game.GRID_HEIGHT, members)
+            rng = random.Random(args.seed + index)
+            room_frames = []
+            for tick in range(args.ticks):
+                steer(g, rng)
+                g.generate_food()
+                g.update()
+                room_frames.append(broadcast_frames(g, tick, args.proto))
+            frames.extend([room_frames] * members)
+        
+        raw = sum(len(frame) for client_frames in frames for frame in client_frames)
+        for mode in ("off", "deflate"):
+            sent = 0
+            start = time.perf_counter()
+            for client_frames in frames:
+                if mode == "off":
+                    sent += sum(len(frame) for frame in client_frames)
+                    continue
+                context = zlib.compressobj(args.level, zlib.DEFLATED, -15)
+                for frame in client_frames:
+                    sent += deflate_frame(context, frame)
+            elapsed = time.perf_counter() - start if mode != "off" else 0.0
+            saved = raw - sent
+            cost = elapsed * 1e6 / (saved / 1024) if saved > 0 else 0.0
+            print(f"{clients:>8} {mode:>10} {elapsed / args.ticks * 1000:>12.3f} "
+                  f"{sent / clients / args.ticks:>18.1f} {saved / raw:>8.1%} {cost:>13.2f}")
+
+# 碰撞规则用例：名称、各条蛇的初始蛇身（蛇头在前）与方向、一个tick后各条蛇是否存活
+CHECK_CASES = [
+    # 两个蛇头进入同一格，都死亡
+    ("head-on", [([(5, 5), (4, 5), (3, 5)], "right"), ([(7, 5), (8, 5), (9, 5)], "left")],
+     [False, False]),
+    # 蛇头互换位置：各自撞上对方的蛇头
+    ("head-swap", [([(5, 5), (4, 5), (3, 5)], "right"), ([(6, 5), (7, 5), (8, 5)], "left")],
+     [False, False]),
+    # 前两条迎面相撞；第三条进入第一条的尾巴，第四条进入第三条的尾巴，死亡沿链条传递
+    ("chain", [([(5, 5), (4, 5), (3, 5)], "right"), ([(7, 5), (8, 5), (9, 5)], "left"),
+               ([(3, 6), (3, 7), (3, 8)], "up"), ([(4, 8), (5, 8), (6, 8)], "left")],
+     [False, False, False, False]),
+    # 进入存活且前进的蛇的尾巴
+    ("live-tail", [([(5, 5), (4, 5), (3, 5)], "right"), ([(3, 6), (3, 7), (3, 8)], "up")],
+     [True, True]),
+    # 蛇头进入自己刚离开的尾巴格
+    ("self-tail", [([(5, 5), (6, 5), (6, 6), (5, 6)], "down")], [True]),
+    # 两条蛇互相追尾，都能前进
+    ("cycle", [([(5, 5), (6, 5)], "down"), ([(6, 6), (5, 6)], "up")], [True, True]),
+]
+
+def consistency_errors(g: game.Game) -> List[str]:
+    """网格、食物、空闲集合与蛇身是否一致；死蛇的身体可被穿过，只要求存活的蛇互不重叠"""
+    errors = []
+    owners = {}
+    for player in g.players.values():
+        if g.slots[player.slot] is not player:
+            errors.append(f"玩家 {player.id} 的槽位 {player.slot} 不指向自己")
+        if set(player.body) != player.body.members or len(player.body.members) != len(player.body):
+            errors.append(f"玩家 {player.id} 的蛇身与集合镜像不一致")
+        if not player.alive:
+            continue
+        for pos in player.body:
+            index = g.cell_index(pos)
+            if index in owners:
+                errors.append(f"玩家 {player.id} 与 {owners[index]} 在 {pos} 重叠")
+            owners[index] = player.id
+            if g.grid[index] != player.slot:
+                errors.append(f"玩家 {player.id} 的格子 {pos} 在网格中为 {g.grid[index]}")
+    if sum(slot is not None for slot in g.slots) != len(g.players):
+        errors.append("存在不属于任何玩家的槽位")
+    for index, value in enumerate(g.grid):
+        pos = (index % g.width, index // g.width)
+        if (value == game.FOOD) != (index in g.foods):
+            errors.append(f"{pos} 的食物与网格不一致")
+        if (value == game.EMPTY) != (index in g.free):
+            errors.append(f"{pos} 的空闲集合与网格不一致")
+        if value >= 0 and (value >= len(g.slots) or g.slots[value] is None
+                           or pos not in g.slots[value].body):
+            errors.append(f"{pos} 在网格中属于槽位 {value}，但不在该玩家的蛇身中")
+    return errors
+
+def check_case(name: str, snakes, expected: List[bool]) -> List[str]:
+    """运行一个碰撞用例一个tick，返回不符合预期之处"""
+    g = game.Game(width=20, height=20, seed=1)
+    players = []
+    for index, (cells, direction) in enumerate(snakes):
+        player = g.add_player(f"s{index}", f"s{index}", None, body=game.SnakeBody(cells))
+        player.direction = game.DIRECTIONS[direction]
+        players.append(player)
+    heads = [player.body.head for player in players]
+    g.update()
+    
+    errors = []
+    for player, head, alive in zip(players, heads, expected):
+        dx, dy = player.direction
+        moved = player.body.head == ((head[0] + dx) % g.width, (head[1] + dy) % g.height)
+        if player.alive != alive or moved != alive:
+            errors.append(f"{player.id} 预期{'存活并前进' if alive else '死亡并留在原地'}，"
+                          f"实际 alive={player.alive} 蛇身={player.body.to_list()}")
+    return [f"{name}: {error}" for error in errors + consistency_errors(g)]
+
+def check_seed(seed: int, args, directory: str) -> List[str]:
+    """带录像运行一局随机对局，每tick检查一致性，最后回放并校验状态摘要"""
+    path = os.path.join(directory, f"{seed}.snkr")
+    g = game.Game(width=args.width, height=args.height, seed=seed)
+    g.recorder = game.ReplayRecorder(path, g)
+    rng = random.Random(seed)
+    try:
+        for tick in range(args.ticks):
+            # 前若干tick陆续加入，之后死亡的玩家随机重新加入；场地太小找不到出生位置时跳过
+            for player_id in ([f"bot{tick}"] if tick < args.players else
+                              [p.id for p in g.players.values() if not p.alive and rng.random() < 0.2]):
+                try:
+                    g.add_player(player_id, player_id, None)
+                except ValueError:
+                    pass
+            steer(g, rng, 0.3)
+            g.generate_food()
+            g.update()
+            g.flush_delta()
+            errors = consistency_errors(g)
+            if errors:
+                return [f"种子 {seed} tick {g.tick}: {error}" for error in errors]
+    finally:
+        g.recorder.close()
+    
+    replay = game.Replay(path)
+    try:
+        replay.fast_forward()
+    except ValueError as e:
+        return [f"种子 {seed} 回放: {e}"]
+    if replay.game.state_hash() != g.state_hash():
+        return [f"种子 {seed} 回放: 结束状态与原对局不一致"]
+    return []
+
+def cmd_check(args):
+    """碰撞规则用例，以及随机对局中网格/空闲集合/蛇身的一致性和录像回放；失败时返回非零"""
+    failures = []
+    for name, snakes, expected in CHECK_CASES:
+        errors = check_case(name, snakes, expected)
+        print(f"{name:<12} {'失败' if errors else '通过'}")
+        failures += errors
+    
+    start = time.perf_counter()
+    failed_seeds = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for seed in range(args.seed, args.seed + args.seeds):
+            errors = check_seed(seed, args, directory)
+            failed_seeds += bool(errors)
+            failures += errors
+    print(f"随机对局 {args.seeds} 个种子（场地 {args.width}x{args.height}，{args.players} 名玩家，"
+          f"{args.ticks} ticks）: {failed_seeds} 个失败，耗时 {time.perf_counter() - start:.1f}s")
+    
+    for failure in failures[:20]:
+        print(f"  {failure}")
+    if failures:
+        raise SystemExit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description="多人贪吃蛇性能基准")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    body = sub.add_parser("body", help="不同蛇长下的单次tick耗时")
+    body.add_argument("--lengths", type=int, nargs="+", default=[10, 1000, 100000])
+    body.add_argument("--ticks", type=int, default=300)
+    body.set_defaults(func=cmd_body)
+
+    arena = sub.add_parser("arena", help="大场地上不同玩家数的tick耗时")
+    arena.add_argument("--players", type=int, nargs="+", default=[300, 1000])
+    arena.add_argument("--width", type=int, default=1000)
+    arena.add_argument("--height", type=int, default=1000)
+    arena.add_argument("--ticks", type=int, default=200)
+    arena.add_argument("--seed", type=int, default=1)
+    arena.set_defaults(func=cmd_arena)
+
+    compress = sub.add_parser("compress", help="不同客户端数下 permessage-deflate 的CPU开销与节省的字节")
+    compress.add_argument("--clients", type=int, nargs="+", default=[10, 100, 1000])
+    compress.add_argument("--proto", choices=["json", "bin"], default="json")
+    compress.add_argument("--level", type=int, default=zlib.Z_DEFAULT_COMPRESSION,
+                          help="压缩级别，默认与 aiohttp 相同")
+    compress.add_argument("--ticks", type=int, default=200)
+    compress.add_argument("--seed", type=int, default=1)
+    compress.set_defaults(func=cmd_compress)
+    
+    suite = sub.add_parser("suite", help="各场景下 update / generate_food / get_state 的耗时与每玩家内存")
+    suite.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    suite.add_argument("--players", type=int, help="自定义场景的玩家数，指定后忽略 --scenarios")
+    suite.add_argument("--length", type=int, help="自定义场景的蛇长")
+    suite.add_argument("--width", type=int, help="自定义场景的场地宽度")
+    suite.add_argument("--height", type=int, help="自定义场景的场地高度")
+    suite.add_argument("--food", type=int, help="自定义场景的食物数（FOOD_COUNT）")
+    suite.add_argument("--ticks", type=int, default=100, help="每轮tick数，不超过场地宽度减一")
+    suite.add_argument("--repeat", type=int, default=20)
+    suite.add_argument("--seed", type=int, default=1)
+    suite.add_argument("--save", help="把结果保存为基线JSON")
+    suite.add_argument("--compare", help="与基线JSON对比")
+    suite.add_argument("--threshold", type=float, default=0.15, help="耗时或内存增加超过该比例视为回退")
+    suite.set_defaults(func=cmd_suite)
+    
+    check = sub.add_parser("check", help="碰撞规则用例与随机对局的一致性检查")
+    check.add_argument("--seeds", type=int, default=300)
+    check.add_argument("--seed", type=int, default=0, help="第一个种子")
+    check.add_argument("--players", type=int, default=10)
+    check.add_argument("--ticks", type=int, default=110, help="每局tick数，超过 REPLAY_HASH_INTERVAL 时回放会校验摘要")
+    check.add_argument("--width", type=int, default=game.GRID_WIDTH)
+    check.add_argument("--height", type=int, default=game.GRID_HEIGHT)
+    check.set_defaults(func=cmd_check)
+    
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
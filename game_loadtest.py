@@ -0,0 +1,544 @@
+"""多人贪吃蛇压测工具
+
+启动大量 asyncio 机器人客户端连接服务器，每个机器人加入房间、转向、聊天并定期 ping，
+统计实际tick频率、帧间隔、ping往返延迟、丢帧数，以及服务器进程的CPU和内存。
+结果写成JSON报告，可与之前版本的报告对比。
+
+用法:
+    python game_loadtest.py --spawn --clients 500 --duration 30
+    python game_loadtest.py --url http://127.0.0.1:8001 --server-pid 1234 --clients 1000
+    python game_loadtest.py --spawn --clients 500 --report new.json --compare old.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import struct
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+from yarl import URL
+
+import game
+
+PING_INTERVAL = 1.0  # 每个机器人的 ping 间隔（秒）
+SAMPLE_INTERVAL = 1.0  # 服务器进程CPU和内存的采样间隔（秒）
+CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+@dataclass
+class BotStats:
+    """单个机器人在测量窗口内的统计"""
+    connected: bool = False
+    disconnected: bool = False
+    error: Optional[str] = None
+    frames: int = 0
+    keyframes: int = 0
+    missed: int = 0  # 序号不连续跳过的帧数
+    resyncs: int = 0
+    bytes: int = 0
+    first_tick: Optional[Tuple[int, float]] = None  # (tick, 到达时间)
+    last_tick: Optional[Tuple[int, float]] = None
+    gaps: List[float] = field(default_factory=list)  # 相邻帧的到达间隔（秒）
+    latencies: List[float] = field(default_factory=list)  # ping 往返时间（秒）
+
+    @property
+    def tick_rate(self) -> Optional[float]:
+        """客户端观察到的tick频率"""
+        if self.first_tick is None or self.last_tick is None:
+            return None
+        elapsed = self.last_tick[1] - self.first_tick[1]
+        if elapsed <= 0:
+            return None
+        return (self.last_tick[0] - self.first_tick[0]) / elapsed
+
+class Bot:
+    """脚本化的机器人客户端；ai 行为会维护场上状态，朝最近的食物移动并避开蛇身"""
+    def __init__(self, index: int, args, measure_from: float):
+        self.index = index
+        self.args = args
+        self.measure_from = measure_from
+        self.stats = BotStats()
+        self.rng = random.Random(args.seed + index)
+        self.player_id = f"bot{index}"
+        self.direction: Optional[str] = None
+        self.last_seq: Optional[int] = None
+        self.last_frame: Optional[float] = None
+        # ai 行为使用的本地状态
+        self.players: Dict[str, dict] = {}
+        self.foods: Dict[str, dict] = {}
+        self.size = (game.GRID_WIDTH, game.GRID_HEIGHT)
+
+    @property
+    def measuring(self) -> bool:
+        return time.monotonic() >= self.measure_from
+
+    async def run(self, session: aiohttp.ClientSession, stop_at: float):
+        query = f"?proto={self.args.proto}" + (f"&room={self.args.room}" if self.args.room else "")
+        try:
+            ws_url = self.args.url + "/ws"
+            if not self.args.proxy:
+                ws_url = await resolve_ws_url(session, self.args.url, self.args.room)
+            async with session.ws_connect(ws_url + query,
+                                          compress=15 if self.args.compress else 0) as ws:
+                self.stats.connected = True
+                await ws.send_str(json.dumps({
+                    "type": "join",
+                    "player_id": self.player_id,
+                    "name": self.player_id,
+                    "proto": self.args.proto,
+                    "batch": True
+                }))
+                actor = asyncio.create_task(self.act(ws, stop_at))
+                try:
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            self.on_text(ws, msg.data)
+                        elif msg.type == aiohttp.WSMsgType.BINARY:
+                            self.on_binary(ws, msg.data)
+                        if time.monotonic() >= stop_at:
+                            break
+                    else:
+                        self.stats.disconnected = True
+                finally:
+                    actor.cancel()
+        except Exception as e:
+            self.stats.error = f"{type(e).__name__}: {e}"
+
+    async def act(self, ws, stop_at: float):
+        """按设定频率转向、聊天和 ping，总消息数保持在服务器限流以内"""
+        interval = 1.0 / self.args.action_rate
+        next_ping = time.monotonic() + self.rng.random() * PING_INTERVAL
+        await asyncio.sleep(self.rng.random() * interval)
+        try:
+            while time.monotonic() < stop_at:
+                now = time.monotonic()
+                if now >= next_ping:
+                    next_ping = now + PING_INTERVAL
+                    await ws.send_str(json.dumps({"type": "ping", "t": time.perf_counter()}))
+                direction = self.choose_direction()
+                if direction is not None and direction != self.direction:
+                    self.direction = direction
+                    await ws.send_str(json.dumps({"type": "change_direction", "direction": direction}))
+                if self.rng.random() < self.args.chat_rate * interval:
+                    await ws.send_str(json.dumps({"type": "chat", "message": f"hello from {self.player_id}"}))
+                await asyncio.sleep(interval)
+        except (ConnectionResetError, aiohttp.ClientError):
+            pass
+
+    def choose_direction(self) -> Optional[str]:
+        if self.args.behavior == "random":
+            return self.rng.choice(list(game.DIRECTIONS)) if self.rng.random() < 0.3 else None
+        me = self.players.get(self.player_id)
+        if me is None or not me["alive"] or not me["body"]:
+            return None
+
+        width, height = self.size
+        head_x, head_y = me["body"][0]
+        occupied = {tuple(cell) for player in self.players.values() for cell in player["body"]}
+        current = game.DIRECTIONS.get(self.direction)
+
+        def distance(x, y):
+            if not self.foods:
+                return 0
+            return min(min(abs(x - f["x"]), width - abs(x - f["x"]))
+                       + min(abs(y - f["y"]), height - abs(y - f["y"]))
+                       for f in self.foods.values())
+
+        choices = []
+        for name, (dx, dy) in game.DIRECTIONS.items():
+            if current is not None and (dx, dy) == (-current[0], -current[1]):
+                continue
+            x, y = (head_x + dx) % width, (head_y + dy) % height
+            if (x, y) not in occupied:
+                choices.append((distance(x, y), self.rng.random(), name))
+        return min(choices)[2] if choices else None
+
+    def on_frame(self, ws, seq: int, tick: int, keyframe: bool):
+        """统计一帧；序号不连续时跳过的帧计为丢帧，并像浏览器客户端一样请求重新同步"""
+        now = time.monotonic()
+        gap = None
+        if self.last_seq is not None and seq > self.last_seq + 1:
+            gap = seq - self.last_seq - 1
+        if self.measuring:
+            stats = self.stats
+            stats.frames += 1
+            stats.keyframes += keyframe
+            if gap:
+                stats.missed += gap
+            if self.last_frame is not None and stats.frames > 1:
+                stats.gaps.append(now - self.last_frame)
+            if stats.first_tick is None:
+                stats.first_tick = (tick, now)
+            stats.last_tick = (tick, now)
+        self.last_frame = now
+        if gap and not keyframe:
+            if self.measuring:
+                self.stats.resyncs += 1
+            asyncio.ensure_future(ws.send_str(json.dumps({"type": "resync"})))
+            self.last_seq = None
+            return
+        self.last_seq = seq
+
+    def on_text(self, ws, raw: str):
+        if self.measuring:
+            self.stats.bytes += len(raw)
+        data = json.loads(raw)
+        messages = data if isinstance(data, list) else [data]
+        for message in messages:
+            kind = message.get("type")
+            if kind == "pong":
+                if self.measuring and message.get("t") is not None:
+                    self.stats.latencies.append(time.perf_counter() - message["t"])
+            elif kind == "game_state":
+                if self.args.behavior == "ai":
+                    self.load_keyframe(message["data"])
+                self.on_frame(ws, message["seq"], message["tick"], True)
+            elif kind == "game_delta":
+                if self.args.behavior == "ai" and self.last_seq is not None and message["seq"] == self.last_seq + 1:
+                    self.apply_delta(message["data"])
+                self.on_frame(ws, message["seq"], message["tick"], False)
+
+    def on_binary(self, ws, data: bytes):
+        if self.measuring:
+            self.stats.bytes += len(data)
+        frame_type, _, seq, tick = struct.unpack_from("<BBII", data)
+        self.on_frame(ws, seq, tick, frame_type == game.BIN_KEYFRAME)
+
+    def load_keyframe(self, data: dict):
+        self.players = {player["id"]: player for player in data["players"]}
+        self.foods = {food["id"]: food for food in data["foods"]}
+        self.size = (data["grid_width"], data["grid_height"])
+
+    def apply_delta(self, data: dict):
+        for player_id in data.get("left", []):
+            self.players.pop(player_id, None)
+        for player in data.get("joined", []):
+            self.players[player["id"]] = player
+        for player_id, move in data.get("moves", {}).items():
+            player = self.players.get(player_id)
+            if player is None:
+                continue
+            for head in move["heads"]:
+                player["body"].insert(0, head)
+            if move["tails"]:
+                del player["body"][-move["tails"]:]
+        for player_id, change in data.get("changed", {}).items():
+            if player_id in self.players:
+                self.players[player_id].update(change)
+        for food_id in data.get("foods_removed", []):
+            self.foods.pop(food_id, None)
+        for food in data.get("foods_added", []):
+            self.foods[food["id"]] = food
+
+class ProcessSampler:
+    """通过 /proc 定期采样服务器进程（含多进程模式的工作进程）的CPU和内存"""
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.cpu: List[float] = []  # 每个采样区间的CPU占用（100% 为一个核）
+        self.rss: List[float] = []  # 每次采样的常驻内存（MB）
+
+    @staticmethod
+    def available() -> bool:
+        return os.path.exists("/proc/self/stat")
+
+    def pids(self) -> List[int]:
+        """服务器进程及其子进程"""
+        pids = [self.pid]
+        for name in os.listdir("/proc"):
+            if name.isdigit():
+                try:
+                    with open(f"/proc/{name}/stat") as f:
+                        fields = f.read().rsplit(")", 1)[1].split()
+                except OSError:
+                    continue
+                if int(fields[1]) == self.pid:
+                    pids.append(int(name))
+        return pids
+
+    def read(self) -> Tuple[float, float]:
+        """返回 (累计CPU秒数, 常驻内存MB)"""
+        cpu = rss = 0.0
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                with open(f"/proc/{pid}/statm") as f:
+                    pages = int(f.read().split()[1])
+            except OSError:
+                continue
+            cpu += (int(fields[11]) + int(fields[12])) / CLK_TCK
+            rss += pages * PAGE_SIZE / 2 ** 20
+        return cpu, rss
+
+    async def run(self, measure_from: float, stop_at: float):
+        await asyncio.sleep(max(0.0, measure_from - time.monotonic()))
+        last_cpu, _ = self.read()
+        last_time = time.monotonic()
+        while time.monotonic() < stop_at:
+            await asyncio.sleep(SAMPLE_INTERVAL)
+            cpu, rss = self.read()
+            now = time.monotonic()
+            self.cpu.append((cpu - last_cpu) / (now - last_time) * 100)
+            self.rss.append(rss)
+            last_cpu, last_time = cpu, now
+
+def percentiles(values: List[float], scale: float = 1.0) -> dict:
+    """p50/p95/p99/max，按 scale 换算单位"""
+    if not values:
+        return {}
+    values = sorted(values)
+    def at(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))] * scale, 3)
+    return {"p50": at(0.50), "p95": at(0.95), "p99": at(0.99), "max": round(values[-1] * scale, 3)}
+
+async def fetch_json(session: aiohttp.ClientSession, url: str) -> Optional[dict]:
+    try:
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=5)) as response:
+            return await response.json()
+    except Exception:
+        return None
+
+async def resolve_ws_url(session: aiohttp.ClientSession, url: str, room: Optional[str]) -> str:
+    """与浏览器客户端一致：多进程模式下按 /route 直接连接工作进程，没有 /route 时连接 /ws"""
+    route = None
+    try:
+        async with session.get(url + "/route", params={"room": room} if room else None,
+                               timeout=aiohttp.ClientTimeout(total=5)) as response:
+            if response.status == 200:
+                route = await response.json()
+    except aiohttp.ClientError:
+        pass
+    if route is None:
+        return url + "/ws"
+    return str(URL(url).with_port(route["port"]).with_path("/ws"))
+
+def server_summary(players: Optional[dict]) -> dict:
+    """汇总 /players 中各房间的调度与编码统计"""
+    if not players:
+        return {}
+    rooms = players.get("rooms", [])
+    schedulers = [room["scheduler"] for room in rooms if "scheduler" in room]
+    encoders = [room["encoder"] for room in rooms if "encoder" in room]
+    summary = {
+        "rooms": len(rooms),
+        "players": sum(room["player_count"] for room in rooms),
+    }
+    if schedulers:
+        summary.update({
+            "overruns": sum(s["overruns"] for s in schedulers),
+            "dropped_ticks": sum(s["dropped_ticks"] for s in schedulers),
+            "tick_avg_ms": round(sum(s["tick_avg_ms"] for s in schedulers) / len(schedulers), 3),
+            "tick_max_ms": round(max(s["tick_max_ms"] for s in schedulers), 3),
+            "jitter_max_ms": round(max(s["jitter_max_ms"] for s in schedulers), 3),
+        })
+    if encoders:
+        summary.update({
+            "encode_avg_ms": round(sum(e["encode_avg_ms"] for e in encoders) / len(encoders), 3),
+            "encode_max_ms": round(max(e["encode_max_ms"] for e in encoders), 3),
+        })
+    return summary
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+async def wait_for_server(session: aiohttp.ClientSession, url: str, timeout: float = 30.0):
+    """等待 /health 返回200，多进程模式下要等所有工作进程就绪"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(url + "/health") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise SystemExit(f"服务器 {url} 在 {timeout} 秒内没有就绪")
+
+async def run_load(args) -> dict:
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await wait_for_server(session, args.url)
+        start = time.monotonic()
+        measure_from = start + args.ramp + args.warmup
+        stop_at = measure_from + args.duration
+
+        sampler = None
+        if args.server_pid and ProcessSampler.available():
+            sampler = ProcessSampler(args.server_pid)
+            sampler_task = asyncio.create_task(sampler.run(measure_from, stop_at))
+        usage_before = resource.getrusage(resource.RUSAGE_SELF)
+
+        # 在 ramp 秒内均匀建立连接
+        bots = [Bot(index, args, measure_from) for index in range(args.clients)]
+        tasks = []
+        for index, bot in enumerate(bots):
+            delay = start + args.ramp * index / args.clients - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(bot.run(session, stop_at)))
+
+        await asyncio.sleep(max(0.0, stop_at - time.monotonic() - 0.5))
+        players = await fetch_json(session, args.url + "/players")
+        await asyncio.wait(tasks, timeout=max(0.0, stop_at - time.monotonic()) + 5)
+        for task in tasks:
+            task.cancel()
+        if sampler is not None:
+            await sampler_task
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    return build_report(args, bots, players, sampler,
+                        usage.ru_utime + usage.ru_stime - usage_before.ru_utime - usage_before.ru_stime,
+                        time.monotonic() - start)
+
+def build_report(args, bots: List[Bot], players: Optional[dict], sampler: Optional[ProcessSampler],
+                 harness_cpu: float, elapsed: float) -> dict:
+    stats = [bot.stats for bot in bots]
+    frames = sum(s.frames for s in stats)
+    missed = sum(s.missed for s in stats)
+    rates = [rate for rate in (s.tick_rate for s in stats) if rate is not None]
+    errors: Dict[str, int] = {}
+    for s in stats:
+        if s.error:
+            errors[s.error] = errors.get(s.error, 0) + 1
+
+    report = {
+        "revision": git_revision(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "config": {
+            "clients": args.clients,
+            "duration": args.duration,
+            "proto": args.proto,
+            "behavior": args.behavior,
+            "action_rate": args.action_rate,
+            "chat_rate": args.chat_rate,
+            "compress": args.compress,
+            "proxy": args.proxy,
+            "server_args": args.server_args,
+        },
+        "clients": {
+            "connected": sum(s.connected for s in stats),
+            "failed": sum(not s.connected for s in stats),
+            "disconnected": sum(s.disconnected for s in stats),
+            "errors": errors,
+        },
+        "frames": {
+            "total": frames,
+            "per_client_per_sec": round(frames / len(stats) / args.duration, 3) if stats else 0,
+            "keyframes": sum(s.keyframes for s in stats),
+            "missed": missed,
+            "missed_ratio": round(missed / (frames + missed), 5) if frames + missed else 0,
+            "resyncs": sum(s.resyncs for s in stats),
+            "kb_per_client_per_sec": round(sum(s.bytes for s in stats) / 1024 / len(stats) / args.duration, 3)
+            if stats else 0,
+        },
+        "tick_rate": {
+            "mean": round(sum(rates) / len(rates), 3) if rates else None,
+            "min": round(min(rates), 3) if rates else None,
+        },
+        "frame_gap_ms": percentiles([gap for s in stats for gap in s.gaps], 1000),
+        "latency_ms": percentiles([latency for s in stats for latency in s.latencies], 1000),
+        "server": server_summary(players),
+        "harness_cpu_percent": round(harness_cpu / elapsed * 100, 1),
+    }
+    if sampler is not None and sampler.cpu:
+        report["process"] = {
+            "cpu_percent_avg": round(sum(sampler.cpu) / len(sampler.cpu), 1),
+            "cpu_percent_max": round(max(sampler.cpu), 1),
+            "rss_mb_max": round(max(sampler.rss), 1),
+        }
+    return report
+
+def flatten(report: dict, prefix: str = "") -> Dict[str, float]:
+    """把报告中的数值展开成 a.b.c 形式的键"""
+    values = {}
+    for key, value in report.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            values.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[name] = value
+    return values
+
+def print_report(report: dict, baseline: Optional[dict] = None):
+    current = flatten({key: report[key] for key in report if key != "config"})
+    previous = flatten(baseline) if baseline else {}
+    print(f"{'指标':<36} {'本次':>12}" + (f" {'基线':>12} {'变化':>9}" if baseline else ""))
+    for name, value in current.items():
+        line = f"{name:<36} {value:>12}"
+        if baseline:
+            old = previous.get(name)
+            if old is None:
+                line += f" {'-':>12} {'':>9}"
+            else:
+                change = f"{(value - old) / old:+.1%}" if old else ""
+                line += f" {old:>12} {change:>9}"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="多人贪吃蛇压测工具")
+    parser.add_argument("--url", default=None, help="服务器地址，默认 http://127.0.0.1:端口")
+    parser.add_argument("--port", type=int, default=8001, help="--spawn 时服务器监听的端口")
+    parser.add_argument("--spawn", action="store_true", help="启动本地服务器进程，结束后关闭")
+    parser.add_argument("--server-args", default="", help="--spawn 时传给 game.py 的参数")
+    parser.add_argument("--server-pid", type=int, default=None, help="采样该进程的CPU和内存")
+    parser.add_argument("--clients", type=int, default=100, help="机器人数量")
+    parser.add_argument("--duration", type=float, default=30, help="测量时长（秒）")
+    parser.add_argument("--ramp", type=float, default=5, help="在多少秒内建立全部连接")
+    parser.add_argument("--warmup", type=float, default=2, help="连接建立后等待多久开始测量（秒）")
+    parser.add_argument("--proto", choices=["json", "bin"], default="json")
+    parser.add_argument("--behavior", choices=["random", "ai"], default="random",
+                        help="ai 行为维护场上状态，朝最近的食物移动，需要 json 协议")
+    parser.add_argument("--action-rate", type=float, default=5, help="每个机器人每秒的行动次数")
+    parser.add_argument("--chat-rate", type=float, default=0.05, help="每个机器人每秒的聊天消息数")
+    parser.add_argument("--room", default=None, help="所有机器人加入指定房间，默认由服务器匹配")
+    parser.add_argument("--no-compress", dest="compress", action="store_false",
+                        help="不协商 permessage-deflate")
+    parser.add_argument("--proxy", action="store_true",
+                        help="多进程模式下经主进程 /ws 转发，而不是按 /route 直接连接工作进程")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--report", default=None, help="把报告写入该JSON文件")
+    parser.add_argument("--compare", default=None, help="与之前保存的报告对比")
+    args = parser.parse_args()
+    if args.behavior == "ai" and args.proto != "json":
+        parser.error("ai 行为需要 json 协议")
+    if args.action_rate + args.chat_rate + 1 / PING_INTERVAL > game.INPUT_RATE:
+        parser.error(f"每个机器人的消息频率不能超过服务器限流 {game.INPUT_RATE} 条/秒")
+    args.url = (args.url or f"http://127.0.0.1:{args.port}").rstrip("/")
+
+    server = None
+    if args.spawn:
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "game.py"),
+             "--port", str(args.port), *args.server_args.split()],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        args.server_pid = args.server_pid or server.pid
+    try:
+        report = asyncio.run(run_load(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"报告已写入 {args.report}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,943 @@
+// 游戏变量
+let playerId = null;
+let playerColor = "#FF5252";
+let playerName = "Player" + Math.floor(1000 + Math.random() * 9000);
+let ws = null;
+let gamePaused = false;
+
+// 客户端保存的游戏状态，由关键帧重建、由增量帧更新
+let gameState = null;
+let lastSeq = -1;
+let resyncPending = false;
+
+// 插值：最近一个权威tick的编号、到达时间和tick间隔（毫秒）
+let serverTick = -1;
+let tickArrival = 0;
+let tickInterval = 100;
+// 预测：自己的蛇按本地方向提前一个tick绘制，服务端确认转向前保留本地方向
+const DIRECTION_VECTORS = {up: [0, -1], down: [0, 1], left: [-1, 0], right: [1, 0]};
+let localDirection = null;
+let pendingTurn = null;
+
+// 默认使用二进制帧，URL 中 proto=json 时使用 JSON
+const useBinary = typeof DataView !== 'undefined' &&
+    new URLSearchParams(window.location.search).get('proto') !== 'json';
+// 同一玩家在新连接中加入时旧连接的关闭码，与服务端 WS_CLOSE_REPLACED 一致
+const WS_CLOSE_REPLACED = 4001;
+// URL 中带 replay=录像文件 时进入观战回放，可选 speed 倍速和 from 起始tick
+const replayFile = new URLSearchParams(window.location.search).get('replay');
+
+// 获取DOM元素
+const canvas = document.getElementById('gameCanvas');
+const ctx = canvas.getContext('2d');
+const statusEl = document.getElementById('status');
+const playerListEl = document.getElementById('playerList');
+const playerCountEl = document.getElementById('playerCount');
+const playerScoreEl = document.getElementById('playerScore');
+const gameSpeedEl = document.getElementById('gameSpeed');
+const chatLogEl = document.getElementById('chatLog');
+const chatInputEl = document.getElementById('chatInput');
+const sendBtn = document.getElementById('sendBtn');
+
+// 多进程模式下先查询房间所在的工作进程，直接连接它的端口；
+// 单进程模式没有 /route，HTTPS 下工作进程端口没有证书，这两种情况都连接本页的 /ws
+function resolveWebSocketUrl(protocol, room) {
+    const query = room ? `?room=${encodeURIComponent(room)}` : '';
+    const sameOrigin = `${protocol}//${window.location.host}/ws${query}`;
+    if (protocol === 'wss:') {
+        return Promise.resolve(sameOrigin);
+    }
+    return fetch(`/route${query}`)
+        .then(response => response.ok ? response.json() : null)
+        .then(route => route ? `${protocol}//${window.location.hostname}:${route.port}/ws${query}` : sameOrigin)
+        .catch(() => sameOrigin);
+}
+
+// 初始化WebSocket连接
+function connectWebSocket() {
+    const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+    const params = new URLSearchParams(window.location.search);
+    if (replayFile) {
+        const query = new URLSearchParams({file: replayFile, proto: useBinary ? 'bin' : 'json'});
+        ['speed', 'from'].forEach(key => {
+            if (params.get(key)) query.set(key, params.get(key));
+        });
+        openWebSocket(`${protocol}//${window.location.host}/replay?${query}`);
+    } else {
+        resolveWebSocketUrl(protocol, params.get('room')).then(openWebSocket);
+    }
+}
+
+function openWebSocket(wsUrl) {
+    ws = new WebSocket(wsUrl);
+    ws.binaryType = 'arraybuffer';
+
+    ws.onopen = function() {
+        console.log('已连接到服务器');
+        statusEl.textContent = '已连接到服务器';
+        statusEl.className = 'status connected';
+        if (replayFile) {
+            statusEl.textContent = `观战回放: ${replayFile}`;
+            return;
+        }
+
+        // 发送加入游戏消息
+        ws.send(JSON.stringify({
+            type: 'join',
+            player_id: localStorage.getItem('snakePlayerId') || generatePlayerId(),
+            name: localStorage.getItem('snakePlayerName') || playerName,
+            proto: useBinary ? 'bin' : 'json',
+            batch: true
+        }));
+    };
+
+    ws.onmessage = function(event) {
+        if (typeof event.data !== 'string') {
+            handleBinaryFrame(event.data);
+            return;
+        }
+
+        // 服务器会把同一批消息合并成数组发送
+        const data = JSON.parse(event.data);
+        if (Array.isArray(data)) {
+            data.forEach(handleMessage);
+        } else {
+            handleMessage(data);
+        }
+    };
+
+    ws.onclose = function(event) {
+        console.log('与服务器的连接已断开');
+        if (replayFile) {
+            // 回放结束后保留最后一帧，不重连
+            statusEl.textContent = '回放结束';
+            statusEl.className = 'status disconnected';
+            return;
+        }
+        if (event.code === WS_CLOSE_REPLACED) {
+            // 同一玩家在其他页面加入，重连会把对方挤下线
+            statusEl.textContent = '已在其他页面加入游戏';
+            statusEl.className = 'status disconnected';
+            return;
+        }
+        gameState = null;
+        lastSeq = -1;
+        resyncPending = false;
+        statusEl.textContent = '与服务器连接已断开，5秒后重连...';
+        statusEl.className = 'status disconnected';
+
+        // 5秒后重连
+        setTimeout(connectWebSocket, 5000);
+    };
+
+    ws.onerror = function(error) {
+        console.error('WebSocket错误:', error);
+        statusEl.textContent = '连接错误，请检查网络';
+        statusEl.className = 'status disconnected';
+    };
+}
+
+// 处理一条JSON消息
+function handleMessage(data) {
+    switch(data.type) {
+        case 'welcome':
+            playerId = data.player_id;
+            playerColor = data.color;
+            playerName = data.name;
+            statusEl.textContent = `已连接到服务器 (房间 ${data.room})`;
+
+            // 保存到本地存储
+            localStorage.setItem('snakePlayerId', playerId);
+            localStorage.setItem('snakePlayerName', playerName);
+
+            console.log(`欢迎，${playerName} (${playerId})`);
+            break;
+
+        case 'game_state': {
+            const previous = captureBodies(gameState);
+            gameState = loadKeyframe(data.data);
+            lastSeq = data.seq;
+            resyncPending = false;
+            finishFrame(gameState, previous, data.tick, data.tick_rate);
+            break;
+        }
+
+        case 'game_delta': {
+            if (!gameState || data.seq !== lastSeq + 1) {
+                requestResync();
+                break;
+            }
+            const previous = captureBodies(gameState);
+            applyDelta(gameState, data.data);
+            lastSeq = data.seq;
+            finishFrame(gameState, previous, data.tick, data.tick_rate);
+            break;
+        }
+
+        case 'chat':
+            addChatMessage(data.player, data.message, data.time);
+            break;
+
+        case 'error':
+            alert(data.message);
+            break;
+    }
+}
+
+// 生成玩家ID
+function generatePlayerId() {
+    return 'player_' + Date.now() + '_' + Math.random().toString(36).substr(2, 9);
+}
+
+// 由关键帧构建本地状态
+function loadKeyframe(data) {
+    const state = {
+        players: new Map(),
+        foods: new Map(),
+        grid_width: data.grid_width,
+        grid_height: data.grid_height,
+        speed: data.speed
+    };
+    for (const player of data.players) {
+        state.players.set(player.id, player);
+    }
+    for (const food of data.foods) {
+        state.foods.set(food.id, food);
+    }
+    return state;
+}
+
+// 应用增量帧
+function applyDelta(state, delta) {
+    for (const id of delta.left || []) {
+        state.players.delete(id);
+    }
+    for (const player of delta.joined || []) {
+        state.players.set(player.id, player);
+    }
+    for (const [id, move] of Object.entries(delta.moves || {})) {
+        const player = state.players.get(id);
+        if (!player) continue;
+        for (const head of move.heads) {
+            player.body.unshift(head);
+        }
+        for (let i = 0; i < move.tails; i++) {
+            player.body.pop();
+        }
+    }
+    for (const [id, change] of Object.entries(delta.changed || {})) {
+        const player = state.players.get(id);
+        if (player) {
+            player.score = change.score;
+            player.alive = change.alive;
+        }
+    }
+    for (const id of delta.foods_removed || []) {
+        state.foods.delete(id);
+    }
+    for (const food of delta.foods_added || []) {
+        state.foods.set(food.id, food);
+    }
+    if (delta.speed !== undefined) {
+        state.speed = delta.speed;
+    }
+}
+
+// 二进制帧读取器，格式见服务端 encode_keyframe_binary / encode_delta_binary
+class FrameReader {
+    constructor(buffer) {
+        this.view = new DataView(buffer);
+        this.bytes = new Uint8Array(buffer);
+        this.offset = 0;
+        this.cellBytes = 2;
+        this.gridWidth = 1;
+    }
+    u8() { return this.view.getUint8(this.offset++); }
+    u16() { const v = this.view.getUint16(this.offset, true); this.offset += 2; return v; }
+    u32() { const v = this.view.getUint32(this.offset, true); this.offset += 4; return v; }
+    i32() { const v = this.view.getInt32(this.offset, true); this.offset += 4; return v; }
+    f32() { const v = this.view.getFloat32(this.offset, true); this.offset += 4; return v; }
+    str() {
+        const length = this.u8();
+        const text = textDecoder.decode(this.bytes.subarray(this.offset, this.offset + length));
+        this.offset += length;
+        return text;
+    }
+    cell() { return this.cellBytes === 2 ? this.u16() : this.u32(); }
+    pos(cell) { return [cell % this.gridWidth, Math.floor(cell / this.gridWidth)]; }
+    cells(count) {
+        const result = new Array(count);
+        for (let i = 0; i < count; i++) {
+            result[i] = this.pos(this.cell());
+        }
+        return result;
+    }
+    player() {
+        const slot = this.u16();
+        const id = this.str();
+        const name = this.str();
+        const color = '#' + [this.u8(), this.u8(), this.u8()]
+            .map(c => c.toString(16).padStart(2, '0')).join('');
+        const score = this.i32();
+        const alive = this.u8() === 1;
+        const body = this.cells(this.u32());
+        return {slot, id, name, color, score, alive, body};
+    }
+}
+const textDecoder = new TextDecoder();
+
+function handleBinaryFrame(buffer) {
+    const reader = new FrameReader(buffer);
+    const type = reader.u8();
+    reader.cellBytes = reader.u8();
+    const seq = reader.u32();
+    const tick = reader.u32();
+
+    if (type === 1) {
+        const previous = captureBodies(gameState);
+        gameState = readBinaryKeyframe(reader);
+        lastSeq = seq;
+        resyncPending = false;
+        finishFrame(gameState, previous, tick, gameState.speed);
+    } else if (type === 2) {
+        if (!gameState || seq !== lastSeq + 1) {
+            requestResync();
+            return;
+        }
+        const previous = captureBodies(gameState);
+        reader.gridWidth = gameState.grid_width;
+        applyBinaryDelta(gameState, reader);
+        lastSeq = seq;
+        finishFrame(gameState, previous, tick, gameState.speed);
+    }
+}
+
+function setBinaryFood(state, reader, cell) {
+    const [x, y] = reader.pos(cell);
+    state.foods.set(cell, {x, y, id: cell});
+}
+
+function readBinaryKeyframe(reader) {
+    const state = {
+        players: new Map(),
+        foods: new Map(),
+        slots: new Map(),
+        grid_width: reader.u16(),
+        grid_height: reader.u16(),
+        speed: reader.f32()
+    };
+    reader.gridWidth = state.grid_width;
+    for (let count = reader.u16(); count > 0; count--) {
+        const player = reader.player();
+        state.players.set(player.id, player);
+        state.slots.set(player.slot, player.id);
+    }
+    for (let count = reader.u16(); count > 0; count--) {
+        setBinaryFood(state, reader, reader.cell());
+    }
+    return state;
+}
+
+function applyBinaryDelta(state, reader) {
+    for (let count = reader.u16(); count > 0; count--) {
+        const slot = reader.u16();
+        state.players.delete(state.slots.get(slot));
+        state.slots.delete(slot);
+    }
+    for (let count = reader.u16(); count > 0; count--) {
+        const player = reader.player();
+        state.players.set(player.id, player);
+        state.slots.set(player.slot, player.id);
+    }
+    for (let count = reader.u16(); count > 0; count--) {
+        const player = state.players.get(state.slots.get(reader.u16()));
+        const heads = reader.cells(reader.u16());
+        const tails = reader.u16();
+        if (!player) continue;
+        for (const head of heads) {
+            player.body.unshift(head);
+        }
+        for (let i = 0; i < tails; i++) {
+            player.body.pop();
+        }
+    }
+    for (let count = reader.u16(); count > 0; count--) {
+        const player = state.players.get(state.slots.get(reader.u16()));
+        const score = reader.i32();
+        const alive = reader.u8() === 1;
+        if (player) {
+            player.score = score;
+            player.alive = alive;
+        }
+    }
+    for (let count = reader.u16(); count > 0; count--) {
+        state.foods.delete(reader.cell());
+    }
+    for (let count = reader.u16(); count > 0; count--) {
+        setBinaryFood(state, reader, reader.cell());
+    }
+    state.speed = reader.f32();
+}
+
+// 序号不连续时请求服务器重发完整状态
+function requestResync() {
+    if (resyncPending || !ws || ws.readyState !== WebSocket.OPEN) return;
+    resyncPending = true;
+    ws.send(JSON.stringify({type: 'resync'}));
+}
+
+// 应用权威帧前记录各玩家的蛇身，作为插值的起点
+function captureBodies(state) {
+    const bodies = new Map();
+    if (state) {
+        for (const player of state.players.values()) {
+            bodies.set(player.id, player.body.slice());
+        }
+    }
+    return bodies;
+}
+
+// 应用权威帧后：tick推进时从上一tick的蛇身开始插值，并校正本地预测
+function finishFrame(state, previous, tick, tickRate) {
+    if (tick !== serverTick) {
+        for (const player of state.players.values()) {
+            player.prevBody = previous.get(player.id) || null;
+        }
+        serverTick = tick;
+        tickArrival = performance.now();
+    } else {
+        for (const player of state.players.values()) {
+            if (player.prevBody === undefined) player.prevBody = previous.get(player.id) || null;
+        }
+    }
+    tickInterval = 1000 / tickRate;
+    reconcile(state);
+    updateSidebar(state);
+}
+
+// 蛇头当前朝向（考虑场地环绕）
+function headingOf(body) {
+    const wrap = d => d > 1 ? -1 : (d < -1 ? 1 : d);
+    return [wrap(body[0][0] - body[1][0]), wrap(body[0][1] - body[1][1])];
+}
+
+// 服务端确认转向（或转向超过3个tick仍未生效）后，以权威朝向为准
+function reconcile(state) {
+    const me = state.players.get(playerId);
+    if (!me || me.body.length < 2) return;
+    const [dx, dy] = headingOf(me.body);
+    if (pendingTurn && ((pendingTurn.direction[0] === dx && pendingTurn.direction[1] === dy) ||
+                        serverTick - pendingTurn.tick > 3)) {
+        pendingTurn = null;
+    }
+    if (!pendingTurn) {
+        localDirection = [dx, dy];
+    }
+}
+
+// 发送转向，同时立即应用到本地预测
+function turn(direction) {
+    if (!ws || ws.readyState !== WebSocket.OPEN) return;
+    const me = gameState && gameState.players.get(playerId);
+    if (me && !me.alive) return;
+    if (!me || me.body.length < 2) {
+        ws.send(JSON.stringify({type: 'change_direction', direction: direction}));
+        return;
+    }
+    // 与服务端输入队列规则一致：与最近一次方向相同或相反的指令会被丢弃，
+    // 不发送这些指令，免得白白占用服务端的消息限流额度
+    const vector = DIRECTION_VECTORS[direction];
+    const [dx, dy] = localDirection || headingOf(me.body);
+    if ((vector[0] === dx && vector[1] === dy) || (vector[0] === -dx && vector[1] === -dy)) return;
+    ws.send(JSON.stringify({type: 'change_direction', direction: direction}));
+    localDirection = vector;
+    pendingTurn = {direction: vector, tick: serverTick};
+}
+
+// 本帧绘制用的蛇身：其他玩家从上一tick插值到当前tick，自己从当前tick预测到下一tick
+// 只有蛇头和蛇尾在格子之间移动，中间的身体停在整格上，重绘时不产生变化
+function renderBody(player, state, alpha) {
+    const body = player.body;
+    let from = player.prevBody, to = body;
+    if (player.id === playerId && player.alive && localDirection && body.length > 0) {
+        const head = [
+            (body[0][0] + localDirection[0] + state.grid_width) % state.grid_width,
+            (body[0][1] + localDirection[1] + state.grid_height) % state.grid_height
+        ];
+        from = body;
+        to = [head, ...body.slice(0, body.length - 1)];
+    }
+    if (!from) return body;
+
+    const last = to.length - 1;
+    return to.map((cell, i) => {
+        const start = from[i];
+        if ((i !== 0 && i !== last) || !start) return cell;
+        const dx = cell[0] - start[0], dy = cell[1] - start[1];
+        if (Math.abs(dx) > 1 || Math.abs(dy) > 1) return cell;  // 穿过场地边界时不插值
+        return [start[0] + dx * alpha, start[1] + dy * alpha];
+    });
+}
+
+// 每个动画帧重绘
+function renderLoop(now) {
+    if (gameState) {
+        const alpha = Math.min(1, Math.max(0, (now - tickArrival) / tickInterval));
+        updateGame(gameState, alpha);
+    }
+    requestAnimationFrame(renderLoop);
+}
+requestAnimationFrame(renderLoop);
+
+// 背景层：底色和网格只绘制一次，多出一格用于镜头平滑移动时偏移取样
+const CELL = 20;
+const backgroundLayer = document.createElement('canvas');
+backgroundLayer.width = canvas.width + CELL;
+backgroundLayer.height = canvas.height + CELL;
+(function paintBackgroundLayer() {
+    const bg = backgroundLayer.getContext('2d');
+    bg.fillStyle = '#0d1b2a';
+    bg.fillRect(0, 0, backgroundLayer.width, backgroundLayer.height);
+    bg.strokeStyle = 'rgba(255, 255, 255, 0.05)';
+    bg.lineWidth = 1;
+    bg.beginPath();
+    for (let x = 0; x <= backgroundLayer.width; x += CELL) {
+        bg.moveTo(x, 0);
+        bg.lineTo(x, backgroundLayer.height);
+    }
+    for (let y = 0; y <= backgroundLayer.height; y += CELL) {
+        bg.moveTo(0, y);
+        bg.lineTo(backgroundLayer.width, y);
+    }
+    bg.stroke();
+})();
+
+// 精灵缓存：每种颜色的蛇身、各方向的蛇头、食物和玩家名称各绘制一次
+const spriteCache = new Map();
+function sprite(key, width, height, draw) {
+    let image = spriteCache.get(key);
+    if (!image) {
+        image = document.createElement('canvas');
+        image.width = width;
+        image.height = height;
+        image.spriteKey = key;
+        draw(image.getContext('2d'));
+        spriteCache.set(key, image);
+    }
+    return image;
+}
+
+function bodySprite(color) {
+    return sprite('body:' + color, CELL, CELL, c => {
+        c.fillStyle = color;
+        c.fillRect(0, 0, CELL, CELL);
+        // 蛇身内部阴影
+        c.fillStyle = 'rgba(255, 255, 255, 0.2)';
+        c.fillRect(2, 2, 16, 16);
+    });
+}
+
+// 眼睛位置按朝向确定
+const EYES = {
+    '1,0': [[15, 5], [15, 15]],
+    '-1,0': [[5, 5], [5, 15]],
+    '0,1': [[5, 15], [15, 15]],
+    '0,-1': [[5, 5], [15, 5]]
+};
+function headSprite(color, direction) {
+    const eyes = EYES[direction] || EYES['0,-1'];
+    return sprite(`head:${color}:${direction}`, CELL, CELL, c => {
+        c.fillStyle = color;
+        c.fillRect(0, 0, CELL, CELL);
+        c.fillStyle = 'white';
+        c.beginPath();
+        for (const [x, y] of eyes) {
+            c.moveTo(x + 2, y);
+            c.arc(x, y, 2, 0, Math.PI * 2);
+        }
+        c.fill();
+        // 蛇瞳孔
+        c.fillStyle = 'black';
+        c.beginPath();
+        for (const [x, y] of eyes) {
+            c.moveTo(x + 1, y);
+            c.arc(x, y, 1, 0, Math.PI * 2);
+        }
+        c.fill();
+    });
+}
+
+function foodSprite() {
+    return sprite('food', CELL, CELL, c => {
+        c.fillStyle = '#FF5252';
+        c.beginPath();
+        c.arc(10, 10, 8, 0, Math.PI * 2);
+        c.fill();
+        // 食物光泽效果
+        c.fillStyle = 'rgba(255, 255, 255, 0.3)';
+        c.beginPath();
+        c.arc(6, 6, 3, 0, Math.PI * 2);
+        c.fill();
+    });
+}
+
+function labelSprite(name) {
+    ctx.font = '12px Arial';
+    const width = Math.ceil(ctx.measureText(name).width) + 4;
+    return sprite('label:' + name, width, 16, c => {
+        c.fillStyle = 'white';
+        c.font = '12px Arial';
+        c.textAlign = 'center';
+        c.fillText(name, width / 2, 12);
+    });
+}
+
+// 上一帧画面中的精灵，键为 精灵@坐标；两帧之间只重绘出现或消失的精灵所在区域
+let drawnItems = new Map();
+let drawnCamera = null;
+
+// 绘制游戏画面
+function updateGame(state, alpha) {
+    const bodies = new Map();
+    for (const player of state.players.values()) {
+        bodies.set(player.id, renderBody(player, state, alpha));
+    }
+
+    // 场地超过画布时镜头跟随自己的蛇头，坐标按场地环绕换算到画布
+    const viewWidth = canvas.width / CELL;
+    const viewHeight = canvas.height / CELL;
+    const myBody = bodies.get(playerId);
+    let camX = 0, camY = 0;
+    if (myBody && myBody.length > 0) {
+        if (state.grid_width > viewWidth) camX = myBody[0][0] - Math.floor(viewWidth / 2);
+        if (state.grid_height > viewHeight) camY = myBody[0][1] - Math.floor(viewHeight / 2);
+    }
+    const wrapView = (value, size) => {
+        const v = ((value % size) + size) % size;
+        return v > size - 1 ? v - size : v;
+    };
+    const toPixels = ([x, y]) => [
+        Math.round(wrapView(x - camX, state.grid_width) * CELL),
+        Math.round(wrapView(y - camY, state.grid_height) * CELL)
+    ];
+
+    // 本帧的精灵列表，按绘制顺序：食物、蛇身、蛇头、名称
+    const items = new Map();
+    const add = (image, x, y) => {
+        if (x + image.width <= 0 || y + image.height <= 0 ||
+            x >= canvas.width || y >= canvas.height) return;
+        items.set(`${image.spriteKey}@${x},${y}`, {image, x, y});
+    };
+    for (const food of state.foods.values()) {
+        const [x, y] = toPixels([food.x, food.y]);
+        add(foodSprite(), x, y);
+    }
+    for (const player of state.players.values()) {
+        const body = bodies.get(player.id);
+        const segment = bodySprite(player.color);
+        for (let i = body.length - 1; i > 0; i--) {
+            const [x, y] = toPixels(body[i]);
+            add(segment, x, y);
+        }
+        if (body.length > 0) {
+            const direction = player.id === playerId && player.alive && localDirection ?
+                localDirection : (player.body.length > 1 ? headingOf(player.body) : [0, -1]);
+            const [x, y] = toPixels(body[0]);
+            add(headSprite(player.color, direction.join(',')), x, y);
+            const label = labelSprite(player.name);
+            add(label, x + CELL / 2 - Math.floor(label.width / 2), y - 17);
+        }
+    }
+
+    const myPlayer = state.players.get(playerId);
+    const gameOver = myPlayer && !myPlayer.alive;
+    const camera = `${camX},${camY}`;
+    if (gameOver || camera !== drawnCamera) {
+        // 镜头移动或显示结束画面时整屏重绘
+        drawBackground(camX, camY, null);
+        for (const item of items.values()) {
+            ctx.drawImage(item.image, item.x, item.y);
+        }
+    } else {
+        const dirty = [];
+        for (const [key, item] of drawnItems) {
+            if (!items.has(key)) dirty.push(item);
+        }
+        for (const [key, item] of items) {
+            if (!drawnItems.has(key)) dirty.push(item);
+        }
+        if (dirty.length > 0) {
+            ctx.save();
+            ctx.beginPath();
+            for (const rect of dirty) {
+                ctx.rect(rect.x, rect.y, rect.image.width, rect.image.height);
+            }
+            ctx.clip();
+            drawBackground(camX, camY, dirty);
+            for (const item of items.values()) {
+                if (dirty.some(rect => overlaps(rect, item))) {
+                    ctx.drawImage(item.image, item.x, item.y);
+                }
+            }
+            ctx.restore();
+        }
+    }
+    drawnItems = items;
+    drawnCamera = gameOver ? null : camera;
+
+    // 如果玩家死亡，显示死亡信息
+    if (gameOver) {
+        ctx.fillStyle = 'rgba(0, 0, 0, 0.7)';
+        ctx.fillRect(0, 0, canvas.width, canvas.height);
+
+        ctx.fillStyle = 'white';
+        ctx.font = 'bold 30px Arial';
+        ctx.textAlign = 'center';
+        ctx.fillText('游戏结束!', canvas.width / 2, canvas.height / 2 - 30);
+
+        ctx.font = '20px Arial';
+        ctx.fillText(`最终得分: ${myPlayer.score}`, canvas.width / 2, canvas.height / 2 + 20);
+
+        ctx.font = '16px Arial';
+        ctx.fillText('刷新页面重新开始', canvas.width / 2, canvas.height / 2 + 60);
+    }
+}
+
+// 从背景层取样绘制背景，网格随镜头的小数部分偏移；只重绘脏区域时由裁剪限制范围
+function drawBackground(camX, camY, dirty) {
+    const offsetX = Math.round((((camX % 1) + 1) % 1) * CELL);
+    const offsetY = Math.round((((camY % 1) + 1) % 1) * CELL);
+    if (!dirty) {
+        ctx.drawImage(backgroundLayer, offsetX, offsetY, canvas.width, canvas.height,
+                      0, 0, canvas.width, canvas.height);
+        return;
+    }
+    for (const rect of dirty) {
+        const x = Math.max(0, rect.x), y = Math.max(0, rect.y);
+        const width = Math.min(canvas.width, rect.x + rect.image.width) - x;
+        const height = Math.min(canvas.height, rect.y + rect.image.height) - y;
+        if (width > 0 && height > 0) {
+            ctx.drawImage(backgroundLayer, x + offsetX, y + offsetY, width, height,
+                          x, y, width, height);
+        }
+    }
+}
+
+function overlaps(a, b) {
+    return a.x < b.x + b.image.width && b.x < a.x + a.image.width &&
+           a.y < b.y + b.image.height && b.y < a.y + a.image.height;
+}
+
+// 收到权威帧时更新侧栏，只修改发生变化的内容
+function updateSidebar(state) {
+    // 更新玩家列表
+    updatePlayerList([...state.players.values()]);
+
+    // 更新统计信息
+    let alivePlayers = 0;
+    for (const player of state.players.values()) {
+        if (player.alive) {
+            alivePlayers++;
+        }
+    }
+    setText(playerCountEl, `${alivePlayers}/${state.players.size}`);
+    setText(gameSpeedEl, state.speed.toFixed(1));
+
+    const myPlayer = state.players.get(playerId);
+    if (myPlayer) {
+        setText(playerScoreEl, String(myPlayer.score));
+    }
+}
+
+function setText(el, text) {
+    if (el.textContent !== text) el.textContent = text;
+}
+
+// 玩家列表：每个玩家一个列表项，分数、存活或排名变化时才修改DOM
+const playerItems = new Map();
+let playerOrder = '';
+
+function updatePlayerList(players) {
+    if (playerItems.size === 0) {
+        playerListEl.innerHTML = '';
+    }
+
+    const present = new Set();
+    for (const player of players) {
+        present.add(player.id);
+        let item = playerItems.get(player.id);
+        if (!item) {
+            const li = document.createElement('li');
+            li.className = 'player-item';
+            li.style.borderLeftColor = player.color;
+
+            const nameSpan = document.createElement('span');
+            nameSpan.className = 'player-name';
+            nameSpan.textContent = player.name + (player.id === playerId ? ' (你)' : '');
+
+            const scoreSpan = document.createElement('span');
+            scoreSpan.className = 'player-score';
+
+            li.appendChild(nameSpan);
+            li.appendChild(scoreSpan);
+            item = {li, scoreSpan, score: null, alive: null};
+            playerItems.set(player.id, item);
+        }
+        if (item.score !== player.score) {
+            item.score = player.score;
+            item.scoreSpan.textContent = player.score;
+        }
+        if (item.alive !== player.alive) {
+            item.alive = player.alive;
+            item.li.style.opacity = player.alive ? '' : '0.6';
+        }
+    }
+    for (const [id, item] of playerItems) {
+        if (!present.has(id)) {
+            item.li.remove();
+            playerItems.delete(id);
+        }
+    }
+
+    // 按分数排序，顺序变化时才重新排列
+    const sorted = [...players].sort((a, b) => b.score - a.score);
+    const order = sorted.map(player => player.id).join(',');
+    if (order !== playerOrder) {
+        playerOrder = order;
+        for (const player of sorted) {
+            playerListEl.appendChild(playerItems.get(player.id).li);
+        }
+    }
+}
+
+// 添加聊天消息
+function addChatMessage(player, message, time) {
+    const messageEl = document.createElement('div');
+    messageEl.className = 'chat-message';
+    messageEl.innerHTML = `<strong style="color: ${player === playerName ? playerColor : '#4dff91'}">${player}:</strong> ${message} <span style="color: #888; font-size: 0.8em;">${time}</span>`;
+
+    chatLogEl.appendChild(messageEl);
+    chatLogEl.scrollTop = chatLogEl.scrollHeight;
+}
+
+// 发送聊天消息
+function sendChatMessage() {
+    const message = chatInputEl.value.trim();
+    if (message && ws && ws.readyState === WebSocket.OPEN) {
+        ws.send(JSON.stringify({
+            type: 'chat',
+            message: message
+        }));
+
+        chatInputEl.value = '';
+    }
+}
+
+// 键盘控制
+const keyMap = {
+    'ArrowUp': 'up',
+    'ArrowDown': 'down',
+    'ArrowLeft': 'left',
+    'ArrowRight': 'right',
+    'w': 'up',
+    's': 'down',
+    'a': 'left',
+    'd': 'right',
+    'W': 'up',
+    'S': 'down',
+    'A': 'left',
+    'D': 'right'
+};
+
+document.addEventListener('keydown', (e) => {
+    // 如果聊天框有焦点，不处理方向键
+    if (document.activeElement === chatInputEl) {
+        if (e.key === 'Enter') {
+            sendChatMessage();
+            e.preventDefault();
+        }
+        return;
+    }
+
+    // 空格键切换聊天框焦点
+    if (e.key === ' ') {
+        e.preventDefault();
+        if (chatInputEl === document.activeElement) {
+            chatInputEl.blur();
+        } else {
+            chatInputEl.focus();
+        }
+        return;
+    }
+
+    // 方向控制；按住方向键时的自动重复不再发送，避免耗尽限流额度
+    if (keyMap[e.key]) {
+        if (!e.repeat) {
+            turn(keyMap[e.key]);
+        }
+        e.preventDefault();
+    }
+});
+
+// 发送按钮事件
+sendBtn.addEventListener('click', sendChatMessage);
+chatInputEl.addEventListener('keypress', (e) => {
+    if (e.key === 'Enter') {
+        sendChatMessage();
+    }
+});
+
+// 触摸控制（移动设备）
+let touchStartX = 0;
+let touchStartY = 0;
+
+canvas.addEventListener('touchstart', (e) => {
+    e.preventDefault();
+    touchStartX = e.touches[0].clientX;
+    touchStartY = e.touches[0].clientY;
+}, {passive: false});
+
+canvas.addEventListener('touchend', (e) => {
+    e.preventDefault();
+    const touchEndX = e.changedTouches[0].clientX;
+    const touchEndY = e.changedTouches[0].clientY;
+
+    const dx = touchEndX - touchStartX;
+    const dy = touchEndY - touchStartY;
+
+    // 确定滑动方向
+    if (Math.abs(dx) > Math.abs(dy)) {
+        // 水平滑动
+        if (dx > 0 && ws) {
+            turn('right');
+        } else if (dx < 0 && ws) {
+            turn('left');
+        }
+    } else {
+        // 垂直滑动
+        if (dy > 0 && ws) {
+            turn('down');
+        } else if (dy < 0 && ws) {
+            turn('up');
+        }
+    }
+}, {passive: false});
+
+// 防止触摸滚动
+document.addEventListener('touchmove', (e) => {
+    if (e.target === canvas) {
+        e.preventDefault();
+    }
+}, {passive: false});
+
+// 初始连接
+connectWebSocket();
+
+// 页面可见性变化处理
+document.addEventListener('visibilitychange', () => {
+    if (document.hidden) {
+        console.log('页面切换到后台');
+    } else {
+        console.log('页面回到前台');
+    }
+});